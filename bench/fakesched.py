@@ -0,0 +1,110 @@
+'''
+Stub job scheduler commands for the benchmarks (so they can run offline).
+
+qsub/sbatch read the job script from stdin and print a new job id, and the
+other commands don't do anything. Every call is counted in "calls.log".
+
+With scripts=True, the job scripts are saved (as scripts/jobid) and the job ids
+are numbered from 101 and printed the way Torque and Slurm print them
+("101.torque", "102[].torque" for arrays, "103;cluster" for sbatch --parsable).
+'''
+import os
+import stat
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+SUBMIT = '''#!/bin/bash
+cat > /dev/null
+echo %s >> "%s"
+echo "$$$RANDOM"
+'''
+
+NOOP = '''#!/bin/bash
+echo %s "$@" >> "%s"
+'''
+
+# (saves the job script, with numbered job ids)
+SAVE = '''#!/bin/bash
+echo %(name)s "$@" >> "%(log)s"
+n=$(( $(cat "%(path)s/jobid" 2>/dev/null || echo 100) + 1 ))
+echo $n > "%(path)s/jobid"
+cat > "%(path)s/scripts/$n"
+%(output)s
+'''
+
+SAVE_OUTPUT = {
+    'qsub': '''if grep -q '^#PBS -t' "%(path)s/scripts/$n"; then
+  echo "$n[].torque"
+else
+  echo "$n.torque"
+fi''',
+    'sbatch': '''if [ "$1" == "--parsable" ]; then
+  echo "$n;cluster"
+else
+  echo "Submitted batch job $n"
+fi''',
+}
+
+
+def make_stubs(path, scripts=False):
+    'writes the stub commands to path, returns the environment to run them with'
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    log = os.path.join(path, 'calls.log')
+    for name in ['qsub', 'sbatch']:
+        if scripts:
+            output = SAVE_OUTPUT[name] % {'path': path}
+            _write_script(os.path.join(path, name), SAVE % {'name': name, 'log': log, 'path': path, 'output': output})
+        else:
+            _write_script(os.path.join(path, name), SUBMIT % (name, log))
+    if scripts and not os.path.exists(os.path.join(path, 'scripts')):
+        os.makedirs(os.path.join(path, 'scripts'))
+    for name in ['qdel', 'qrls', 'qstat', 'scancel', 'scontrol']:
+        _write_script(os.path.join(path, name), NOOP % (name, log))
+
+    env = dict(os.environ)
+    # qtask-mon (and mqsub) from this checkout
+    env['PATH'] = '%s:%s:%s' % (path, os.path.join(ROOT, 'bin'), env.get('PATH', ''))
+    env['PYTHONPATH'] = ROOT
+    # a fake home, so that a real ~/.qtaskrc isn't read
+    env['HOME'] = path
+    for k in env.keys():
+        if k[:6] == 'QTASK_':
+            del env[k]
+    return env
+
+
+def call_counts(path):
+    'returns the number of times each stub command was called'
+    counts = {}
+    log = os.path.join(path, 'calls.log')
+    if os.path.exists(log):
+        with open(log) as f:
+            for line in f:
+                name = line.split()[0]
+                counts[name] = counts.get(name, 0) + 1
+    return counts
+
+
+def calls(path):
+    'returns the arguments of each stub command call (as lists)'
+    calls = []
+    log = os.path.join(path, 'calls.log')
+    if os.path.exists(log):
+        with open(log) as f:
+            for line in f:
+                calls.append(line.split())
+    return calls
+
+
+def script(path, jobid):
+    'returns the job script saved for a job id (with scripts=True)'
+    with open(os.path.join(path, 'scripts', jobid.split('.')[0].split(';')[0].replace('[]', ''))) as f:
+        return f.read()
+
+
+def _write_script(fname, src):
+    with open(fname, 'w') as f:
+        f.write(src)
+    os.chmod(fname, os.stat(fname).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
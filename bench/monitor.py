@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+'''
+Monitor write benchmark
+
+Records -jobs jobs in a temporary sqlite monitor, then starts N writer
+processes at once. Each writer runs "qtask-mon start" and "qtask-mon stop"
+for its share of the jobs (the same calls that each job makes), so the
+writers compete for the monitor lock. Reports the write rate and the time
+spent waiting for the lock (from $QTASK_MON_STATS).
+'''
+import os
+import sys
+import time
+import json
+import shutil
+import tempfile
+import subprocess
+
+import fakesched
+
+ROOT = fakesched.ROOT
+QTASK_MON = os.path.join(ROOT, 'bin', 'qtask-mon')
+
+
+def usage():
+    print __doc__
+    print '''Usage: monitor.py {options}
+
+Options:
+  -writers list   Number of concurrent writers (default: 1,4,16)
+  -jobs num       Number of jobs (default: 400)
+  -json file      Also write the results to this file
+'''
+    sys.exit(1)
+
+
+def read_stats(fname):
+    'sums the $QTASK_MON_STATS lines from every qtask-mon call'
+    stats = {'calls': 0, 'lock_wait': 0.0, 'lock_max_wait': 0.0, 'lock_broken': 0}
+    with open(fname) as f:
+        for line in f:
+            cols = line.rstrip('\n').split('\t')
+            vals = dict([x.split('=', 1) for x in cols[3:]])
+            stats['calls'] += 1
+            stats['lock_wait'] += float(vals.get('lock_wait', 0))
+            stats['lock_max_wait'] = max(stats['lock_max_wait'], float(vals.get('lock_max_wait', 0)))
+            stats['lock_broken'] += int(vals.get('lock_broken', 0))
+    return stats
+
+
+def run(writers, jobs, tmpdir):
+    sys.path.insert(0, ROOT)
+    import qtask.monitor
+
+    path = os.path.join(tmpdir, 'bench%s.db' % writers)
+    uri = 'sqlite://%s' % path
+    mon = qtask.monitor.load_monitor(uri)
+    with mon.batch():
+        for i in xrange(jobs):
+            mon.submit('job%s' % i, 'bench', 'echo %s' % i, run='bench')
+    mon.close()
+
+    env = fakesched.make_stubs(tmpdir)
+    env['QTASK_MON_STATS'] = os.path.join(tmpdir, 'stats%s.txt' % writers)
+
+    scripts = []
+    for w in xrange(writers):
+        script = os.path.join(tmpdir, 'writer%s.%s.sh' % (writers, w))
+        with open(script, 'w') as f:
+            f.write('for j in %s; do\n' % ' '.join(['job%s' % i for i in xrange(w, jobs, writers)]))
+            f.write('  "%s" "%s" "%s" start $j localhost\n' % (sys.executable, QTASK_MON, uri))
+            f.write('  "%s" "%s" "%s" stop $j 0\n' % (sys.executable, QTASK_MON, uri))
+            f.write('done\n')
+        scripts.append(script)
+
+    start = time.time()
+    procs = [subprocess.Popen(['/bin/bash', script], env=env) for script in scripts]
+    for proc in procs:
+        proc.wait()
+    elapsed = time.time() - start
+
+    done = len(qtask.monitor.load_monitor(uri).find(status='done'))
+    result = read_stats(env['QTASK_MON_STATS'])
+    result.update({'writers': writers, 'jobs': jobs, 'secs': elapsed, 'events_per_sec': result['calls'] / elapsed, 'done': done})
+    return result
+
+
+def bench(writer_counts=[1, 4, 16], jobs=400):
+    results = []
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for writers in writer_counts:
+            result = run(writers, jobs, tmpdir)
+            sys.stdout.write('writers=%-4s %5s events in %7.3f sec (%7.1f/sec), lock wait %.3f sec (max %.3f), %s broken, %s/%s done\n' % (writers, result['calls'], result['secs'], result['events_per_sec'], result['lock_wait'], result['lock_max_wait'], result['lock_broken'], result['done'], jobs))
+            sys.stdout.flush()
+            results.append(result)
+    finally:
+        shutil.rmtree(tmpdir)
+    return results
+
+
+if __name__ == '__main__':
+    opts = {}
+    json_out = None
+
+    last = None
+    for arg in sys.argv[1:]:
+        if last == '-writers':
+            opts['writer_counts'] = [int(x) for x in arg.split(',')]
+        elif last == '-jobs':
+            opts['jobs'] = int(arg)
+        elif last == '-json':
+            json_out = arg
+        elif arg in ['-writers', '-jobs', '-json']:
+            last = arg
+            continue
+        else:
+            usage()
+        last = None
+
+    results = bench(**opts)
+
+    if json_out:
+        with open(json_out, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write('\n')
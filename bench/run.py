@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+'''
+Runs all of the benchmarks, using stub scheduler commands and temporary
+sqlite monitors (nothing is submitted to a real scheduler):
+
+  submit.py     pipeline submission throughput and peak memory
+  monitor.py    monitor write rate with concurrent qtask-mon writers
+  startup.py    qtask-mon startup time
+  schedulers.py PBS and Slurm job scripts (checks, not timed)
+  throttle.py   a long chain submitted with max_queued (check, not timed)
+
+See each script for more options (and larger runs, ex: submit.py -n 1000000
+-runner inproc).
+'''
+import sys
+import json
+
+import submit
+import monitor
+import startup
+import schedulers
+import throttle
+
+
+def usage():
+    print __doc__
+    print '''Usage: run.py {-json file}
+'''
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+    json_out = None
+
+    last = None
+    for arg in sys.argv[1:]:
+        if last == '-json':
+            json_out = arg
+            last = None
+        elif arg == '-json':
+            last = arg
+        else:
+            usage()
+
+    results = {}
+
+    sys.stdout.write('== submit\n')
+    results['submit'] = submit.bench(sizes=[1000, 10000], runners=['inproc'])
+    results['submit'].extend(submit.bench(sizes=[1000], runners=['stub'], monitor=True, mqsub_sizes=[1000]))
+    results['submit'].extend(submit.bench(shapes=[], mqsub_sizes=[10000], array=True))
+
+    sys.stdout.write('\n== monitor\n')
+    results['monitor'] = monitor.bench(writer_counts=[1, 8], jobs=200)
+
+    sys.stdout.write('\n== startup\n')
+    results['startup_ok'] = startup.bench()
+
+    sys.stdout.write('\n== schedulers\n')
+    results['schedulers_ok'] = schedulers.bench()
+
+    sys.stdout.write('\n== throttle\n')
+    results['throttle_ok'] = throttle.bench()
+
+    if json_out:
+        with open(json_out, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    if not results['startup_ok'] or not results['schedulers_ok'] or not results['throttle_ok']:
+        sys.exit(1)
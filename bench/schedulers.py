@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+'''
+Job script checks for the PBS and Slurm runners
+
+Submits a small pipeline with the pbs and slurm runners, using stub qsub/sbatch
+commands that save each job script and print job ids the way Torque
+("101.torque", "102[].torque" for arrays) and Slurm ("103;cluster" for
+sbatch --parsable) do. Then checks that the job ids were parsed, and that the
+scripts have the expected dependency, array, hold and resource lines. Fails
+(exit code 1) if any check doesn't pass.
+
+The pipeline:
+  first     a job
+  array     an array job (3 inputs, -tc 2)
+  after     depends on "first" and "array", and an external job and array job
+  held      a held job with ppn=4 and mem=2G
+'''
+import os
+import sys
+import json
+import shutil
+import tempfile
+import subprocess
+
+import fakesched
+
+ROOT = fakesched.ROOT
+
+# the external jobs that "after" depends on (the "depends" resource)
+EXTERNAL = {'pbs': '55.torque,56[].torque', 'slurm': '55,56'}
+
+CHECKS = {
+    'pbs': [
+        ('jobid', 'first', '101.torque'),
+        ('jobid', 'array', '102[].torque'),
+        ('line', 'array', '#PBS -t 1-3%2'),
+        ('line', 'after', '#PBS -W depend=afterok:101.torque:55.torque,afterokarray:102[].torque:56[].torque'),
+        ('no_line', 'first', '#PBS -W depend='),
+        ('line', 'held', '#PBS -h'),
+        ('line', 'held', '#PBS -l nodes=1:ppn=4'),
+        ('line', 'held', '#PBS -l mem=8192mb'),
+        ('call', ['qsub']),
+        ('call', ['qrls', '%(held)s']),
+        ('call', ['qdel', '101.torque', '102[].torque']),
+    ],
+    'slurm': [
+        ('jobid', 'first', '101'),
+        ('jobid', 'array', '102'),
+        ('line', 'array', '#SBATCH --array=1-3%2'),
+        ('line', 'after', '#SBATCH --dependency=afterok:101:102:55:56'),
+        ('line', 'after', '#SBATCH --kill-on-invalid-dep=yes'),
+        ('no_line', 'first', '#SBATCH --dependency='),
+        ('line', 'held', '#SBATCH --hold'),
+        ('line', 'held', '#SBATCH --cpus-per-task=4'),
+        ('line', 'held', '#SBATCH --mem-per-cpu=2G'),
+        ('call', ['sbatch', '--parsable']),
+        ('call', ['scontrol', 'release', '%(held)s']),
+        ('call', ['scancel', '101', '102']),
+    ],
+}
+
+
+def usage():
+    print __doc__
+    print '''Usage: schedulers.py {-runner pbs,slurm} {-v}
+
+Options:
+  -runner list    Runners to check (default: pbs,slurm)
+  -v              Show the job scripts
+'''
+    sys.exit(1)
+
+
+def child(runner):
+    'submits the pipeline (in this process), returns the job id of each task'
+    sys.path.insert(0, ROOT)
+    import qtask
+
+    @qtask.task(walltime='0:10:00')
+    def first():
+        return 'echo first'
+
+    @qtask.task(walltime='0:10:00', depends=EXTERNAL[runner])
+    def after():
+        return 'echo after'
+
+    @qtask.task(holding=True, ppn=4, mem='2G')
+    def held():
+        return 'echo held'
+
+    a = first()
+    b = qtask.QTask('cat "$QTASK_INPUT"', 'array', {'tc': '2'}, array=['one.txt', 'two.txt', 'three.txt'])
+    qtask.pipeline.add_task(b)
+    c = after().deps(a, b)
+    d = held()
+
+    qtask.pipeline.submit()
+
+    jobids = {}
+    for task in [a, b, c, d]:
+        jobids[task.name] = task.jobid
+
+    d.release()
+    qtask.pipeline.runner.qdel(a.jobid, b.jobid)
+
+    return jobids
+
+
+def run_checks(runner, tmpdir, verbose=False):
+    'submits the pipeline in a child process (with the stub commands), returns the failed checks'
+    casedir = tempfile.mkdtemp(dir=tmpdir)
+    env = fakesched.make_stubs(casedir, scripts=True)
+    env['QTASK_RUNNER'] = runner
+
+    out = os.path.join(casedir, 'jobids.json')
+    with open('/dev/null', 'w') as devnull:
+        retval = subprocess.call([sys.executable, os.path.realpath(__file__), '-child', runner, out], stdout=None if verbose else devnull, env=env, cwd=casedir)
+    if retval != 0 or not os.path.exists(out):
+        return ['submit failed (%s)' % retval]
+
+    with open(out) as f:
+        jobids = json.load(f)
+
+    scripts = {}
+    for name in jobids:
+        if jobids[name]:
+            scripts[name] = fakesched.script(casedir, jobids[name])
+            if verbose:
+                sys.stdout.write('---- %s: %s\n%s\n' % (name, jobids[name], scripts[name]))
+
+    calls = fakesched.calls(casedir)
+
+    failed = []
+    for check in CHECKS[runner]:
+        if check[0] == 'jobid':
+            if jobids.get(check[1]) != check[2]:
+                failed.append('%s job id: %s (expected: %s)' % (check[1], jobids.get(check[1]), check[2]))
+        elif check[0] == 'line':
+            if check[2] not in scripts.get(check[1], '').split('\n'):
+                failed.append('%s script is missing: %s' % (check[1], check[2]))
+        elif check[0] == 'no_line':
+            if [l for l in scripts.get(check[1], '').split('\n') if l.startswith(check[2])]:
+                failed.append('%s script should not have: %s' % (check[1], check[2]))
+        elif check[0] == 'call':
+            args = [x % jobids for x in check[1]]
+            if args not in calls:
+                failed.append('no call to: %s' % ' '.join(args))
+
+    shutil.rmtree(casedir)
+    return failed
+
+
+def bench(runners=['pbs', 'slurm'], verbose=False):
+    'runs the checks for each runner, returns True if they all passed'
+    ok = True
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for runner in runners:
+            failed = run_checks(runner, tmpdir, verbose)
+            for msg in failed:
+                sys.stdout.write('FAIL: %s: %s\n' % (runner, msg))
+            sys.stdout.write('%s: %s of %s checks passed\n' % (runner, len(CHECKS[runner]) - len(failed), len(CHECKS[runner])))
+            if failed:
+                ok = False
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return ok
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4 and sys.argv[1] == '-child':
+        runner, out = sys.argv[2], sys.argv[3]
+        jobids = child(runner)
+        with open(out, 'w') as f:
+            json.dump(jobids, f)
+        sys.exit(0)
+
+    opts = {}
+
+    last = None
+    for arg in sys.argv[1:]:
+        if last == '-runner':
+            opts['runners'] = arg.split(',')
+            last = None
+        elif arg == '-runner':
+            last = arg
+        elif arg == '-v':
+            opts['verbose'] = True
+        else:
+            usage()
+
+    if not bench(**opts):
+        sys.exit(1)
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+'''
+Startup benchmark for qtask-mon
+
+qtask-mon runs at the start and end of every job, so it should only load
+what it needs. This measures the time to import qtask.monitor and to run
+qtask-mon against a temporary sqlite database (compared to starting an
+empty python process). It fails (exit code 1) if importing qtask.monitor
+creates the pipeline or loads a job runner, or if qtask-mon takes more than
+-max ms longer to run than an empty python process.
+'''
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+QTASK_MON = os.path.join(ROOT, 'bin', 'qtask-mon')
+
+# run in a child process, so that we start from a clean interpreter
+IMPORT_CHECK = '''
+import sys
+import time
+sys.path.insert(0, %r)
+start = time.time()
+import qtask.monitor
+elapsed = time.time() - start
+import qtask
+loaded = [m for m in ['qtask.sge', 'qtask.pbs', 'subprocess', 'threading'] if sys.modules.get(m)]
+if object.__getattribute__(qtask.pipeline, '_pipeline') is not None:
+    loaded.append('qtask.pipeline')
+sys.stdout.write('%%s %%s\\n' %% (elapsed, ','.join(loaded)))
+''' % ROOT
+
+
+def usage():
+    print __doc__
+    print '''Usage: startup.py {-n 20} {-max 100}
+
+Options:
+  -n num      Number of times to run each command (default: 20)
+  -max ms     Max allowed qtask-mon overhead in ms (default: 100)
+'''
+    sys.exit(1)
+
+
+def timeit(cmd, n, env=None):
+    'returns the median wall time of running cmd n times'
+    times = []
+    with open('/dev/null', 'w') as devnull:
+        for i in xrange(n):
+            start = time.time()
+            subprocess.check_call(cmd, stdout=devnull, env=env)
+            times.append(time.time() - start)
+    times.sort()
+    return times[len(times) / 2]
+
+
+def bench(n=20, max_ms=100):
+    ok = True
+    tmpdir = tempfile.mkdtemp()
+    try:
+        # a fake home, so that a real ~/.qtaskrc isn't read
+        env = dict(os.environ)
+        env['HOME'] = tmpdir
+
+        proc = subprocess.Popen([sys.executable, '-c', IMPORT_CHECK], stdout=subprocess.PIPE, env=env)
+        out = proc.communicate()[0].split()
+        import_secs = float(out[0])
+        loaded = out[1].split(',') if len(out) > 1 else []
+
+        sys.stdout.write('import qtask.monitor: %.1f ms\n' % (import_secs * 1000))
+        if loaded:
+            sys.stdout.write('FAIL: importing qtask.monitor loaded: %s\n' % ', '.join(loaded))
+            ok = False
+
+        uri = 'sqlite://%s' % os.path.join(tmpdir, 'bench.db')
+        baseline = timeit([sys.executable, '-c', 'pass'], n, env)
+        mon = timeit([sys.executable, QTASK_MON, uri, 'start', '1', 'localhost'], n, env)
+        overhead = (mon - baseline) * 1000
+
+        sys.stdout.write('python startup: %.1f ms\n' % (baseline * 1000))
+        sys.stdout.write('qtask-mon start: %.1f ms (+%.1f ms)\n' % (mon * 1000, overhead))
+        if overhead > max_ms:
+            sys.stdout.write('FAIL: qtask-mon overhead is more than %s ms\n' % max_ms)
+            ok = False
+
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return ok
+
+
+if __name__ == '__main__':
+    n = 20
+    max_ms = 100
+
+    last = None
+    for arg in sys.argv[1:]:
+        if last == '-n':
+            n = int(arg)
+            last = None
+        elif last == '-max':
+            max_ms = float(arg)
+            last = None
+        elif arg in ['-n', '-max']:
+            last = arg
+        else:
+            usage()
+
+    if not bench(n, max_ms):
+        sys.exit(1)
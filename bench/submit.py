@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+'''
+Submission benchmark
+
+Builds synthetic pipelines (with @task) and submits them, either with the
+SGE runner calling stub qsub/qdel/qrls commands ("stub"), or with the SGE
+job scripts rendered, but never submitted ("inproc", to measure qtask's own
+overhead). mqsub fan-outs are submitted with the stub commands. Each case
+runs in its own process, so that its peak memory can be measured.
+
+Shapes:
+  chain     each task depends on the one before it
+  fanout    every task depends on one root task
+  dense     layers of -width tasks, each depending on every task in the
+            layer before it
+'''
+import os
+import sys
+import time
+import json
+import shutil
+import tempfile
+import resource
+import subprocess
+
+import fakesched
+
+ROOT = fakesched.ROOT
+MQSUB = os.path.join(ROOT, 'bin', 'mqsub')
+
+
+def usage():
+    print __doc__
+    print '''Usage: submit.py {options}
+
+Options:
+  -shape list        Pipeline shapes to run (default: chain,fanout,dense)
+  -n list            Number of tasks (default: 1000,10000)
+  -width num         Layer width for "dense" (default: 100)
+  -runner list       inproc, stub (default: inproc,stub)
+  -concurrency num   runner.concurrency (default: 1)
+  -monitor           Record the jobs in a temporary sqlite monitor
+  -mqsub list        Number of input files for mqsub fan-outs (default: none)
+  -array             Submit the mqsub fan-outs as array jobs
+  -json file         Also write the results to this file
+'''
+    sys.exit(1)
+
+
+def build(shape, n, width):
+    import qtask
+
+    @qtask.task(walltime='0:10:00', mem='1G')
+    def bench_task(i):
+        return 'echo %s' % i
+
+    tasks = []
+    if shape == 'chain':
+        last = None
+        for i in xrange(n):
+            last = bench_task(i).deps(last)
+            tasks.append(last)
+
+    elif shape == 'fanout':
+        root = bench_task(0)
+        tasks.append(root)
+        for i in xrange(1, n):
+            tasks.append(bench_task(i).deps(root))
+
+    elif shape == 'dense':
+        layer = []
+        for i in xrange(0, n, width):
+            layer = [bench_task(j).deps(*layer) for j in xrange(i, min(i + width, n))]
+            tasks.extend(layer)
+
+    else:
+        raise ValueError('Unknown shape: %s' % shape)
+
+    return tasks
+
+
+def _peak_mb():
+    # (KB on Linux)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def child(case):
+    'runs one case (in this process), returns the results'
+    sys.path.insert(0, ROOT)
+    import qtask
+
+    if case['kind'] == 'mqsub':
+        infiles = []
+        for i in xrange(case['n']):
+            fname = os.path.join(case['tmpdir'], 'input%s.txt' % i)
+            open(fname, 'w').close()
+            infiles.append(fname)
+
+        argv = [MQSUB, '-wd', case['tmpdir']]
+        if case['array']:
+            argv.append('-array')
+        argv.extend(['cat', '{}', '--'] + infiles)
+
+        start = time.time()
+        sys.argv = argv
+        try:
+            execfile(MQSUB, {'__name__': '__main__', '__file__': MQSUB})
+        except SystemExit:
+            pass
+        return {'submit': time.time() - start, 'peak_mb': _peak_mb()}
+
+    if case['runner'] == 'inproc':
+        from qtask.sge import SGE
+
+        class InprocSGE(SGE):
+            'renders the job scripts, but never calls qsub'
+            def qsub(self, task, monitor, dryrun=False):
+                jobid, src = SGE.qsub(self, task, monitor, dryrun=True)
+                return jobid[7:], src
+
+            def qdel(self, *jobid):
+                pass
+
+            def qrls(self, *jobid):
+                pass
+
+        qtask.pipeline.runner = InprocSGE(concurrency=case['concurrency'])
+
+    start = time.time()
+    build(case['shape'], case['n'], case['width'])
+    built = time.time()
+    qtask.pipeline.submit()
+    return {'build': built - start, 'submit': time.time() - built, 'peak_mb': _peak_mb()}
+
+
+def run_case(case, tmpdir):
+    'runs one case in a child process (with the stub commands on the $PATH)'
+    casedir = tempfile.mkdtemp(dir=tmpdir)
+    env = fakesched.make_stubs(casedir)
+    env['QTASK_RUNNER'] = 'sge'
+    env['QTASK_RUNNER_CONCURRENCY'] = str(case.get('concurrency', 1))
+    if case.get('monitor'):
+        env['QTASK_MONITOR'] = 'sqlite://%s' % os.path.join(casedir, 'bench.db')
+
+    case = dict(case)
+    case['tmpdir'] = casedir
+    out = os.path.join(casedir, 'result.json')
+    with open('/dev/null', 'w') as devnull:
+        retval = subprocess.call([sys.executable, os.path.realpath(__file__), '-child', json.dumps(case), out], stdout=devnull, env=env, cwd=casedir)
+
+    if retval != 0 or not os.path.exists(out):
+        raise RuntimeError('Benchmark failed: %s' % case)
+
+    with open(out) as f:
+        result = json.load(f)
+
+    result['calls'] = fakesched.call_counts(casedir)
+    shutil.rmtree(casedir)
+    return result
+
+
+def report(case, result):
+    if case['kind'] == 'mqsub':
+        name = 'mqsub%s n=%s' % (' -array' if case['array'] else '', case['n'])
+    else:
+        name = '%s n=%s runner=%s' % (case['shape'], case['n'], case['runner'])
+        if case['shape'] == 'dense':
+            name += ' width=%s' % case['width']
+        if case['concurrency'] > 1:
+            name += ' concurrency=%s' % case['concurrency']
+        if case['monitor']:
+            name += ' monitor'
+
+    line = '%-50s submit %8.3f sec (%8.1f tasks/sec)' % (name, result['submit'], case['n'] / max(result['submit'], 1e-6))
+    if 'build' in result:
+        line += ', build %.3f sec' % result['build']
+    line += ', peak %.1f MB' % result['peak_mb']
+    if result['calls'].get('qsub'):
+        line += ', %s qsub' % result['calls']['qsub']
+    sys.stdout.write('%s\n' % line)
+    sys.stdout.flush()
+
+
+def bench(shapes=['chain', 'fanout', 'dense'], sizes=[1000, 10000], width=100, runners=['inproc', 'stub'], concurrency=1, monitor=False, mqsub_sizes=[], array=False):
+    'runs each case, returns a list of {case, result} dicts'
+    results = []
+    cases = []
+    for runner in runners:
+        for shape in shapes:
+            for n in sizes:
+                cases.append({'kind': 'dag', 'shape': shape, 'n': n, 'width': width, 'runner': runner, 'concurrency': concurrency, 'monitor': monitor})
+    for n in mqsub_sizes:
+        cases.append({'kind': 'mqsub', 'n': n, 'array': array, 'monitor': monitor})
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for case in cases:
+            result = run_case(case, tmpdir)
+            report(case, result)
+            results.append({'case': case, 'result': result})
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return results
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4 and sys.argv[1] == '-child':
+        # (mqsub cases replace sys.argv)
+        case, out = json.loads(sys.argv[2]), sys.argv[3]
+        result = child(case)
+        with open(out, 'w') as f:
+            json.dump(result, f)
+        sys.exit(0)
+
+    opts = {}
+    json_out = None
+
+    last = None
+    for arg in sys.argv[1:]:
+        if last == '-shape':
+            opts['shapes'] = arg.split(',')
+        elif last == '-n':
+            opts['sizes'] = [int(x) for x in arg.split(',')]
+        elif last == '-width':
+            opts['width'] = int(arg)
+        elif last == '-runner':
+            opts['runners'] = arg.split(',')
+        elif last == '-concurrency':
+            opts['concurrency'] = int(arg)
+        elif last == '-mqsub':
+            opts['mqsub_sizes'] = [int(x) for x in arg.split(',')]
+        elif last == '-json':
+            json_out = arg
+        elif arg == '-monitor':
+            opts['monitor'] = True
+        elif arg == '-array':
+            opts['array'] = True
+        elif arg in ['-shape', '-n', '-width', '-runner', '-concurrency', '-mqsub', '-json']:
+            last = arg
+            continue
+        else:
+            usage()
+        last = None
+
+    results = bench(**opts)
+
+    if json_out:
+        with open(json_out, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write('\n')
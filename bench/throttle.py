@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+'''
+Throttled submission check (max_queued)
+
+Submits a long chain of tasks (each depending on the one before it) with the
+PBS runner and stub commands (see schedulers.py), with max_queued set, so that
+most of the chain is saved for qtask-throttle. The saved state is then loaded
+and the rest of the chain is submitted (in this process, instead of in the
+background). Checks that every task was submitted, and that each job script
+depends on the job before it. Fails (exit code 1) if any check doesn't pass.
+'''
+import os
+import sys
+import json
+import shutil
+import tempfile
+import subprocess
+
+import fakesched
+
+ROOT = fakesched.ROOT
+
+
+def usage():
+    print __doc__
+    print '''Usage: throttle.py {-n tasks} {-max-queued N} {-v}
+
+Options:
+  -n tasks        Length of the chain (default: 3000)
+  -max-queued N   max_queued (default: 10)
+  -v              Show the output of the submission
+'''
+    sys.exit(1)
+
+
+def child(num, max_queued):
+    '''
+    submits the chain (in this process), then the deferred tasks, returns the
+    job ids (in chain order)
+    '''
+    sys.path.insert(0, ROOT)
+    import qtask
+    import qtask.throttle
+
+    # (started below, instead of in the background)
+    qtask.QTASK_THROTTLE = 'true'
+    qtask.pipeline.config['max_queued'] = str(max_queued)
+
+    @qtask.task(walltime='0:10:00')
+    def step(i):
+        return 'echo %s' % i
+
+    last = None
+    tasks = []
+    for i in xrange(num):
+        t = step(i)
+        if last:
+            t.deps(last)
+        tasks.append(t)
+        last = t
+
+    qtask.pipeline.submit()
+    jobids = [t.jobid for t in tasks if t.jobid]
+    if len(jobids) != max_queued:
+        raise RuntimeError('%s jobs submitted before qtask-throttle (expected: %s)' % (len(jobids), max_queued))
+
+    path = qtask.throttle.state_dir(qtask.pipeline.config)
+    states = [x for x in os.listdir(path) if x[-6:] == '.state']
+    throttle = qtask.throttle.Throttle(os.path.join(path, states[0]))
+    throttle.replay()
+    throttle.setup()
+    # (nothing is running, each job counts as active until the next check)
+    throttle.submit_more(0, {}, num)
+
+    return jobids + [t.jobid for t in throttle.tasks]
+
+
+def run_checks(num, max_queued, tmpdir, verbose=False):
+    'submits the chain in a child process (with the stub commands), returns the failed checks'
+    casedir = tempfile.mkdtemp(dir=tmpdir)
+    env = fakesched.make_stubs(casedir, scripts=True)
+    env['QTASK_RUNNER'] = 'pbs'
+    env['QTASK_THROTTLE_DIR'] = os.path.join(casedir, 'throttle')
+
+    out = os.path.join(casedir, 'jobids.json')
+    with open('/dev/null', 'w') as devnull:
+        retval = subprocess.call([sys.executable, os.path.realpath(__file__), '-child', str(num), str(max_queued), out], stdout=None if verbose else devnull, stderr=None if verbose else devnull, env=env, cwd=casedir)
+    if retval != 0 or not os.path.exists(out):
+        return ['submit failed (%s)' % retval]
+
+    with open(out) as f:
+        jobids = json.load(f)
+
+    failed = []
+    if len(jobids) != num or None in jobids:
+        failed.append('%s of %s tasks submitted' % (len([x for x in jobids if x]), num))
+    else:
+        for i in xrange(1, num):
+            line = '#PBS -W depend=afterok:%s' % jobids[i - 1]
+            if line not in fakesched.script(casedir, jobids[i]).split('\n'):
+                failed.append('step%s script is missing: %s' % (i, line))
+                break
+
+    shutil.rmtree(casedir)
+    return failed
+
+
+def bench(num=3000, max_queued=10, verbose=False):
+    'runs the checks, returns True if they all passed'
+    tmpdir = tempfile.mkdtemp()
+    try:
+        failed = run_checks(num, max_queued, tmpdir, verbose)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    for msg in failed:
+        sys.stdout.write('FAIL: %s\n' % msg)
+    sys.stdout.write('chain of %s (max_queued %s): %s\n' % (num, max_queued, 'failed' if failed else 'ok'))
+    return not failed
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 5 and sys.argv[1] == '-child':
+        jobids = child(int(sys.argv[2]), int(sys.argv[3]))
+        with open(sys.argv[4], 'w') as f:
+            json.dump(jobids, f)
+        sys.exit(0)
+
+    opts = {}
+
+    last = None
+    for arg in sys.argv[1:]:
+        if last == '-n':
+            opts['num'] = int(arg)
+            last = None
+        elif last == '-max-queued':
+            opts['max_queued'] = int(arg)
+            last = None
+        elif arg in ['-n', '-max-queued']:
+            last = arg
+        elif arg == '-v':
+            opts['verbose'] = True
+        else:
+            usage()
+
+    if not bench(**opts):
+        sys.exit(1)
@@ -47,12 +47,12 @@ hostname
 
     return cmd
 
-@task()
+@task(fuse=True)
 def task3(arg):
     cmd = 'echo "%s, %s"' % (arg, arg)
     return cmd
 
-@task()
+@task(fuse=True)
 def task4(arg):
     return str(arg)
 
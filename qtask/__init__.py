@@ -1,12 +1,35 @@
 import os
 import sys
 import qtask.monitor as monitor
+import qtask.profiler as profiler
 import re
-import subprocess
 import datetime
+import collections
+import itertools
+import contextlib
+import hashlib
+import random
+import math
+import time
+import string
 
 # QTASK_MON = os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "bin", "qtask-mon"))
 QTASK_MON = "qtask-mon"  # rely on the $PATH
+QTASK_RUSAGE = "qtask-rusage"
+QTASK_THROTTLE = "qtask-throttle"
+
+
+def _measured(task, func, rusage):
+    '''
+    Shell code that runs a function (in its own bash process) with qtask-rusage,
+    which writes its peak memory, CPU time and I/O to the file "rusage" (passed
+    to "qtask-mon stop"). Tasks that aren't measured (see task.measured) just
+    call the function. Redirects can be appended.
+    '''
+    if not task.measured:
+        return func
+    return 'export -f %s\n"%s" "%s" /bin/bash -o pipefail -c %s' % (func, QTASK_RUSAGE, rusage, func)
+
 
 class QTask(object):
     '''\
@@ -25,20 +48,33 @@ Valid job resource/arguments (examples, not defaults):
     ppn         processors per node (pe shm)
     env         Use current environment (default: True)
     account     The account to set (usually for resource billing)
+    tc          max number of concurrently running tasks (array jobs only)
+    inputs      input file(s) for the task (used for incremental re-runs)
+    outputs     output file(s) for the task (used for incremental re-runs)
+    fuse        run in the same job as its parent/child tasks (if they can be)
+    autosize    set walltime/mem from past runs (true, walltime, or mem)
+    priority    scheduler priority (SGE/PBS -p, Slurm --nice)
 
 Note: These values are all job-scheduler dependent
 '''
 
-    def __init__(self, cmd, name=None, resources=None, skip=False):
+    def __init__(self, cmd, name=None, resources=None, skip=False, array=None):
         self.name = name
         self.cmd = cmd
         self.skip = skip
+        self.array = array  # input values for an array job ($QTASK_INPUT)
+        self.array_index = None
         self.resources = {'env': True, 'wd': os.path.abspath(os.curdir), 'force_first': False, 'mail': 'ea'}
         if resources:
             for k in resources:
                 self.resources[k] = resources[k]
 
         self.jobid = None
+        self.task_hash = None
+        self.fused = None  # tasks run by this job (if fused)
+        self.measured = False  # run with qtask-rusage (for autosize)
+        self.token = None  # added to the job name, to find the job if qsub may have failed
+        self.barrier = False
         self.runner = None
         self.basename = None
         self.depends = []
@@ -86,6 +122,188 @@ class _QTaskDirectWrapper(object):
         self.jobid = str(jobid)
 
 
+class _TaskGraph(object):
+    '''
+    Dependency graph for the tasks in a pipeline. Tasks are released (in their
+    original order) as soon as all of their dependencies are done. Building the
+    graph and walking it is O(tasks + dependencies).
+
+    Dependencies on tasks that aren't part of this pipeline (direct job ids or
+    tasks submitted previously) are treated as already satisfied.
+    '''
+    def __init__(self, tasks):
+        self.tasks = tasks
+        self.ready = collections.deque()
+        self._pending = {}
+        self._children = {}
+
+        members = set(tasks)
+        for t in tasks:
+            count = 0
+            for d in t.depends:
+                if d in members:
+                    count += 1
+                    if d in self._children:
+                        self._children[d].append(t)
+                    else:
+                        self._children[d] = [t]
+            self._pending[t] = count
+
+        for t in tasks:
+            if not self._pending[t]:
+                self.ready.append(t)
+
+    def done(self, task):
+        'mark a task as done, queueing any children that are now clear to run'
+        for child in self._children.pop(task, []):
+            self._pending[child] -= 1
+            if not self._pending[child]:
+                self.ready.append(child)
+        del self._pending[task]
+
+    def check(self):
+        'raise an error if any tasks could never be released (a dependency cycle)'
+        if self._pending:
+            self._cycle_error(self._pending)
+
+    def verify(self):
+        'check for dependency cycles up front (without releasing any tasks)'
+        pending = dict(self._pending)
+        queue = list(self.ready)
+        while queue:
+            t = queue.pop()
+            for child in self._children.get(t, []):
+                pending[child] -= 1
+                if not pending[child]:
+                    queue.append(child)
+
+        stuck = set([t for t in pending if pending[t]])
+        if stuck:
+            self._cycle_error(stuck)
+
+    def _cycle_error(self, stuck):
+        # follow unfinished dependencies until we revisit a task
+        path = []
+        seen = {}
+        t = [x for x in self.tasks if x in stuck][0]
+        while t not in seen:
+            seen[t] = len(path)
+            path.append(t)
+            for d in t.depends:
+                if d in stuck:
+                    t = d
+                    break
+
+        cycle = list(reversed(path[seen[t]:]))
+        names = [str(x.fullname) for x in cycle]
+        if len(set(names)) < len(names):
+            # (tasks from the same function need their position to tell them apart)
+            pos = dict([(x, i) for i, x in enumerate(self.tasks)])
+            names = ['%s (task %s)' % (n, pos[x] + 1) for n, x in zip(names, cycle)]
+
+        raise RuntimeError('Dependency cycle detected: %s (and back to %s)' % (' -> '.join(names), names[0]))
+
+    def walk(self):
+        'returns all of the tasks in dependency order'
+        order = []
+        while self.ready:
+            t = self.ready.popleft()
+            order.append(t)
+            self.done(t)
+        self.check()
+        return order
+
+
+def _file_list(val):
+    if not val:
+        return []
+    if type(val) == str:
+        return [val]
+    return list(val)
+
+
+def _task_hash(task, dep_hashes, generated):
+    '''
+    Content hash for a task: the command, resources, input/output file names,
+    the size/mtime of input files (that aren't made by another task), and the
+    hashes of the tasks it depends on. If anything upstream changes, so does
+    the hash.
+    '''
+    h = hashlib.sha1()
+    h.update(repr((task.fullname, task.cmd)))
+    for k in sorted(task.resources):
+        if k not in ['holding', 'force_first', 'inputs', 'outputs', 'fuse']:
+            h.update(repr((k, task.resources[k])))
+
+    for fname in _file_list(task.resources.get('inputs')):
+        fname = os.path.abspath(os.path.join(task.resources['wd'], fname))
+        if fname in generated or not os.path.exists(fname):
+            h.update(repr(('input', fname)))
+        else:
+            st = os.stat(fname)
+            h.update(repr(('input', fname, st.st_size, int(st.st_mtime))))
+
+    for fname in _file_list(task.resources.get('outputs')):
+        h.update(repr(('output', os.path.abspath(os.path.join(task.resources['wd'], fname)))))
+
+    for dep_hash in sorted(dep_hashes):
+        h.update(dep_hash)
+
+    return h.hexdigest()
+
+
+class _SubmitPool(object):
+    '''
+    Pool of worker threads that submit tasks (by calling qsub(task)). Results
+    are returned as (task, jobid, src, exception) tuples in the order they
+    finish.
+    '''
+    def __init__(self, qsub, size):
+        # imported here so that "import qtask" stays light
+        import threading
+        import Queue
+
+        self.qsub = qsub
+        self._in = Queue.Queue()
+        self._out = Queue.Queue()
+        self._empty = Queue.Empty
+        self._threads = []
+        for i in xrange(size):
+            thread = threading.Thread(target=self._worker)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _worker(self):
+        while True:
+            task = self._in.get()
+            if task is None:
+                return
+            try:
+                jobid, src = self.qsub(task)
+                self._out.put((task, jobid, src, None))
+            except Exception, e:
+                self._out.put((task, None, None, e))
+
+    def put(self, task):
+        self._in.put(task)
+
+    def get(self):
+        while True:
+            try:
+                # a timeout keeps the main thread responsive to Ctrl-C
+                return self._out.get(True, 1)
+            except self._empty:
+                pass
+
+    def close(self):
+        for thread in self._threads:
+            self._in.put(None)
+        # (daemon threads that are still running at exit print errors)
+        for thread in self._threads:
+            thread.join()
+
+
 class QTaskList(object):
     def __init__(self, tasks):
         self.tasks = tasks
@@ -97,11 +315,8 @@ class QTaskList(object):
         return True
 
     def deps(self, *deps):
-        for d in deps:
-            if d and not d.skip:
-                for t in self.tasks:
-                    t.depends.append(d)
-                    d.children.append(t)
+        for t in self.tasks:
+            t.deps(*deps)
         return self
 
 def task(**task_args):
@@ -148,34 +363,299 @@ def task(**task_args):
     return wrap
 
 
+def var_repl(arg, val):
+    '''
+    Replace a "{}" style argument with a value. "{%}" uses the basename of the
+    value and "{^.txt}" strips everything from the last ".txt".
+    '''
+    m = re.match('^(.*){(.*)}(.*)$', arg)
+    if m:
+        if m.group(2):
+            middle = m.group(2)
+            if middle[0] == '%':
+                val = os.path.basename(val)
+                middle = middle[1:]
+            if middle and middle[0] == '^':
+                repl = val[:val.rfind(middle[1:])]
+                return '%s%s%s' % (m.group(1), repl, m.group(3))
+        return '%s%s%s' % (m.group(1), val, m.group(3))
+    else:
+        return arg
+
+
+def var_repl_shell(arg):
+    '''
+    Same as var_repl, but the replacement is a bash expression that is resolved
+    at run time from $QTASK_INPUT (used for array jobs).
+    '''
+    m = re.match('^(.*){(.*)}(.*)$', arg)
+    if m:
+        var = 'QTASK_INPUT'
+        middle = m.group(2)
+        if middle and middle[0] == '%':
+            var = 'QTASK_INPUT_BASE'
+            middle = middle[1:]
+        if middle and middle[0] == '^':
+            suffix = re.sub(r'([\\"$`])', r'\\\1', middle[1:])
+            return '%s${%s%%"%s"*}%s' % (m.group(1), var, suffix, m.group(3))
+        return '%s${%s}%s' % (m.group(1), var, m.group(3))
+    else:
+        return arg
+
+
+def _dep_key(d):
+    'direct job ids are different objects, so they are compared by id'
+    if isinstance(d, QTask):
+        return d
+    return d.jobid
+
+
+def _submit_token():
+    'a random token for one submission (see JobRunner.job_name)'
+    return '%08x' % random.getrandbits(32)
+
+
+def _fusable(a, b):
+    'can these two tasks run in the same job?'
+    for k in ['wd', 'env', 'queue', 'qos', 'account', 'mail', 'stack']:
+        if a.resources.get(k) != b.resources.get(k):
+            return False
+    return a.basename == b.basename
+
+
+def _mem_bytes(val):
+    'converts a memory value (10M, 4G, etc) to bytes'
+    val = str(val).strip().upper()
+    if val[-1:] == 'B':
+        val = val[:-1]
+
+    mult = 1
+    for i, suffix in enumerate('KMGT'):
+        if val[-1:] == suffix:
+            mult = 1024 ** (i + 1)
+            val = val[:-1]
+            break
+
+    return int(float(val) * mult)
+
+
+def _walltime_seconds(val):
+    'converts a walltime (HH:MM:SS, MM:SS or seconds) to seconds'
+    cols = [int(x) for x in str(val).split(':')]
+    secs = 0
+    for col in cols:
+        secs = secs * 60 + col
+    return secs
+
+
+def _walltime_str(secs):
+    return '%d:%02d:%02d' % (secs / 3600, (secs % 3600) / 60, secs % 60)
+
+
+# run time for tasks without a walltime or history (see _critical_path)
+_DEFAULT_SECS = 60 * 60
+
+# smallest values that _autosize() will set
+_AUTOSIZE_MIN_SECS = 5 * 60
+_AUTOSIZE_MIN_MEM = 64 * 1024 * 1024
+
+
+def _percentile(vals, pct):
+    'nearest rank'
+    vals = sorted(vals)
+    return vals[max(0, int(math.ceil(pct / 100.0 * len(vals))) - 1)]
+
+
+def _config_bool(val):
+    if not val:
+        return False
+    if type(val) == str:
+        return val.strip().lower() not in ['0', 'false', 'no', 'n', 'f']
+    return True
+
+
+def _profiling():
+    'returns the submission profiler, started if "profile" is set in the config ($QTASK_PROFILE)'
+    if not profiler.current() and _config_bool(pipeline.config.get('profile')):
+        profiler.start()
+    return profiler.current()
+
+
 __path_cache = set()
 def check_path(prog):
     if prog in __path_cache:
         return True
 
+    import subprocess
+    prof = _profiling()
+    start = time.time()
     with open('/dev/null', 'w') as devnull:
-        if subprocess.call("which %s" % prog, stderr=devnull, stdout=devnull, shell=True) != 0:
-            raise RuntimeError("Missing required program from $PATH: %s\n\n" % prog)
+        retval = subprocess.call("which %s" % prog, stderr=devnull, stdout=devnull, shell=True)
+    if prof:
+        prof.record('check_path', time.time() - start)
+    if retval != 0:
+        raise RuntimeError("Missing required program from $PATH: %s\n\n" % prog)
 
     __path_cache.add(prog)
     return True
 
 
 class JobRunner(object):
-    def __init__(self, multiplier=1.0):
+    supports_array = False
+    concurrency = 1
+    retries = 0
+    jobid_var = None  # shell variable with the job id (needed to fuse tasks)
+    qdel_deps = False  # failed jobs remove their successors with "qtask-mon qdeldeps"
+    priority_range = None  # (least, most urgent) values for the "priority" resource
+    job_prefix = 'job_'  # for job names that don't start with a letter
+    virtual_mem = False  # the "mem" resource limits virtual memory (not the RSS)
+
+    def __init__(self, multiplier=1.0, concurrency=1, retries=0, status_ttl=60, priority_range=None):
         self.multiplier = float(multiplier)
+        self.concurrency = int(concurrency)
+        self.retries = int(retries)
+        self.status_ttl = float(status_ttl)
+        if priority_range:
+            # runner.priority_range = least,most (ex: -100,0)
+            self.priority_range = tuple([int(x) for x in str(priority_range).split(',')])
+        self._states = None
+
+    def _batches(self, jobids, max_len=65536):
+        'splits job ids into groups that are short enough for one command line'
+        batch = []
+        size = 0
+        for jobid in jobids:
+            jobid = str(jobid)
+            if batch and size + len(jobid) + 1 > max_len:
+                yield batch
+                batch = []
+                size = 0
+            batch.append(jobid)
+            size += len(jobid) + 1
+        if batch:
+            yield batch
 
     def done(self):
+        '''
+        called once the pipeline has been submitted. Runners that run the jobs
+        themselves return False if any of them failed.
+        '''
         pass
 
+    def job_name(self, task):
+        '''
+        the name a task is submitted with (scheduler job names have to start
+        with a letter), ending with its token, if it has one
+        '''
+        name = task.fullname
+        if name[0] not in string.ascii_letters:
+            name = '%s%s' % (self.job_prefix, name)
+        if task.token:
+            name = '%s.%s' % (name, task.token)
+        return name
+
+    def lists_jobs(self):
+        'True if the runner can list its jobs (job_states)'
+        return type(self).job_states.im_func is not JobRunner.job_states.im_func
+
+    def find_jobs(self, name):
+        'returns the job ids of the current jobs with this name (asks the scheduler)'
+        states = self.job_states()
+        found = []
+        for key in states:
+            jobid = self.monitor_jobid(key)
+            if states[key].get('name') == name and jobid not in found:
+                found.append(jobid)
+        return found
+
+    def monitor_jobid(self, row):
+        'returns the job id for a monitor row (array and fused tasks are recorded as jobid.N)'
+        base, sep, idx = row.rpartition('.')
+        if sep and idx.isdigit():
+            return base
+        return row
+
     def qdel(self, *jobid):
         raise NotImplementedError
 
     def qrls(self, *jobid):
         raise NotImplementedError
 
+    def job_states(self):
+        '''
+        Asks the scheduler (with one call) for all of the current user's jobs.
+        Returns a dict: jobid -> {'state': state, 'name': job name}, where
+        state is one of: pending, held, running, suspended, error, or done (if
+        the scheduler still lists finished jobs, along with their
+        'exit_status').
+
+        Job ids match the monitor rows: array tasks are listed as jobid.N (and
+        the array job itself isn't listed).
+        '''
+        raise NotImplementedError
+
+    def job_accounting(self, jobids, since=None):
+        '''
+        Looks up finished jobs in the scheduler's accounting records (jobs
+        started after "since"). Returns a dict: jobid -> {'state': 'done',
+        'exit_status': N, ...} for the jobs that were found.
+        '''
+        return {}
+
+    def cached_job_states(self, ttl=None):
+        '''
+        job_states(), called at most once every "ttl" seconds (default:
+        runner.status_ttl). The result is shared with other processes for the
+        same user and runner (through a file in $TMPDIR), so that any number of
+        watchers only cost one scheduler call per interval.
+
+        Returns a tuple: (time the states were read, states)
+        '''
+        if ttl is None:
+            ttl = self.status_ttl
+
+        now = time.time()
+        if self._states and now - self._states[0] < ttl:
+            return self._states
+
+        import json
+        import getpass
+        import tempfile
+
+        path = os.path.join(tempfile.gettempdir(), 'qtask-status.%s.%s.json' % (getpass.getuser(), self.__class__.__name__.lower()))
+        try:
+            with open(path) as f:
+                cached = json.load(f)
+            if now - cached['ts'] < ttl:
+                self._states = (cached['ts'], cached['states'])
+                return self._states
+        except (IOError, ValueError, KeyError):
+            pass
+
+        # (timestamp from before the call, so jobs submitted while it runs are newer)
+        ts = time.time()
+        states = self.job_states()
+        self._states = (ts, states)
+
+        tmp = '%s.%s' % (path, os.getpid())
+        try:
+            with open(tmp, 'w') as f:
+                json.dump({'ts': ts, 'states': states}, f)
+            os.rename(tmp, path)
+        except (IOError, OSError):
+            pass
+
+        return self._states
+
     def qsub(self, task, monitor, dryrun=False):
-        'return a tuple: (jobid, script_src)'
+        '''
+        return a tuple: (jobid, script_src)
+
+        If task.array is set (and the runner supports arrays), a single array
+        job is submitted with one task per value. Each task should read its
+        value from line N of task.array_index into $QTASK_INPUT (and its
+        basename into $QTASK_INPUT_BASE).
+        '''
         raise NotImplementedError
 
     def _calc_time(self, val):
@@ -219,9 +699,11 @@ class BashRunner(JobRunner):
                 self.script += 'func_%s () {\n%s\nreturn $?\n}\n' % (jobid, task.cmd)
 
                 self.script += '"%s" "%s" start %s\n' % (QTASK_MON, monitor, jobid)
-                self.script += 'func_%s 2>"%s/%s.qtask.stderr" >"/tmp/%s.qtask.stdout"\n' % (jobid, self.tmpdir, jobid, jobid)
+                self.script += '%s 2>"%s/%s.qtask.stderr" >"/tmp/%s.qtask.stdout"\n' % (_measured(task, 'func_%s' % jobid, '%s/%s.qtask.rusage' % (self.tmpdir, jobid)), self.tmpdir, jobid, jobid)
                 self.script += 'RETVAL=$?\n'
-                self.script += '"%s" "%s" stop %s $RETVAL "%s/%s.qtask.stdout" "%s/%s.qtask.stderr"\n' % (QTASK_MON, monitor, jobid, self.tmpdir, jobid, self.tmpdir, jobid)
+                self.script += '"%s" "%s" stop %s $RETVAL "%s/%s.qtask.stdout" "%s/%s.qtask.stderr" "%s/%s.qtask.rusage"\n' % (QTASK_MON, monitor, jobid, self.tmpdir, jobid, self.tmpdir, jobid, self.tmpdir, jobid)
+                if task.measured:
+                    self.script += 'rm -f "%s/%s.qtask.rusage"\n' % (self.tmpdir, jobid)
 
                 if 'stdout' in task.resources:
                     self.script += 'mv "%s/%s.qtask.stdout" "%s"\n' % (self.tmpdir, jobid, task.resources['stdout'])
@@ -240,16 +722,21 @@ class BashRunner(JobRunner):
         self._jobid += 1
         return jobid, ''
 
-    def qdel(self, jobid):
+    def qdel(self, *jobid):
         pass
 
-    def qrls(self, jobid):
+    def qrls(self, *jobid):
         pass
 
     def done(self):
         print self.script
 
 
+@contextlib.contextmanager
+def _no_phase(name):
+    yield
+
+
 @task(holding=True, force_first=True, walltime="00:00:10", mem='10M')
 def holding():
     return '/bin/true'
@@ -267,17 +754,18 @@ class __Pipeline(object):
             with open(os.path.expanduser('~/.qtaskrc')) as f:
                 for line in f:
                     k,v = line.strip().split('=')
-                    if k[:7].lower() == 'runner.':
-                        runnerconf[k[7:].lower().strip()] = v.strip()
-                    self.config[k.lower()] = v.strip()
+                    k = k.strip().lower()
+                    if k[:7] == 'runner.':
+                        runnerconf[k[7:]] = v.strip()
+                    self.config[k] = v.strip()
 
         # if 'QTASK_RUNNER' in os.environ:
         #     self.config['runner'] = os.environ['QTASK_RUNNER']
 
         for env in os.environ:
             if env[:6] == 'QTASK_':
-                if env[:12] == 'QTASK_RUNNER_':
-                    runnerconf[env[12:].lower()] = os.environ[env]
+                if env[:13] == 'QTASK_RUNNER_':
+                    runnerconf[env[13:].lower()] = os.environ[env]
                 else:
                     self.config[env[6:].lower()] = os.environ[env]
 
@@ -290,16 +778,34 @@ class __Pipeline(object):
             for k in runnerconf:
                 sys.stderr.write('  %s => %s\n' % (k, runnerconf[k]))
 
-        if self.config['runner'] == 'sge':
-            from sge import SGE
-            self.runner = SGE(**runnerconf)
-        elif self.config['runner'] == 'pbs':
-            from pbs import PBS
-            self.runner = PBS(**runnerconf)
-        elif self.config['runner'] == 'bash':
-            self.runner = BashRunner(**runnerconf)
-        else:
-            raise RuntimeError("Unknown runner: %s (valid: sge, pbs, bash)" % self.config['qtype'])
+        self.runnerconf = runnerconf
+        self._runner = None
+
+    @property
+    def runner(self):
+        # the runner is only loaded when it is needed
+        if not self._runner:
+            if self.config['runner'] == 'sge':
+                from sge import SGE
+                self._runner = SGE(**self.runnerconf)
+            elif self.config['runner'] == 'pbs':
+                from pbs import PBS
+                self._runner = PBS(**self.runnerconf)
+            elif self.config['runner'] == 'slurm':
+                from slurm import Slurm
+                self._runner = Slurm(**self.runnerconf)
+            elif self.config['runner'] == 'local':
+                from local import LocalRunner
+                self._runner = LocalRunner(**self.runnerconf)
+            elif self.config['runner'] == 'bash':
+                self._runner = BashRunner(**self.runnerconf)
+            else:
+                raise RuntimeError("Unknown runner: %s (valid: sge, pbs, slurm, local, bash)" % self.config['runner'])
+        return self._runner
+
+    @runner.setter
+    def runner(self, val):
+        self._runner = val
 
     def _reset(self):
         self.tasks = []
@@ -308,6 +814,9 @@ class __Pipeline(object):
         self.sample = ''
         self.himem = False
         self._submitted_tasks = set()
+        self._submit_order = []
+        self._completed = set()
+        self._array_seq = itertools.count(1)
         self.global_depends = []
         self.run_code = '%s.%s' % (datetime.datetime.utcnow().strftime('%Y%m%d-%H%M%S.%f'), os.getpid())
 
@@ -357,59 +866,132 @@ class __Pipeline(object):
             self.tasks.append(task)
 
 
-    def submit(self, verbose=False, dryrun=False):
+    def submit(self, verbose=False, dryrun=False, incremental=None, force=None, rerun_from=None, profile=None):
+        '''
+        Submit all of the tasks in the pipeline.
+
+        incremental - skip tasks that have already finished successfully (as
+                      recorded by the monitor), if their content hash hasn't
+                      changed (see QTask inputs/outputs)
+        force       - re-run everything, even in incremental mode
+        rerun_from  - task name(s) that (along with everything that depends
+                      on them) should be re-run, even in incremental mode
+
+        These default to the "incremental", "force" and "from" config values
+        (~/.qtaskrc or $QTASK_INCREMENTAL, etc). In dry-run mode, the tasks
+        that would be skipped are listed.
+
+        profile     - time each part of the submission (see qtask.profiler),
+                      default: the "profile" config value ($QTASK_PROFILE)
+        '''
+        if profile or (profile is None and _config_bool(self.config.get('profile'))):
+            prof = profiler.start()
+        else:
+            # (it may have been started by check_path)
+            profiler.stop()
+            prof = None
+
+        if incremental is None:
+            incremental = _config_bool(self.config.get('incremental'))
+        if force is None:
+            force = _config_bool(self.config.get('force'))
+        if rerun_from is None and self.config.get('from'):
+            rerun_from = self.config['from'].split(',')
+
+        phase = prof.phase if prof else _no_phase
+
+        measured = self._set_measured()
+
         mon = None
         if not dryrun and self.config['monitor']:
-            mon = monitor.load_monitor(self.config['monitor'])
-            check_path(QTASK_MON)
+            with phase('monitor.open'):
+                mon = monitor.load_monitor(self.config['monitor'])
+                check_path(QTASK_MON)
+                if measured:
+                    check_path(QTASK_RUSAGE)
+
+        if incremental:
+            with phase('skip_completed'):
+                self._skip_completed(mon, force, rerun_from)
+        elif mon:
+            # (recorded, so that a later incremental run can skip these tasks)
+            with phase('task_hash'):
+                self._set_task_hashes()
+
+        if self.config.get('autosize') or [t for t in self.tasks if t.resources.get('autosize')]:
+            with phase('autosize'):
+                self._autosize(mon)
+
+        if self.runner.jobid_var:
+            with phase('fuse'):
+                self._fuse_tasks()
+
+        with phase('barriers'):
+            self._add_barriers()
+
+        if self.runner.priority_range and _config_bool(self.config.get('critical_path')):
+            with phase('critical_path'):
+                self._critical_path(mon)
 
         try:
-            while self.tasks:
-                for t in self.tasks:
-                    # is this an already processed job (flagged to skip)
-                    if t.skip:
-                        sys.stderr.write(' - skipped %s\n' % t.name)
-                        self._submitted_tasks.add(t)
-                        continue
-
-                    # check to see if dependencies have been submitted
-                    clear = True
-                    for d in t.depends:
-                        if d and type(d) != _QTaskDirectWrapper and d not in self._submitted_tasks:
-                            clear = False
-                            break
-                    if not clear:
-                        continue
-
-                    # submit
-
-                    if 'holding' in t.resources and t.resources['holding'] and 'force_first' in t.resources and t.resources['force_first'] and not t.children:
-                        # This is a front-loaded holding job meant to hold all the other jobs from starting
-                        # until the entire pipeline has been submitted. If there aren't any children for
-                        # this job, then there is no point in submitting it.
-
-                        t.skip = True
+            with phase('graph'):
+                graph = _TaskGraph(self.tasks)
+                # (before anything is submitted)
+                graph.verify()
+
+            if mon and self._starts_held():
+                # monitor rows can be written in batches, none of the jobs
+                # can start before they are all written
+                mon.begin_batch()
+
+            # at most this many jobs are queued at once (the rest are
+            # submitted by qtask-throttle, see qtask.throttle)
+            max_queued = int(self.config.get('max_queued') or 0) if not dryrun else 0
+            if max_queued and not self.runner.lists_jobs():
+                sys.stderr.write('WARNING: max_queued is ignored (the %s runner can\'t list its jobs)\n' % self.runner.__class__.__name__)
+                max_queued = 0
+            deferred = []
+
+            with phase('submit'):
+                if self.runner.concurrency > 1 and not dryrun and not max_queued:
+                    self._submit_concurrent(graph, mon, verbose)
+
+                queued = 0
+                while graph.ready:
+                    t = graph.ready.popleft()
+                    if max_queued and (deferred or queued >= max_queued):
+                        if not t.skip:
+                            deferred.append(t)
+                    elif self._prepare_task(t, dryrun):
+                        jobid, src = self._qsub(t, dryrun)
+                        self._task_submitted(t, jobid)
+                        self._report_task(t, src, mon, verbose, dryrun)
+                        queued += len(t.array) if t.array else 1
+
+                    graph.done(t)
+
+                graph.check()
 
-                    else:
-                        jobid, src = self.runner.qsub(t, monitor=self.config['monitor'], dryrun=dryrun)
-                        t.jobid = jobid
-                        t.runner = self.runner
-                        self._submitted_tasks.add(t)
-                        sys.stdout.write('%s\n' % jobid)
-                        if verbose:
-                            sys.stderr.write('-[%s - %s (%s)]---------------\n%s\n' % (jobid, t.name, ','.join([d.jobid for d in t.depends]), src))
-
-                        if mon and not dryrun:
-                            mon.submit(jobid, t.name, procs=t.resources['ppn'] if 'ppn' in t.resources else 1, deps=[x.jobid for x in t.depends], src=src, project=self.project, sample=self.sample, run=self.run_code)
-                
-                remaining = []
-                for t in self.tasks:
-                    if t not in self._submitted_tasks:
-                        remaining.append(t)
-                self.tasks = remaining
-            self.runner.done()
             if mon:
-                mon.close()
+                # all rows need to be written before any jobs are released
+                with phase('monitor.flush'):
+                    mon.end_batch()
+
+            with phase('runner.done'):
+                ok = self.runner.done()
+
+            if deferred:
+                import qtask.throttle
+                with phase('throttle'):
+                    state = qtask.throttle.start(self, deferred, max_queued)
+                sys.stderr.write('%s task(s) will be submitted as jobs finish (state: %s)\n' % (len(deferred), state))
+
+            if mon:
+                self._profile_monitor(prof, mon)
+                with phase('monitor.close'):
+                    mon.close()
+
+            self._finish_profile(prof)
 
             # victoire! reset pipeline and release the hounds!
             self._reset()
@@ -417,17 +999,740 @@ class __Pipeline(object):
         except Exception, e:
             print e
             # there was a problem...
-            self.abort(mon)
+            self._profile_monitor(prof, mon)
+            with phase('abort'):
+                self.abort(mon)
+            self._finish_profile(prof)
             raise e
 
+        if ok is False:
+            # (after the jobs ran, so there is nothing to abort)
+            raise RuntimeError('Some jobs failed')
+
+    def _set_measured(self):
+        '''
+        Marks the tasks that should run with qtask-rusage: every task if
+        "rusage" or "autosize" is set (the resource usage of past runs is
+        needed to size them), otherwise only the tasks with their own
+        autosize value. Returns True if any task will be measured.
+        '''
+        every = _config_bool(self.config.get('rusage')) or _config_bool(self.config.get('autosize'))
+        measured = False
+        for t in self.tasks:
+            t.measured = every or _config_bool(t.resources.get('autosize'))
+            measured = measured or t.measured
+        return measured
+
+    def _starts_held(self):
+        '''
+        True if every job waits on a held job (ex: a holding task, or mqsub
+        -holding), so nothing can run until the user releases it
+        '''
+        members = set([t for t in self.tasks if not t.skip])
+        for t in members:
+            if not t.resources.get('holding') and not [d for d in t.depends if d in members]:
+                return False
+        return True
+
+    def _profile_monitor(self, prof, mon):
+        if prof and mon:
+            prof.add_counters('monitor', mon.stats())
+
+    def _finish_profile(self, prof):
+        'writes the profile to stderr (and the "profile_json" file)'
+        if not prof:
+            return
+
+        profiler.stop()
+        prof.add_counters('pipeline', {'tasks': len(self.tasks), 'submitted': len(self._submit_order)})
+        prof.report(sys.stderr)
+        if self.config.get('profile_json'):
+            prof.write_json(self.config['profile_json'])
+
+    def _set_task_hashes(self):
+        'sets the content hash of each task (see _task_hash), returns the tasks in dependency order'
+        order = _TaskGraph(self.tasks).walk()
+
+        generated = set()
+        for t in order:
+            for fname in _file_list(t.resources.get('outputs')):
+                generated.add(os.path.abspath(os.path.join(t.resources['wd'], fname)))
+
+        for t in order:
+            t.task_hash = _task_hash(t, [d.task_hash for d in t.depends if isinstance(d, QTask) and d.task_hash], generated)
+
+        return order
+
+    def _skip_completed(self, mon=None, force=False, rerun_from=None):
+        '''
+        Marks tasks that have already finished successfully (same content hash,
+        and all outputs exist) to be skipped. Tasks that depend on a skipped
+        task will depend on its (still needed) dependencies instead.
+        '''
+        order = self._set_task_hashes()
+
+        forced = set()
+        if rerun_from:
+            queue = collections.deque([t for t in order if t.name in rerun_from or t.fullname in rerun_from])
+            while queue:
+                t = queue.popleft()
+                if t not in forced:
+                    forced.add(t)
+                    queue.extend(t.children)
+
+        if force:
+            return
+
+        close = False
+        if not mon:
+            mon = monitor.load_monitor(self.config['monitor']) if self.config['monitor'] else None
+            close = True
+        if not mon:
+            raise RuntimeError("Incremental mode requires a job monitor")
+
+        try:
+            done = mon.completed([t.task_hash for t in order])
+        except NotImplementedError:
+            raise RuntimeError("Incremental mode isn't supported by this monitor: %s" % self.config['monitor'])
+        finally:
+            if close:
+                mon.close()
+
+        members = set(order)
+        for t in order:
+            if t.skip or t in forced or t.array or t.resources.get('holding') or t.task_hash not in done:
+                continue
+
+            # anything downstream of a task that will run has to run again too
+            # (holding jobs don't do anything, and they are always submitted)
+            if [d for d in t.depends if d in members and not d.skip and not d.resources.get('holding')]:
+                continue
+
+            outputs = _file_list(t.resources.get('outputs'))
+            if [x for x in outputs if not os.path.exists(os.path.join(t.resources['wd'], x))]:
+                continue
+
+            t.skip = True
+            self._completed.add(t)
+
+        # wire the children of skipped tasks to the tasks they were waiting on
+        for t in order:
+            depends = []
+            for d in t.depends:
+                if d in self._completed:
+                    for dd in d.depends:
+                        if dd not in depends:
+                            depends.append(dd)
+                            if isinstance(dd, QTask) and t not in dd.children:
+                                dd.children.append(t)
+                elif d not in depends:
+                    depends.append(d)
+            t.depends = depends
+
+    def _autosize(self, mon=None):
+        '''
+        Sets the walltime and/or mem of tasks from the resource usage of past
+        successful jobs with the same name (as recorded by the monitor): the
+        "autosize_pct" percentile (default: 95) of their run time and peak
+        memory, plus "autosize_headroom" (default: 0.25, 25%), once there are
+        "autosize_min_runs" (default: 3) of them. Requested values are only
+        lowered, never raised.
+
+        "autosize" can be true (walltime and mem), "walltime", or "mem", and
+        can be set for each task (@task(autosize=...)) or for every task (the
+        "autosize" config value, $QTASK_AUTOSIZE).
+
+        mem isn't sized for runners whose mem limit is for virtual memory (SGE
+        h_vmem), which can be much larger than the peak RSS that is measured.
+        '''
+        sized = {}
+        warned = False
+        for t in self.tasks:
+            val = t.resources.get('autosize', self.config.get('autosize'))
+            if t.skip or not _config_bool(val):
+                continue
+            val = str(val).strip().lower()
+            sized[t] = [val] if val in ['walltime', 'mem'] else ['walltime', 'mem']
+            if self.runner.virtual_mem and 'mem' in sized[t]:
+                sized[t].remove('mem')
+                if val == 'mem' and not warned:
+                    sys.stderr.write('WARNING: mem is not autosized with the %s runner (its mem limit is for virtual memory)\n' % self.config['runner'])
+                    warned = True
+                if not sized[t]:
+                    del sized[t]
+
+        if not sized:
+            return
+
+        pct = float(self.config.get('autosize_pct', 95))
+        headroom = 1.0 + float(self.config.get('autosize_headroom', 0.25))
+        min_runs = int(self.config.get('autosize_min_runs', 3))
+
+        close = False
+        if not mon:
+            mon = monitor.load_monitor(self.config['monitor']) if self.config['monitor'] else None
+            close = True
+        if not mon:
+            raise RuntimeError("Auto-sizing requires a job monitor")
+
+        try:
+            history = mon.history(set([t.name for t in sized]))
+        except NotImplementedError:
+            raise RuntimeError("Auto-sizing isn't supported by this monitor: %s" % self.config['monitor'])
+        finally:
+            if close:
+                mon.close()
+
+        for t in sized:
+            runs = history.get(t.name, [])
+
+            if 'walltime' in sized[t]:
+                secs = [x['secs'] for x in runs if x['secs'] is not None]
+                if len(secs) >= min_runs:
+                    est = max(int(_percentile(secs, pct) * headroom), _AUTOSIZE_MIN_SECS)
+                    if 'walltime' not in t.resources or est < _walltime_seconds(t.resources['walltime']):
+                        t.resources['walltime'] = _walltime_str(est)
+
+            if 'mem' in sized[t]:
+                # (max_rss is in KB for the job, mem is per processor)
+                procs = int(t.resources.get('ppn', 1))
+                rss = [x['max_rss'] for x in runs if x['max_rss'] is not None]
+                if len(rss) >= min_runs:
+                    est = max(int(_percentile(rss, pct) * 1024 * headroom / procs), _AUTOSIZE_MIN_MEM)
+                    if 'mem' not in t.resources or est < _mem_bytes(t.resources['mem']):
+                        t.resources['mem'] = '%dM' % ((est + 1024 * 1024 - 1) / (1024 * 1024))
+
+    def _critical_path(self, mon=None):
+        '''
+        Sets the priority of each task from the length of the longest path
+        (in estimated run time) from it to the end of the pipeline, so that
+        the tasks on the critical path are started first when the queue is
+        busy. The task with the longest path gets the runner's most urgent
+        priority_range value. Tasks with a "priority" resource are left as is.
+
+        Run times are the median of past runs (from the monitor), the
+        walltime, or a default (_DEFAULT_SECS).
+        '''
+        order = _TaskGraph(self.tasks).walk()
+        members = set(order)
+
+        history = {}
+        names = set()
+        for t in order:
+            names.update([x.name for x in t.fused or [t]])
+
+        close = False
+        if not mon and self.config['monitor']:
+            mon = monitor.load_monitor(self.config['monitor'])
+            close = True
+        if mon:
+            try:
+                history = mon.history(names)
+            except NotImplementedError:
+                pass
+            finally:
+                if close:
+                    mon.close()
+
+        def est(t):
+            if t.skip:
+                return 0
+            if t.fused:
+                return sum([est(x) for x in t.fused])
+            secs = [x['secs'] for x in history.get(t.name, []) if x['secs'] is not None]
+            if secs:
+                return _percentile(secs, 50)
+            if 'walltime' in t.resources:
+                return _walltime_seconds(t.resources['walltime'])
+            return _DEFAULT_SECS
+
+        children = {}
+        for t in order:
+            for d in t.depends:
+                if d in members:
+                    children.setdefault(d, []).append(t)
+
+        # longest path to a sink, including the task itself
+        length = {}
+        for t in reversed(order):
+            length[t] = est(t) + max([length[c] for c in children.get(t, [])] or [0])
+
+        longest = max(length.values() or [0])
+        least, most = self.runner.priority_range
+        for t in order:
+            if 'priority' not in t.resources:
+                frac = float(length[t]) / longest if longest else 1.0
+                t.resources['priority'] = int(round(least + (most - least) * frac))
+
+    def _fuse_tasks(self):
+        '''
+        Fuses chains of short tasks (A -> B -> C, where each task is the only
+        thing that depends on the one before) into a single job that runs them
+        in order. Tasks can be fused if they are marked with fuse=True, or if
+        their walltime is at most "fuse_walltime" (config, HH:MM:SS), and if
+        their resources are compatible.
+        '''
+        max_secs = _walltime_seconds(self.config['fuse_walltime']) if self.config.get('fuse_walltime') else 0
+
+        def can_fuse(t):
+            if t.skip or t.array or t.fused or t.resources.get('holding') or t.resources.get('force_first'):
+                return False
+            if 'fuse' in t.resources:
+                return bool(t.resources['fuse'])
+            return max_secs and 'walltime' in t.resources and _walltime_seconds(t.resources['walltime']) <= max_secs
+
+        order = _TaskGraph(self.tasks).walk()
+        members = set(order)
+        chains = []
+        chained = set()
+        for t in order:
+            if t in chained or not can_fuse(t):
+                continue
+
+            chain = [t]
+            while True:
+                last = chain[-1]
+                children = [c for c in last.children if c in members and not c.skip]
+                if len(children) != 1:
+                    break
+                child = children[0]
+                if not can_fuse(child) or not _fusable(last, child):
+                    break
+                # other dependencies are fine if the chain already waits on them (ex: a holding job)
+                if [d for d in child.depends if d in members and d is not last and not [t for t in chain if d in t.depends]]:
+                    break
+                chain.append(child)
+
+            if len(chain) > 1:
+                chains.append(chain)
+                chained.update(chain)
+
+        if not chains:
+            return
+
+        # the task list and the neighbors' dependencies are rebuilt once,
+        # which keeps this O(tasks + dependencies)
+        fused_by = {}
+        for chain in chains:
+            fused = self._fuse_chain(chain)
+            for t in chain:
+                fused_by[t] = fused
+
+        def replace(tasks):
+            out = []
+            seen = set()
+            for t in tasks:
+                t = fused_by.get(t, t)
+                if t not in seen:
+                    seen.add(t)
+                    out.append(t)
+            return out
+
+        self.tasks = [fused_by.get(t, t) for t in self.tasks if t not in fused_by or t is fused_by[t].fused[0]]
+        for t in self.tasks:
+            t.depends = replace(t.depends)
+            t.children = [c for c in replace(t.children) if c is not t]
+
+    def _fuse_chain(self, chain):
+        'returns one task that runs a chain of tasks (and takes their place in the graph)'
+        resources = dict(chain[0].resources)
+        for k in ['fuse', 'stdout', 'stderr', 'inputs', 'outputs', 'depends']:
+            resources.pop(k, None)
+
+        for t in chain[1:]:
+            if 'ppn' in t.resources and int(t.resources['ppn']) > int(resources.get('ppn', 1)):
+                resources['ppn'] = t.resources['ppn']
+            if 'mem' in t.resources and ('mem' not in resources or _mem_bytes(t.resources['mem']) > _mem_bytes(resources['mem'])):
+                resources['mem'] = t.resources['mem']
+
+        if [t for t in chain if 'walltime' not in t.resources]:
+            resources.pop('walltime', None)
+        else:
+            resources['walltime'] = _walltime_str(sum([_walltime_seconds(t.resources['walltime']) for t in chain]))
+
+        depids = []
+        for t in chain:
+            if 'depends' in t.resources:
+                depids.extend([x for x in t.resources['depends'].split(',') if x not in depids])
+        if depids:
+            resources['depends'] = ','.join(depids)
+
+        if self.config['monitor']:
+            # output is captured for each task
+            resources['stdout'] = '/dev/null'
+            resources['stderr'] = '/dev/null'
+            # (for runner.qdel_deps, see _fused_cmd)
+            resources['monitor'] = self.config['monitor']
+
+        fused = QTask(self._fused_cmd(chain), '%s+%s' % (chain[0].name, len(chain) - 1), resources)
+        fused.basename = chain[0].basename
+        fused.fused = chain
+
+        # (the neighbors are pointed at the fused task by _fuse_tasks)
+        for t in chain:
+            for d in t.depends:
+                if d not in chain and d not in fused.depends:
+                    fused.depends.append(d)
+        fused.children = list(chain[-1].children)
+
+        return fused
+
+    def _fused_cmd(self, chain):
+        '''
+        The command for a fused job. Each task runs in its own subshell (in
+        order), and is tracked by the monitor as jobid.N. On the first failure,
+        the remaining tasks are aborted and the error is returned.
+        '''
+        monitor = self.config['monitor']
+        jobvar = self.runner.jobid_var
+        # qdeldeps also removes the successors from the scheduler
+        killdeps = 'qdeldeps' if self.runner.qdel_deps else 'killdeps'
+        cmd = ''
+        for i, t in enumerate(chain):
+            func = 'qtask_fused_%s' % (i + 1)
+            subvar = '%s.%s' % (jobvar, i + 1)
+            cmd += '%s () (\n  %s\n)\n' % (func, t.cmd)
+
+            if monitor:
+                cmd += '"%s" "%s" start %s $HOSTNAME\n' % (QTASK_MON, monitor, subvar)
+                cmd += '%s >"${TMPDIR:-/tmp}/%s.qtask.stdout" 2>"${TMPDIR:-/tmp}/%s.qtask.stderr"\n' % (_measured(t, func, '${TMPDIR:-/tmp}/%s.qtask.rusage' % subvar), subvar, subvar)
+                cmd += 'RETVAL=$?\n'
+                cmd += '"%s" "%s" stop %s $RETVAL "${TMPDIR:-/tmp}/%s.qtask.stdout" "${TMPDIR:-/tmp}/%s.qtask.stderr" "${TMPDIR:-/tmp}/%s.qtask.rusage"\n' % (QTASK_MON, monitor, subvar, subvar, subvar, subvar)
+                if t.measured:
+                    cmd += 'rm -f "${TMPDIR:-/tmp}/%s.qtask.rusage"\n' % subvar
+                for stream in ['stdout', 'stderr']:
+                    if stream in t.resources:
+                        cmd += 'mv "${TMPDIR:-/tmp}/%s.qtask.%s" "%s"\n' % (subvar, stream, t.resources[stream])
+                    else:
+                        cmd += 'rm "${TMPDIR:-/tmp}/%s.qtask.%s"\n' % (subvar, stream)
+            else:
+                cmd += func
+                if 'stdout' in t.resources:
+                    cmd += ' >"%s"' % t.resources['stdout']
+                if 'stderr' in t.resources:
+                    cmd += ' 2>"%s"' % t.resources['stderr']
+                cmd += '\n'
+                cmd += 'RETVAL=$?\n'
+
+            cmd += 'if [ $RETVAL -ne 0 ]; then\n'
+            if monitor:
+                cmd += '  "%s" "%s" %s %s\n' % (QTASK_MON, monitor, killdeps, subvar)
+                cmd += '  "%s" "%s" %s %s\n' % (QTASK_MON, monitor, killdeps, jobvar)
+            cmd += '  return $RETVAL\n'
+            cmd += 'fi\n'
+
+        return cmd
+
+    def _add_barriers(self):
+        '''
+        Reduces the number of dependencies with "barrier" jobs (that do nothing).
+
+        If a group of N tasks all depend on the same M jobs (ex: one QTaskList
+        depending on another), the group depends on a barrier that depends on
+        the M jobs (M+N dependencies instead of M*N). This is done when it
+        saves at least "barrier_edges" dependencies (config, ex: 100). Tasks
+        (or barriers) with more than "max_depends" dependencies (config, ex:
+        100) wait on a tree of barriers instead. Both are off by default.
+
+        If a job fails, kill_deps/killdeps still reach everything past the
+        barrier.
+        '''
+        min_saved = int(self.config.get('barrier_edges') or 0)
+        max_depends = int(self.config.get('max_depends') or 0)
+        if not min_saved and not max_depends:
+            return
+
+        members = set(self.tasks)
+        # barriers are added to the task list at the end (each one before the
+        # first task that needs it), keeping this O(tasks + dependencies)
+        pos = dict([(t, i) for i, t in enumerate(self.tasks)])
+        before = collections.defaultdict(list)
+
+        if min_saved:
+            groups = collections.OrderedDict()
+            for t in self.tasks:
+                if t.skip or len(t.depends) < 2:
+                    continue
+                key = frozenset([_dep_key(d) for d in t.depends])
+                if key in groups:
+                    groups[key].append(t)
+                else:
+                    groups[key] = [t]
+
+            for key in groups:
+                group = groups[key]
+                m = len(key)
+                n = len(group)
+                if n > 1 and (m * n) - (m + n) >= min_saved:
+                    self._add_barrier(group, group[0].depends, members, pos, before)
+
+        if max_depends > 1:
+            queue = collections.deque(self.tasks)
+            for i in sorted(before):
+                queue.extend(before[i])
+            while queue:
+                t = queue.popleft()
+                if len(t.depends) > max_depends:
+                    depends = list(t.depends)
+                    for i in xrange(0, len(depends), max_depends):
+                        self._add_barrier([t], depends[i:i + max_depends], members, pos, before)
+                    # it may still have too many (barriers), making a tree
+                    queue.append(t)
+
+        if before:
+            tasks = []
+            for i, t in enumerate(self.tasks):
+                tasks.extend(before.get(i, []))
+                tasks.append(t)
+            self.tasks = tasks
+
+    def _add_barrier(self, tasks, depends, members, pos, before):
+        '''
+        adds a barrier job, so that the tasks wait on it instead of these
+        dependencies (it is listed in "before", under the position of the
+        first of the tasks)
+        '''
+        first = tasks[0]
+        resources = {'walltime': '00:00:10', 'mem': '10M'}
+        for k in ['wd', 'env', 'queue', 'qos', 'account', 'mail']:
+            if k in first.resources:
+                resources[k] = first.resources[k]
+
+        barrier = QTask('/bin/true', 'barrier', resources)
+        barrier.basename = first.basename
+        barrier.barrier = True
+        barrier.depends = list(depends)
+
+        moved = set([_dep_key(d) for d in depends])
+        waiting = set(tasks)
+        for d in depends:
+            if d in members:
+                d.children = [c for c in d.children if c not in waiting] + [barrier]
+
+        for t in tasks:
+            t.depends = [d for d in t.depends if _dep_key(d) not in moved] + [barrier]
+            barrier.children.append(t)
+
+        pos[barrier] = min([pos[t] for t in tasks])
+        before[pos[barrier]].append(barrier)
+        members.add(barrier)
+
+    def _prepare_task(self, t, dryrun=False):
+        '''
+        Returns True if the task should be submitted, False if it should be
+        skipped. Skipped tasks are treated as done for their dependents.
+        '''
+
+        # is this an already processed job (flagged to skip)
+        if t.skip:
+            if t in self._completed:
+                sys.stderr.write(' - skipped %s (already done)\n' % t.name)
+            else:
+                sys.stderr.write(' - skipped %s\n' % t.name)
+            self._submitted_tasks.add(t)
+            return False
+
+        if 'holding' in t.resources and t.resources['holding'] and 'force_first' in t.resources and t.resources['force_first'] and not [c for c in t.children if not c.skip]:
+            # This is a front-loaded holding job meant to hold all the other jobs from starting
+            # until the entire pipeline has been submitted. If there aren't any children for
+            # this job, then there is no point in submitting it.
+
+            t.skip = True
+            return False
+
+        if t.array:
+            t.array_index = self._write_array_index(t, dryrun)
+
+        return True
+
+    def _task_submitted(self, t, jobid):
+        t.jobid = jobid
+        t.runner = self.runner
+        if t.fused:
+            for sub in t.fused:
+                sub.jobid = jobid
+                sub.runner = self.runner
+        self._submitted_tasks.add(t)
+        self._submit_order.append(t)
+
+    def _qsub(self, t, dryrun=False):
+        '''
+        Calls runner.qsub, retrying (with a backoff) up to runner.retries times.
+        qsub can fail after the scheduler accepted the job, so if the runner
+        can list its jobs, the job is submitted with a token (in its name),
+        and a retry uses the job with that token if there is one.
+        '''
+        # fused tasks report to the monitor themselves
+        monitor = None if t.fused else self.config['monitor']
+        if not dryrun and not t.token and self.runner.retries and self.runner.lists_jobs():
+            t.token = _submit_token()
+
+        delay = 1.0
+        attempt = 0
+        prof = profiler.current()
+        while True:
+            try:
+                if attempt and t.token and not dryrun:
+                    found = self.runner.find_jobs(self.runner.job_name(t))
+                    if found:
+                        sys.stderr.write('%s was submitted (%s), not retrying\n' % (t.name, found[0]))
+                        return found[0], self.runner.qsub(t, monitor=monitor, dryrun=True)[1]
+
+                start = time.time()
+                try:
+                    return self.runner.qsub(t, monitor=monitor, dryrun=dryrun)
+                finally:
+                    if prof:
+                        prof.record('qsub', time.time() - start)
+            except (RuntimeError, OSError), e:
+                if attempt >= self.runner.retries:
+                    raise
+                attempt += 1
+                sys.stderr.write('Error submitting %s, retrying in %.0f sec (%s/%s)\n' % (t.name, delay, attempt, self.runner.retries))
+                time.sleep(delay * random.uniform(1, 1.5))
+                delay *= 2
+
+    def _report_task(self, t, src, mon, verbose=False, dryrun=False):
+        sys.stdout.write('%s\n' % t.jobid)
+        if verbose:
+            sys.stderr.write('-[%s - %s (%s)]---------------\n%s\n' % (t.jobid, t.name, ','.join([d.jobid for d in t.depends]), src))
+
+        if mon and not dryrun:
+            prof = profiler.current()
+            start = time.time()
+            if t.array:
+                # one row per array task (jobid.taskid)
+                for i, val in enumerate(t.array):
+                    mon.submit('%s.%s' % (t.jobid, i + 1), t.name, procs=t.resources['ppn'] if 'ppn' in t.resources else 1, deps=[x.jobid for x in t.depends], src=src, project=self.project, sample=var_repl(self.sample, val) if self.sample else self.sample, run=self.run_code)
+            elif t.fused:
+                # one row per fused task (jobid.N), each depending on the one before
+                for i, sub in enumerate(t.fused):
+                    deps = [x.jobid for x in sub.depends if x not in t.fused]
+                    if i:
+                        deps.append('%s.%s' % (t.jobid, i))
+                    mon.submit('%s.%s' % (t.jobid, i + 1), sub.name, procs=sub.resources['ppn'] if 'ppn' in sub.resources else 1, deps=deps, src=src, project=self.project, sample=self.sample, run=self.run_code, task_hash=sub.task_hash)
+            else:
+                mon.submit(t.jobid, t.name, procs=t.resources['ppn'] if 'ppn' in t.resources else 1, deps=[x.jobid for x in t.depends], src=src, project=self.project, sample=self.sample, run=self.run_code, task_hash=t.task_hash)
+            if prof:
+                prof.record('monitor.submit', time.time() - start)
+
+    def _submit_concurrent(self, graph, mon, verbose=False):
+        '''
+        Submits every ready task in parallel (up to runner.concurrency qsub
+        calls at once). Children are released as soon as their parents have a
+        jobid. Job ids are still written (and recorded) in pipeline order.
+
+        If a qsub call fails, no new jobs are submitted. Any outstanding
+        calls are allowed to finish (so they can be rolled back) and the
+        error is raised.
+        '''
+        pool = _SubmitPool(self._qsub, self.runner.concurrency)
+        order = list(self.tasks)
+        pos = 0
+        finished = {}
+        inflight = 0
+        error = None
+
+        try:
+            while True:
+                while graph.ready and not error:
+                    t = graph.ready.popleft()
+                    if self._prepare_task(t):
+                        pool.put(t)
+                        inflight += 1
+                    else:
+                        finished[t] = None
+                        graph.done(t)
+
+                # write out job ids in a stable order
+                while pos < len(order) and order[pos] in finished:
+                    t = order[pos]
+                    if not t.skip:
+                        self._report_task(t, finished[t], mon, verbose)
+                    pos += 1
+
+                if not inflight:
+                    break
+
+                t, jobid, src, e = pool.get()
+                inflight -= 1
+
+                if e:
+                    if not error:
+                        error = e
+                    continue
+
+                self._task_submitted(t, jobid)
+                finished[t] = src
+                if not error:
+                    graph.done(t)
+
+        finally:
+            pool.close()
+
+        if error:
+            raise error
+
+    def _write_array_index(self, task, dryrun=False):
+        '''
+        Writes the values for an array job (one per line) to a file in the
+        job's working directory. Returns the path to the file.
+        '''
+        path = os.path.join(task.resources['wd'], '.qtask.%s.%s.array' % (self.run_code, self._array_seq.next()))
+        if not dryrun:
+            with open(path, 'w') as f:
+                for val in task.array:
+                    f.write('%s\n' % val)
+        return path
+
     def abort(self, monitor=None):
-        for t in self._submitted_tasks:
+        '''
+        Removes all of the jobs that were submitted. Jobs are removed (in as few
+        qdel calls as possible) in the reverse order that they were submitted,
+        so that nothing is released early by removing its dependencies first.
+        '''
+        jobids = []
+        rows = []
+        for t in reversed(self._submit_order):
             if not t.skip:
-                self.runner.qdel(t.jobid)
-                if monitor:
-                    monitor.abort(t.jobid, 'submit', '0')
+                jobids.append(t.jobid)
+                if t.array or t.fused:
+                    for i in xrange(len(t.array or t.fused)):
+                        rows.append('%s.%s' % (t.jobid, i + 1))
+                else:
+                    rows.append(t.jobid)
+
+        if jobids:
+            self.runner.qdel(*jobids)
 
         if monitor:
+            if rows:
+                monitor.abort_jobs(rows, 'submit', '0')
             monitor.close()
 
-pipeline = __Pipeline()
+def _load_pipeline():
+    return __Pipeline()
+
+
+class _PipelineProxy(object):
+    '''
+    The pipeline is only created (reading ~/.qtaskrc and the environment)
+    the first time it is used. This keeps "import qtask.monitor" (used by
+    qtask-mon in every job) fast.
+    '''
+    def __init__(self):
+        object.__setattr__(self, '_pipeline', None)
+
+    def _get(self):
+        if object.__getattribute__(self, '_pipeline') is None:
+            object.__setattr__(self, '_pipeline', _load_pipeline())
+        return object.__getattribute__(self, '_pipeline')
+
+    def __getattr__(self, name):
+        return getattr(self._get(), name)
+
+    def __setattr__(self, name, val):
+        setattr(self._get(), name, val)
+
+
+pipeline = _PipelineProxy()
@@ -0,0 +1,283 @@
+import os
+import sys
+import time
+import signal
+import datetime
+import subprocess
+import collections
+
+import qtask
+
+
+class _LocalJob(object):
+    def __init__(self, jobid, task, script, procs, mem, walltime):
+        self.jobid = jobid
+        self.name = task.name
+        self.script = script
+        self.procs = procs
+        self.mem = mem
+        self.walltime = walltime
+        self.wd = task.resources['wd']
+        self.tc = int(task.resources['tc']) if task.array and 'tc' in task.resources else 0
+        self.elements = range(1, len(task.array) + 1) if task.array else [None]
+        self.depends = set()
+        self.children = []
+        self.remaining = len(self.elements)
+        self.running = 0
+        self.failed = False
+        self.cancelled = False
+
+
+class LocalRunner(qtask.JobRunner):
+    '''
+    Runs the pipeline on this host, instead of submitting it to a scheduler.
+
+    Jobs are started (in parallel) as soon as their dependencies finish,
+    limited by the number of available slots (ppn) and memory (mem, per
+    processor). If a job fails, all of the jobs that depend on it are
+    cancelled, and submit() raises a RuntimeError once the rest have finished.
+
+    Options (runner.* in ~/.qtaskrc):
+        slots    number of processors to use (default: all)
+        mem      memory to use (default: all physical memory)
+    '''
+    supports_array = True
+    jobid_var = '${QTASK_JOB_ID}'
+
+    def __init__(self, slots=None, mem=None, tmpdir='/tmp', *args, **kwargs):
+        qtask.JobRunner.__init__(self, *args, **kwargs)
+        # jobs are only queued by qsub, so there is nothing to gain by submitting in parallel
+        self.concurrency = 1
+
+        if slots:
+            self.slots = int(slots)
+        else:
+            import multiprocessing
+            self.slots = multiprocessing.cpu_count()
+
+        if mem:
+            self.mem = qtask._mem_bytes(mem)
+        else:
+            self.mem = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+        self.tmpdir = tmpdir
+        self.failed = []
+        self._jobs = collections.OrderedDict()
+        self._jobid = 1
+        self.uniq = '%s_%s' % (datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S%f'), os.getpid())
+
+    def qsub(self, task, monitor, dryrun=False):
+        jobid = 'local_%s_%s' % (self._jobid, self.uniq)
+        self._jobid += 1
+
+        if task.array:
+            # each array task is tracked separately by the monitor
+            jobvar = '${QTASK_JOB_ID}.${QTASK_TASK_ID}'
+        else:
+            jobvar = '${QTASK_JOB_ID}'
+
+        src = '#!/bin/bash\n'
+        src += 'FAILED=""\n'
+        src += 'trap \'FAILED="SIGTERM"\' SIGTERM\n'
+
+        if task.array:
+            src += 'QTASK_INPUT="$(sed -n "${QTASK_TASK_ID}p" "%s")"\n' % task.array_index
+            src += 'QTASK_INPUT_BASE="${QTASK_INPUT##*/}"\n'
+            src += 'export QTASK_INPUT QTASK_INPUT_BASE\n'
+
+        # (in a subshell, so that an "exit" in the command doesn't skip the monitor)
+        src += 'set -o pipefail\nfunc () (\n  %s\n)\n' % task.cmd
+
+        if monitor:
+            src += '"%s" "%s" start %s $HOSTNAME\n' % (qtask.QTASK_MON, monitor, jobvar)
+            src += '%s 2>"%s/%s.qtask.stderr" >"%s/%s.qtask.stdout"\n' % (qtask._measured(task, 'func', '%s/%s.qtask.rusage' % (self.tmpdir, jobvar)), self.tmpdir, jobvar, self.tmpdir, jobvar)
+            src += 'RETVAL=$?\n'
+            src += 'if [ "$FAILED" == "" ]; then\n'
+            src += '  "%s" "%s" stop %s $RETVAL "%s/%s.qtask.stdout" "%s/%s.qtask.stderr" "%s/%s.qtask.rusage"\n' % (qtask.QTASK_MON, monitor, jobvar, self.tmpdir, jobvar, self.tmpdir, jobvar, self.tmpdir, jobvar)
+            src += 'else\n'
+            src += '  "%s" "%s" signal %s "$FAILED"\n' % (qtask.QTASK_MON, monitor, jobvar)
+            src += 'fi\n'
+            if task.measured:
+                src += 'rm -f "%s/%s.qtask.rusage"\n' % (self.tmpdir, jobvar)
+
+            for stream in ['stdout', 'stderr']:
+                if stream in task.resources:
+                    src += 'mv "%s/%s.qtask.%s" "%s"\n' % (self.tmpdir, jobvar, stream, task.resources[stream])
+                else:
+                    src += 'rm "%s/%s.qtask.%s"\n' % (self.tmpdir, jobvar, stream)
+
+            src += 'if [ "$FAILED" != "" -o $RETVAL -ne 0 ]; then\n'
+            src += '  "%s" "%s" killdeps $QTASK_JOB_ID\n' % (qtask.QTASK_MON, monitor)
+            src += 'fi\n'
+        else:
+            src += 'func'
+            if 'stdout' in task.resources:
+                src += ' >"%s"' % task.resources['stdout']
+            if 'stderr' in task.resources:
+                src += ' 2>"%s"' % task.resources['stderr']
+            src += '\n'
+            src += 'RETVAL=$?\n'
+            if task.fused and task.resources.get('monitor'):
+                # fused tasks report to the monitor themselves (this aborts
+                # the unfinished ones, jobid.N)
+                src += 'if [ "$FAILED" != "" ]; then\n'
+                src += '  "%s" "%s" signal %s "$FAILED"\n' % (qtask.QTASK_MON, task.resources['monitor'], jobvar)
+                src += 'fi\n'
+
+        src += 'exit $RETVAL\n'
+
+        if dryrun:
+            return 'dryrun.%s' % jobid, src
+
+        procs = int(task.resources['ppn']) if 'ppn' in task.resources else 1
+        # (mem is per processor, like SGE's h_vmem)
+        mem = qtask._mem_bytes(task.resources['mem']) * procs if 'mem' in task.resources else 0
+        walltime = qtask._walltime_seconds(self._calc_time(task.resources['walltime'])) if 'walltime' in task.resources else 0
+
+        job = _LocalJob(jobid, task, src, procs, mem, walltime)
+        for dep in task.depends:
+            if dep.jobid in self._jobs:
+                job.depends.add(dep.jobid)
+        if 'depends' in task.resources:
+            for depid in task.resources['depends'].split(','):
+                if depid in self._jobs:
+                    job.depends.add(depid)
+        for depid in job.depends:
+            self._jobs[depid].children.append(job)
+
+        self._jobs[jobid] = job
+        return jobid, src
+
+    def qdel(self, *jobid):
+        for j in jobid:
+            if j in self._jobs:
+                self._jobs[j].cancelled = True
+
+    def qrls(self, *jobid):
+        # nothing is started until the pipeline has been submitted (done)
+        pass
+
+    def done(self):
+        if self._jobs:
+            return self.run()
+
+    def run(self):
+        'runs all queued jobs, returns True if they all finished successfully'
+        self.failed = []
+        ready = collections.deque()
+        for job in self._jobs.values():
+            if job.cancelled:
+                self._cancel(job)
+            elif not job.depends:
+                ready.extend([(job, i) for i in job.elements])
+
+        running = {}
+        free_slots = self.slots
+        free_mem = self.mem
+
+        try:
+            while ready or running:
+                waiting = collections.deque()
+                while ready and free_slots:
+                    job, idx = ready.popleft()
+                    if job.cancelled:
+                        continue
+
+                    # (jobs larger than the host are run by themselves)
+                    procs = min(job.procs, self.slots)
+                    mem = min(job.mem, self.mem)
+                    if (job.tc and job.running >= job.tc) or procs > free_slots or mem > free_mem:
+                        waiting.append((job, idx))
+                        continue
+
+                    running[self._start(job, idx)] = (job, idx, procs, mem, time.time())
+                    job.running += 1
+                    free_slots -= procs
+                    free_mem -= mem
+
+                waiting.extend(ready)
+                ready = waiting
+
+                finished = False
+                for proc, (job, idx, procs, mem, started) in running.items():
+                    if job.walltime and not proc.stopped and time.time() - started > job.walltime:
+                        sys.stderr.write('Job %s exceeded its walltime, stopping\n' % self._jobname(job, idx))
+                        self._stop(proc)
+
+                    if proc.poll() is None:
+                        continue
+
+                    finished = True
+                    del running[proc]
+                    os.unlink(proc.script)
+                    job.running -= 1
+                    job.remaining -= 1
+                    free_slots += procs
+                    free_mem += mem
+
+                    if proc.returncode != 0 and not job.failed:
+                        job.failed = True
+                        self.failed.append(job.jobid)
+                        sys.stderr.write('Error processing job: %s (%s)\n' % (self._jobname(job, idx), proc.returncode))
+                        for child in job.children:
+                            self._cancel(child)
+
+                    if not job.remaining and not job.failed:
+                        for child in job.children:
+                            child.depends.discard(job.jobid)
+                            if not child.depends and not child.cancelled:
+                                ready.extend([(child, i) for i in child.elements])
+
+                if not finished:
+                    time.sleep(0.05)
+
+        except KeyboardInterrupt:
+            for proc in running:
+                self._stop(proc)
+            for proc in running:
+                proc.wait()
+                os.unlink(proc.script)
+            raise
+
+        finally:
+            self._jobs = collections.OrderedDict()
+
+        return not self.failed
+
+    def _jobname(self, job, idx):
+        if idx:
+            return '%s.%s (%s)' % (job.jobid, idx, job.name)
+        return '%s (%s)' % (job.jobid, job.name)
+
+    def _start(self, job, idx):
+        script = os.path.join(self.tmpdir, '%s.%s.qtask.sh' % (job.jobid, idx or 0))
+        with open(script, 'w') as f:
+            f.write(job.script)
+
+        env = dict(os.environ)
+        env['QTASK_JOB_ID'] = job.jobid
+        if idx:
+            env['QTASK_TASK_ID'] = str(idx)
+
+        # in its own process group, so that everything it started can be stopped
+        proc = subprocess.Popen(['/bin/bash', script], cwd=job.wd, env=env, preexec_fn=os.setsid)
+        proc.script = script
+        proc.stopped = False
+        return proc
+
+    def _stop(self, proc):
+        proc.stopped = True
+        try:
+            os.killpg(proc.pid, signal.SIGTERM)
+        except OSError:
+            # already finished
+            pass
+
+    def _cancel(self, job):
+        'cancels a job and everything that depends on it'
+        queue = collections.deque([job])
+        while queue:
+            j = queue.popleft()
+            if not j.cancelled or j is job:
+                j.cancelled = True
+                queue.extend(j.children)
@@ -1,6 +1,12 @@
 import os
-import datetime
 import time
+import contextlib
+import errno
+import random
+import socket
+import sys
+import zlib
+import collections
 # import signal
 
 
@@ -10,8 +16,175 @@ def load_monitor(uri):
     elif uri[:9] == 'sqlite://':
         import sqlite
         return sqlite.SqliteMonitor(os.path.realpath(os.path.expanduser(uri[9:])))
+    elif uri[:7] == 'http://':
+        import http
+        return http.HttpMonitor(uri)
     return None
 
+# captured job output is read (and decompressed) in chunks of this size
+CHUNK_SIZE = 1024 * 1024
+
+
+def _env_int(name, default):
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+def _strip_line(line):
+    'keep the last thing written to a line that is overwritten using \\r (progress bars)'
+    if '\r' not in line:
+        return line
+    segments = [x for x in line.split('\r') if x]
+    if segments:
+        return segments[-1]
+    return ''
+
+
+def _strip_progress(chunks):
+    partial = ''
+    for chunk in chunks:
+        lines = (partial + chunk).split('\n')
+        partial = lines.pop()
+        if len(partial) > CHUNK_SIZE and '\r' in partial:
+            # a progress bar without a newline, only the last update matters
+            partial = partial[partial.rfind('\r'):]
+        if lines:
+            yield '%s\n' % '\n'.join([_strip_line(x) for x in lines])
+        if len(partial) > CHUNK_SIZE:
+            # a long line without a newline (ex: binary data), pass it on so
+            # that only the capture's head and tail are kept in memory
+            yield _strip_line(partial)
+            partial = ''
+    if partial:
+        yield _strip_line(partial)
+
+
+class _OutputCapture(object):
+    '''
+    Compresses output as it is written, keeping at most "head" bytes from the
+    start and "tail" bytes from the end. If both are 0, everything is kept.
+    '''
+    def __init__(self, head, tail):
+        if head <= 0 and tail <= 0:
+            head = sys.maxint
+        self.head = max(head, 0)
+        self.tail = max(tail, 0)
+        self._z = zlib.compressobj()
+        self._out = []
+        self._head_len = 0
+        self._tail = collections.deque()
+        self._tail_len = 0
+        self._total = 0
+
+    def write(self, data):
+        self._total += len(data)
+        if self._head_len < self.head:
+            data_head = data[:self.head - self._head_len]
+            self._out.append(self._z.compress(data_head))
+            self._head_len += len(data_head)
+            data = data[len(data_head):]
+
+        if data and self.tail:
+            self._tail.append(data)
+            self._tail_len += len(data)
+            while self._tail_len - len(self._tail[0]) >= self.tail:
+                self._tail_len -= len(self._tail.popleft())
+
+    def getvalue(self):
+        tail = ''
+        if self.tail:
+            tail = ''.join(self._tail)[-self.tail:]
+
+        dropped = self._total - self._head_len - len(tail)
+        if dropped:
+            self._out.append(self._z.compress('\n[... %s bytes truncated ...]\n' % dropped))
+        self._out.append(self._z.compress(tail))
+        self._out.append(self._z.flush())
+        return ''.join(self._out)
+
+
+def capture_output(filename, strip_progress=False, head=None, tail=None):
+    '''
+    Reads a captured output file in chunks and returns it zlib compressed.
+    Only the first "head" and last "tail" bytes are kept ($QTASK_LOG_HEAD and
+    $QTASK_LOG_TAIL, default: 1M each; set both to 0 to keep everything).
+    '''
+    if head is None:
+        head = _env_int('QTASK_LOG_HEAD', 1024 * 1024)
+    if tail is None:
+        tail = _env_int('QTASK_LOG_TAIL', 1024 * 1024)
+
+    capture = _OutputCapture(head, tail)
+    if filename and os.path.exists(filename):
+        with open(filename, 'rb') as f:
+            chunks = iter(lambda: f.read(CHUNK_SIZE), '')
+            if strip_progress:
+                chunks = _strip_progress(chunks)
+            for chunk in chunks:
+                capture.write(chunk)
+
+    return capture.getvalue()
+
+def read_stdout(stdout):
+    'returns the (compressed) contents of a captured stdout file'
+    return capture_output(stdout)
+
+def read_stderr(stderr):
+    'returns the (compressed) contents of a captured stderr file, without progress bars'
+    return capture_output(stderr, strip_progress=True)
+
+# resource usage recorded for each job (see qtask-rusage): peak RSS (KB), CPU
+# user/sys time (sec), and bytes read/written
+RUSAGE_COLUMNS = ['max_rss', 'cpu_user', 'cpu_sys', 'io_read', 'io_write']
+
+def write_rusage(filename, vals):
+    with open(filename, 'w') as f:
+        for k in RUSAGE_COLUMNS:
+            if vals.get(k) is not None:
+                f.write('%s %s\n' % (k, vals[k]))
+
+def read_rusage(filename):
+    'returns the values in a qtask-rusage file (or None if it is missing)'
+    if not filename or not os.path.exists(filename):
+        return None
+    vals = {}
+    with open(filename) as f:
+        for line in f:
+            cols = line.split()
+            if len(cols) == 2 and cols[0] in RUSAGE_COLUMNS:
+                vals[cols[0]] = float(cols[1]) if cols[0][:4] == 'cpu_' else int(cols[1])
+    return vals
+
+def iter_output(data):
+    '''
+    Decompresses stored output, yielding it in chunks. Output stored by older
+    versions (uncompressed text) is returned as is.
+    '''
+    if data is None:
+        return
+    if not isinstance(data, buffer):
+        yield data
+        return
+
+    z = zlib.decompressobj()
+    buf = str(data)
+    while buf:
+        out = z.decompress(buf, CHUNK_SIZE)
+        buf = z.unconsumed_tail
+        if out:
+            yield out
+
+    out = z.flush()
+    if out:
+        yield out
+
+
+# possible job statuses
+STATUSES = ['pending', 'running', 'done', 'failed', 'aborted']
+
+
 class LockAcquireError(Exception):
     pass
 
@@ -26,35 +199,162 @@ class LockAcquireError(Exception):
 # signal.signal(signal.SIGINT , __cleanup_handler) 
 
 
+def _read_owner(path):
+    try:
+        with open(os.path.join(path, 'owner')) as f:
+            host, pid, ts = f.read().split()
+            return host, int(pid), float(ts)
+    except (IOError, OSError, ValueError):
+        return None
+
+def _pid_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+    return True
+
+
 class Lock(object):
-    def __init__(self, path):
+    '''
+    Directory based lock (mkdir is atomic, even over NFS). The owner's host,
+    pid and acquire time are written to the lock directory so that locks left
+    behind by dead processes (or nodes) can be detected and broken.
+
+    A holder that keeps the lock for a long time (ex: a large migration)
+    should call refresh() as it goes, so that it isn't mistaken for a stale
+    lock.
+
+    Time spent waiting for the lock is tracked to measure contention.
+    '''
+    def __init__(self, path, stale=120):
         self.path = os.path.abspath(path)+'.lock'
+        self.stale = stale
         self.__locked = False
+        self._written = 0
+
+        self.acquired = 0
+        self.broken = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
 
     def acquire(self, timeout = 60):
         if self.__locked:
             return
 
-        start = datetime.datetime.now()
-        while (datetime.datetime.now() - start).seconds < timeout:
+        start = time.time()
+        delay = 0.01
+        while True:
             try:
                 os.mkdir(self.path)
                 self.__locked = True
+                self._write_owner()
                 # global __active_locks
                 # __active_locks.add(self)
-                return
+                break
             except OSError:
-                time.sleep(.1)
-        
-        raise LockAcquireError
+                pass
+
+            if self._break_stale():
+                continue
+
+            if time.time() - start >= timeout:
+                self._record_wait(time.time() - start)
+                raise LockAcquireError('Timed out waiting for lock: %s (owner: %s)' % (self.path, self.owner()))
+
+            # back off (with jitter) so that many waiting jobs don't poll in lock-step
+            time.sleep(random.uniform(delay / 2, delay))
+            delay = min(delay * 2, 0.5)
+
+        self.acquired += 1
+        self._record_wait(time.time() - start)
 
     def release(self):
         if self.__locked:
             self.__locked = False
-            os.rmdir(self.path)
+            try:
+                os.unlink(os.path.join(self.path, 'owner'))
+                os.rmdir(self.path)
+            except OSError:
+                # our lock was broken by someone else
+                pass
     #         global __active_locks
     #         __active_locks.remove(self)
 
+    def refresh(self):
+        'updates the timestamp of a held lock (at most every stale/4 seconds)'
+        if self.__locked and time.time() - self._written > self.stale / 4.0:
+            self._write_owner()
+
+    def owner(self):
+        'returns (hostname, pid, timestamp) for the current lock holder, or None'
+        return _read_owner(self.path)
+
+    def _write_owner(self):
+        # (renamed into place, so the owner is never read half-written)
+        self._written = time.time()
+        tmp = os.path.join(self.path, 'owner.tmp')
+        try:
+            with open(tmp, 'w') as f:
+                f.write('%s %s %s\n' % (socket.gethostname(), os.getpid(), self._written))
+            os.rename(tmp, os.path.join(self.path, 'owner'))
+        except (IOError, OSError):
+            # our lock was broken by someone else
+            pass
+
+    def _record_wait(self, secs):
+        self.wait_time += secs
+        if secs > self.max_wait:
+            self.max_wait = secs
+
+    def _is_stale(self, owner):
+        if not owner:
+            # the owner may not have written the file yet, so use the age of the lock
+            try:
+                return time.time() - os.stat(self.path).st_mtime > self.stale
+            except OSError:
+                return False
+
+        host, pid, ts = owner
+        if host == socket.gethostname() and not _pid_exists(pid):
+            return True
+
+        return time.time() - ts > self.stale
+
+    def _break_stale(self):
+        '''
+        Removes the current lock if it is stale. Returns True if the lock was
+        removed (or went away), so acquiring should be tried again.
+        '''
+        owner = self.owner()
+        if not self._is_stale(owner):
+            return False
+
+        # move the lock out of the way first, so only one process breaks it
+        tmp = '%s.stale.%s.%s' % (self.path, socket.gethostname(), os.getpid())
+        try:
+            os.rename(self.path, tmp)
+        except OSError:
+            return True
+
+        if _read_owner(tmp) != owner:
+            # someone else broke the stale lock and acquired it in the meantime
+            try:
+                os.rename(tmp, self.path)
+                return False
+            except OSError:
+                pass
+
+        try:
+            if os.path.exists(os.path.join(tmp, 'owner')):
+                os.unlink(os.path.join(tmp, 'owner'))
+            os.rmdir(tmp)
+        except OSError:
+            pass
+
+        self.broken += 1
+        return True
+
     # def _abort(self):
     #     if self.__locked:
     #         self.__locked = False
@@ -66,22 +366,160 @@ class Monitor(object):
         pass
     def close(self):
         pass
-    def submit(self, jobid, jobname, src, procs=1, deps=[], project=None, sample=None, run=None):
+    def stats(self):
+        'returns a dict of counters (lock waits, etc)'
+        return {}
+    def begin_batch(self, size=1000):
+        'buffer submit() calls, writing them every "size" jobs (or when end_batch() is called)'
+        pass
+    def end_batch(self):
+        pass
+    @contextlib.contextmanager
+    def batch(self, size=1000):
+        self.begin_batch(size)
+        try:
+            yield self
+        finally:
+            self.end_batch()
+    def submit(self, jobid, jobname, src, procs=1, deps=[], project=None, sample=None, run=None, task_hash=None):
         raise NotImplementedError
     def start(self, jobid, hostname=None):
         raise NotImplementedError
-    def stop(self, jobid, return_code, stdout=None, stderr=None):
+    def stop(self, jobid, return_code, stdout=None, stderr=None, rusage=None):
+        'stdout, stderr, and rusage (from qtask-rusage) are files'
         raise NotImplementedError
     def stdout(self, jobid, filename):
         raise NotImplementedError
     def stderr(self, jobid, filename):
         raise NotImplementedError
+    def output(self, jobid, stream='stdout'):
+        'returns an iterator over the stored stdout (or stderr) for a job'
+        raise NotImplementedError
     def killdeps(self, jobid):
         raise NotImplementedError
+    def qdeldeps(self, jobid):
+        '''
+        killdeps(), returning the rows for the jobs that still need to be
+        removed from the scheduler (ones that weren't already finished or
+        aborted). See qdel_rows().
+        '''
+        raise NotImplementedError
     def signal(self, jobid, signal):
         raise NotImplementedError
-    def find(self, project=None, sample=None, jobname=None, jobid=None):
+    def abort(self, jobid, reason, code):
+        raise NotImplementedError
+    def abort_jobs(self, jobids, reason, code):
+        'abort() for many jobs at once'
+        with self.batch():
+            for jobid in jobids:
+                self.abort(jobid, reason, code)
+    def find(self, project=None, sample=None, jobname=None, jobid=None, run=None, status=None, columns=None, limit=None, offset=0):
+        'returns a list of dicts (one per job); src/stdout/stderr are only included if given in "columns"'
+        raise NotImplementedError
+    def completed(self, task_hashes):
+        'returns the set of the given task hashes that have finished successfully (and were not aborted)'
         raise NotImplementedError
+    def summary(self, project=None, sample=None, run=None):
+        'returns a list of dicts with the number of jobs in each status for each run'
+        raise NotImplementedError
+    def history(self, jobnames, limit=20):
+        '''
+        returns the run time and resource usage of the most recent (up to
+        "limit") successful jobs for each name, as a dict: name -> list of
+        dicts (secs, procs, and RUSAGE_COLUMNS)
+        '''
+        raise NotImplementedError
+
+
+def qdel_rows(rows, exclude=None):
+    '''
+    Removes the jobs for monitor rows from the scheduler, in as few qdel
+    calls as possible. Rows for array and fused tasks (jobid.N) are mapped
+    back to their job. Returns the job ids that were removed.
+    '''
+    if not rows:
+        return []
+
+    # (the runner is only loaded when there is something to remove)
+    import qtask
+    runner = qtask.pipeline.runner
+
+    exclude = set([runner.monitor_jobid(x) for x in exclude or []])
+    jobids = []
+    seen = set()
+    for row in rows:
+        jobid = runner.monitor_jobid(row)
+        if jobid not in exclude and jobid not in seen:
+            seen.add(jobid)
+            jobids.append(jobid)
+
+    if jobids:
+        runner.qdel(*jobids)
+    return jobids
+
+
+# abort code for jobs that the scheduler no longer knows about, but that never
+# reported that they finished (ex: killed for using too much memory)
+ABORT_LOST = 3
+
+
+def _lost_reason(info):
+    if not info or 'exit_status' not in info:
+        return 'lost'
+    reason = 'lost: exit_status=%s' % info['exit_status']
+    if info.get('failed'):
+        reason += ' (%s)' % info['failed']
+    return reason
+
+
+def reconcile(mon, runner, run=None, project=None, ttl=None, dryrun=False):
+    '''
+    Compares the pending/running jobs in the monitor with the scheduler
+    (runner.cached_job_states(), so at most one call every "ttl" seconds).
+    Jobs that the scheduler has dropped (or lists as finished) are aborted
+    with code 3 (lost), with their exit status from the scheduler's
+    accounting records, if it can be found.
+
+    Returns a list of (jobid, reason) for the lost jobs.
+    '''
+    # the scheduler has to be read first: jobs record that they finished
+    # before they exit, so any job missing after that is really gone
+    ts, states = runner.cached_job_states(ttl)
+
+    lost = []
+    since = None
+    for status in ['pending', 'running']:
+        for job in mon.find(run=run, project=project, status=status, columns=['jobid', 'submit_time']):
+            if job['submit_time'] is None or job['submit_time'] >= int(ts):
+                # submitted after the states were read
+                continue
+
+            jobid = job['jobid']
+            info = states.get(jobid)
+            if info is None:
+                # fused tasks (jobid.N) run as one job
+                info = states.get(runner.monitor_jobid(jobid))
+
+            if info is None or info['state'] == 'done':
+                lost.append((jobid, info))
+                since = min(since or job['submit_time'], job['submit_time'])
+
+    if not lost:
+        return []
+
+    missing = [jobid for jobid, info in lost if not info or 'exit_status' not in info]
+    if missing:
+        found = runner.job_accounting(missing + [runner.monitor_jobid(x) for x in missing], since)
+        lost = [(jobid, info if info and 'exit_status' in info else found.get(jobid, found.get(runner.monitor_jobid(jobid)))) for jobid, info in lost]
+
+    lost = [(jobid, _lost_reason(info)) for jobid, info in lost]
+    if not dryrun:
+        by_reason = {}
+        for jobid, reason in lost:
+            by_reason.setdefault(reason, []).append(jobid)
+        for reason in by_reason:
+            mon.abort_jobs(by_reason[reason], reason, ABORT_LOST)
+    return lost
 
 
 class TextMonitor(Monitor):
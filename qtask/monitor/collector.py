@@ -0,0 +1,315 @@
+import os
+import sys
+import json
+import base64
+import time
+import socket
+import sqlite3
+import threading
+import Queue
+import BaseHTTPServer
+import SocketServer
+
+import qtask.monitor.http
+
+
+def _output(args, stream):
+    'returns compressed output from an event'
+    if args.get('%s_z' % stream):
+        return base64.b64decode(args['%s_z' % stream])
+    return None
+
+
+def apply_event(mon, ev):
+    '''
+    writes one event (sent by HttpMonitor) to a SqliteMonitor, returns the
+    rows for any jobs that need to be removed from the scheduler (qdeldeps)
+    '''
+    cmd = ev['cmd']
+    jobid = ev['jobid']
+    ts = ev.get('ts')
+    args = ev.get('args', {})
+
+    if cmd == 'submit':
+        mon.submit(jobid, args['jobname'], args['src'], args.get('procs', 1), args.get('deps', []), args.get('project'), args.get('sample'), args.get('run'), args.get('task_hash'), ts=ts)
+    elif cmd == 'start':
+        mon.start(jobid, args.get('hostname'), ts=ts)
+    elif cmd == 'stop':
+        mon.record_stop(jobid, args['retcode'], _output(args, 'stdout'), _output(args, 'stderr'), ts=ts, usage=args.get('usage'))
+    elif cmd == 'output':
+        mon.record_output(jobid, _output(args, 'stdout'), _output(args, 'stderr'))
+    elif cmd == 'killdeps':
+        mon.killdeps(jobid, ts=ts)
+    elif cmd == 'qdeldeps':
+        return mon.qdeldeps(jobid, ts=ts)
+    elif cmd == 'signal':
+        mon.signal(jobid, args['sig'], ts=ts)
+    elif cmd == 'abort':
+        mon.abort(jobid, args['reason'], args['code'], ts=ts)
+    else:
+        raise ValueError('Unknown event: %s' % cmd)
+    return []
+
+
+class _SpoolFile(object):
+    '''
+    Used in place of a request's "done" event for events replayed from a
+    spool file: the file is removed once they have been written.
+    '''
+    def __init__(self, fname, orig):
+        self.fname = fname
+        self.orig = orig
+        self.error = None
+
+    def set(self):
+        if self.error:
+            # put it back to be replayed again
+            sys.stderr.write('Events not written (left in %s): %s\n' % (self.orig, self.error))
+            os.rename(self.fname, self.orig)
+        else:
+            os.unlink(self.fname)
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        self._reply(200, 'qtask-collector\n')
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.getheader('content-length'))
+            events = json.loads(self.rfile.read(length))
+            if type(events) == dict:
+                events = [events]
+        except (TypeError, ValueError):
+            self._reply(400, 'Invalid request\n')
+            return
+
+        try:
+            written = self.server.collector.post(events)
+        except RuntimeError, e:
+            # (the client will spool the events)
+            self._reply(503, '%s\n' % e)
+            return
+
+        if written:
+            self._reply(200, 'OK\n')
+        else:
+            # queued, but not written yet
+            self._reply(202, 'Queued\n')
+
+    def _reply(self, code, msg):
+        self.send_response(code)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(msg)))
+        self.end_headers()
+        self.wfile.write(msg)
+
+    def log_message(self, fmt, *args):
+        if self.server.collector.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, fmt, *args)
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class Collector(object):
+    '''
+    HTTP server that accepts events from HttpMonitor clients (qtask-mon
+    running on compute nodes) and writes them to a SqliteMonitor.
+
+    All writes are made by a single thread. Events that arrive while a write
+    is in progress are grouped into the next transaction, and each request is
+    answered once its events have been committed, or after "wait" seconds
+    (with 202, they are still written). "wait" has to be well under the
+    clients' timeout (HttpMonitor: 5 sec), otherwise they spool events that
+    the collector writes anyway (submit events are written once, but the
+    others would be applied again).
+
+    Jobs removed by failed jobs (qdeldeps) are collected for "qdel_wait"
+    seconds, so that a wave of failures is sent to the scheduler as one
+    (deduplicated) qdel call.
+    '''
+    def __init__(self, monitor, host='', port=8080, wait=2, batch_size=1000, verbose=False, qdel_wait=2, qdel=None):
+        self.monitor = monitor
+        self.wait = wait
+        self.batch_size = batch_size
+        self.verbose = verbose
+        self.qdel_wait = qdel_wait
+        # (rows, exclude) -> None, defaults to qtask.monitor.qdel_rows
+        self._qdel = qdel or qtask.monitor.qdel_rows
+        self._qdel_rows = []
+        self._qdel_exclude = []
+        self._qdel_start = None
+        self._queue = Queue.Queue()
+        self._writer = None
+        self._server = _Server((host, port), _Handler)
+        self._server.collector = self
+
+    @property
+    def uri(self):
+        host, port = self._server.server_address
+        if host in ['', '0.0.0.0']:
+            host = socket.gethostname()
+        return 'http://%s:%s/qtask-mon' % (host, port)
+
+    def start(self):
+        'starts the writer and server threads (returns immediately)'
+        self._start_writer()
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def serve_forever(self):
+        self._start_writer()
+        try:
+            self._server.serve_forever()
+        finally:
+            self._stop_writer()
+
+    def shutdown(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._stop_writer()
+
+    def post(self, events):
+        '''
+        queue events to be written, returns True if they were written within
+        "wait" seconds. Raises a RuntimeError if they couldn't be written (or
+        the writer isn't running).
+        '''
+        if not self._writer or not self._writer.is_alive():
+            raise RuntimeError('The writer is not running')
+
+        done = threading.Event()
+        done.error = None
+        self._queue.put((events, done))
+        done.wait(self.wait)
+        if done.error:
+            raise RuntimeError(done.error)
+        return done.is_set()
+
+    def replay_spool(self, spool):
+        '''
+        queue any events that clients spooled while the collector was down
+        (each file is removed once its events have been written)
+        '''
+        for fname, orig, events in qtask.monitor.http.claim_spool(spool):
+            self._queue.put((events, _SpoolFile(fname, orig)))
+
+    def _start_writer(self):
+        # sqlite connections can only be used by the thread that opened them
+        self.monitor.close()
+        self._writer = threading.Thread(target=self._write_loop)
+        self._writer.daemon = True
+        self._writer.start()
+
+    def _stop_writer(self):
+        if self._writer:
+            self._queue.put(None)
+            self._writer.join()
+            self._writer = None
+
+    def _write_loop(self):
+        try:
+            self._write_queue()
+        finally:
+            self._flush_qdel()
+            self.monitor.close()
+
+    def _write_queue(self):
+        while True:
+            if self._qdel_rows:
+                try:
+                    item = self._queue.get(True, max(0.01, self._qdel_start + self.qdel_wait - time.time()))
+                except Queue.Empty:
+                    self._flush_qdel()
+                    continue
+            else:
+                item = self._queue.get()
+
+            if item is None:
+                return
+
+            items = [item]
+            stop = False
+            while len(items) < self.batch_size:
+                try:
+                    item = self._queue.get_nowait()
+                except Queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                items.append(item)
+
+            self._write(items)
+            if self._qdel_rows and time.time() >= self._qdel_start + self.qdel_wait:
+                self._flush_qdel()
+            if stop:
+                return
+
+    def _flush_qdel(self):
+        if not self._qdel_rows:
+            return
+
+        rows = self._qdel_rows
+        exclude = self._qdel_exclude
+        self._qdel_rows = []
+        self._qdel_exclude = []
+        self._qdel_start = None
+        try:
+            jobids = self._qdel(rows, exclude)
+            if self.verbose:
+                sys.stderr.write('Removed %s job(s) with failed dependencies\n' % len(jobids))
+        except Exception, e:
+            sys.stderr.write('Error removing jobs: %s\n' % e)
+
+    def _write(self, items):
+        '''
+        Writes a group of requests in one transaction. If that fails, each
+        request is tried on its own, so that one can't lose the others.
+        '''
+        try:
+            self._write_items(items)
+        except Exception, e:
+            if len(items) == 1:
+                events, done = items[0]
+                sys.stderr.write('Error writing events: %s\n' % e)
+                done.error = 'Error writing events: %s' % e
+                done.set()
+                return
+
+            for item in items:
+                self._write([item])
+
+    def _write_items(self, items):
+        while True:
+            qdel_rows = []
+            qdel_exclude = []
+            try:
+                with self.monitor.transaction():
+                    for events, done in items:
+                        for ev in events:
+                            try:
+                                rows = apply_event(self.monitor, ev)
+                                if rows:
+                                    qdel_rows.extend(rows)
+                                    qdel_exclude.append(ev['jobid'])
+                            except (KeyError, TypeError, ValueError, sqlite3.InterfaceError, sqlite3.IntegrityError), e:
+                                # (a bad event, ex: a value sqlite can't store)
+                                sys.stderr.write('Error processing event: %s (%s)\n' % (ev, e))
+                break
+            except qtask.monitor.LockAcquireError, e:
+                sys.stderr.write('%s, retrying...\n' % e)
+                time.sleep(1)
+
+        if qdel_rows:
+            if not self._qdel_rows:
+                self._qdel_start = time.time()
+            self._qdel_rows.extend(qdel_rows)
+            self._qdel_exclude.extend(qdel_exclude)
+
+        for events, done in items:
+            done.set()
@@ -0,0 +1,195 @@
+import os
+import sys
+import errno
+import json
+import base64
+import time
+import socket
+import httplib
+import urllib2
+
+import qtask.monitor
+
+
+def _text(val):
+    'JSON needs unicode, but scripts can contain anything'
+    if type(val) == str:
+        return val.decode('utf-8', 'replace')
+    return val
+
+
+def _unclaim_stale(spool):
+    'puts back files claimed by processes on this host that are gone (ex: killed before sending them)'
+    prefix = '.claimed.%s.' % socket.gethostname()
+    for name in os.listdir(spool):
+        if not name.startswith(prefix):
+            continue
+        pid, orig = name[len(prefix):].split('.', 1)
+        try:
+            os.kill(int(pid), 0)
+            continue
+        except OSError, e:
+            if e.errno != errno.ESRCH:
+                continue
+        except ValueError:
+            continue
+
+        try:
+            os.rename(os.path.join(spool, name), os.path.join(spool, orig))
+        except OSError:
+            # someone else got it first
+            pass
+
+
+def claim_spool(spool, limit=None):
+    '''
+    Claims spooled event files (oldest first) by renaming them, so that only
+    one process sends them. Returns a list of (claimed filename, original
+    filename, events) tuples.
+    '''
+    if not os.path.isdir(spool):
+        return []
+
+    _unclaim_stale(spool)
+
+    claimed = []
+    for name in sorted(os.listdir(spool)):
+        if name[0] == '.':
+            continue
+        if limit and len(claimed) >= limit:
+            break
+
+        orig = os.path.join(spool, name)
+        fname = os.path.join(spool, '.claimed.%s.%s.%s' % (socket.gethostname(), os.getpid(), name))
+        try:
+            os.rename(orig, fname)
+        except OSError:
+            # someone else got it first
+            continue
+
+        try:
+            with open(fname) as f:
+                claimed.append((fname, orig, json.load(f)))
+        except ValueError:
+            sys.stderr.write('Invalid spool file: %s\n' % fname)
+
+    return claimed
+
+
+class HttpMonitor(qtask.monitor.Monitor):
+    '''
+    Sends job events to a qtask-collector server (see bin/qtask-collector),
+    which writes them to its database. If the server can't be reached, the
+    events are written to a spool directory ($QTASK_MON_SPOOL, or
+    ~/.qtask-mon.spool) and are sent the next time a request succeeds.
+    '''
+    def __init__(self, uri, timeout=5, spool=None):
+        self.uri = uri
+        self.timeout = timeout
+        if spool:
+            self.spool = spool
+        elif 'QTASK_MON_SPOOL' in os.environ:
+            self.spool = os.environ['QTASK_MON_SPOOL']
+        else:
+            self.spool = os.path.expanduser('~/.qtask-mon.spool')
+
+        # the collector is on the local network, so don't use a proxy
+        self._opener = urllib2.build_opener(urllib2.ProxyHandler({}))
+        self._batch_size = 0
+        self._pending = []
+        self._spooled = 0
+
+    def close(self):
+        self.flush()
+
+    def begin_batch(self, size=1000):
+        self._batch_size = size
+
+    def end_batch(self):
+        self.flush()
+        self._batch_size = 0
+
+    def flush(self):
+        if self._pending:
+            self._send(self._pending)
+            self._pending = []
+
+    def _event(self, cmd, jobid, **args):
+        self._pending.append({'cmd': cmd, 'jobid': jobid, 'ts': int(time.time()), 'args': args})
+        if len(self._pending) >= self._batch_size:
+            self.flush()
+
+    def _post(self, events):
+        try:
+            req = urllib2.Request(self.uri, json.dumps(events), {'Content-Type': 'application/json'})
+            resp = self._opener.open(req, timeout=self.timeout)
+            resp.read()
+            resp.close()
+            return True
+        except (urllib2.URLError, httplib.HTTPException, socket.error):
+            return False
+
+    def _send(self, events):
+        if self._post(events):
+            self._replay()
+        else:
+            self._write_spool(events)
+
+    def _write_spool(self, events):
+        if not os.path.exists(self.spool):
+            try:
+                os.makedirs(self.spool)
+            except OSError:
+                # made by another job
+                pass
+
+        self._spooled += 1
+        name = '%d.%s.%s.%s.json' % (time.time() * 1000, socket.gethostname(), os.getpid(), self._spooled)
+        tmp = os.path.join(self.spool, '.%s' % name)
+        with open(tmp, 'w') as f:
+            json.dump(events, f)
+        os.rename(tmp, os.path.join(self.spool, name))
+
+    def _replay(self, limit=100):
+        for fname, orig, events in claim_spool(self.spool, limit):
+            if self._post(events):
+                os.unlink(fname)
+            else:
+                # put it back for next time
+                os.rename(fname, orig)
+
+    def stats(self):
+        return {'spooled': self._spooled}
+
+    def submit(self, jobid, jobname, src, procs=1, deps=[], project=None, sample=None, run=None, task_hash=None):
+        self._event('submit', jobid, jobname=jobname, src=_text(src), procs=procs, deps=deps, project=project, sample=sample, run=run, task_hash=task_hash)
+
+    def start(self, jobid, hostname=None):
+        self._event('start', jobid, hostname=hostname)
+
+    def stop(self, jobid, return_code, stdout=None, stderr=None, rusage=None):
+        # the collector can't see files on this node, so send the (compressed) contents
+        self._event('stop', jobid, retcode=return_code,
+                    stdout_z=base64.b64encode(qtask.monitor.read_stdout(stdout)) if stdout else None,
+                    stderr_z=base64.b64encode(qtask.monitor.read_stderr(stderr)) if stderr else None,
+                    usage=qtask.monitor.read_rusage(rusage))
+
+    def stdout(self, jobid, filename):
+        self._event('output', jobid, stdout_z=base64.b64encode(qtask.monitor.read_stdout(filename)))
+
+    def stderr(self, jobid, filename):
+        self._event('output', jobid, stderr_z=base64.b64encode(qtask.monitor.read_stderr(filename)))
+
+    def killdeps(self, jobid):
+        self._event('killdeps', jobid)
+
+    def qdeldeps(self, jobid):
+        # the collector removes the jobs (in batches)
+        self._event('qdeldeps', jobid)
+        return []
+
+    def signal(self, jobid, signal):
+        self._event('signal', jobid, sig=signal)
+
+    def abort(self, jobid, reason, code):
+        self._event('abort', jobid, reason=reason, code=code)
@@ -3,7 +3,8 @@ import sqlite3
 import calendar
 import datetime
 import time
-import re
+import contextlib
+import collections
 
 import qtask.monitor
 
@@ -13,17 +14,80 @@ def _now_ts():
 def _ts_to_datetime(ts):
     return datetime.datetime.fromtimestamp(ts)
 
+# Schema changes, applied in order to new and existing databases.
+# ("PRAGMA user_version" is the number of changes that have been applied)
+_MIGRATIONS = [
+    [
+        'CREATE INDEX IF NOT EXISTS jobs_jobid ON jobs (jobid)',
+        'CREATE INDEX IF NOT EXISTS job_deps_parentid ON job_deps (parentid)',
+        'CREATE INDEX IF NOT EXISTS job_deps_jobid ON job_deps (jobid)',
+    ],
+    [
+        # job status, so that it can be indexed (see STATUSES)
+        'ALTER TABLE jobs ADD COLUMN status TEXT',
+        '''UPDATE jobs SET status = CASE
+    WHEN abort_time IS NOT NULL THEN 'aborted'
+    WHEN stop_time IS NOT NULL AND retcode = 0 THEN 'done'
+    WHEN stop_time IS NOT NULL THEN 'failed'
+    WHEN start_time IS NOT NULL THEN 'running'
+    ELSE 'pending' END''',
+        'CREATE INDEX IF NOT EXISTS jobs_project ON jobs (project, sample)',
+        'CREATE INDEX IF NOT EXISTS jobs_sample ON jobs (sample)',
+        'CREATE INDEX IF NOT EXISTS jobs_run ON jobs (run, status)',
+        'CREATE INDEX IF NOT EXISTS jobs_name ON jobs (name)',
+        'CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)',
+    ],
+    [
+        # content hash of the task (for incremental re-runs)
+        'ALTER TABLE jobs ADD COLUMN task_hash TEXT',
+        'CREATE INDEX IF NOT EXISTS jobs_task_hash ON jobs (task_hash, status)',
+    ],
+    [
+        # resource usage (see qtask.monitor.RUSAGE_COLUMNS)
+        'ALTER TABLE jobs ADD COLUMN max_rss INTEGER',
+        'ALTER TABLE jobs ADD COLUMN cpu_user REAL',
+        'ALTER TABLE jobs ADD COLUMN cpu_sys REAL',
+        'ALTER TABLE jobs ADD COLUMN io_read INTEGER',
+        'ALTER TABLE jobs ADD COLUMN io_write INTEGER',
+    ],
+]
+
+def _base_jobid(col):
+    'SQL for the job id of an array/fused task row (jobid.N), NULL for other rows'
+    return "CASE WHEN rtrim(%s, '0123456789') LIKE '%%_.' AND rtrim(%s, '0123456789') != %s THEN substr(%s, 1, length(rtrim(%s, '0123456789')) - 1) END" % (col, col, col, col, col)
+
+# All of the jobs that depend on a job (directly or indirectly). Dependencies
+# on array and fused jobs are recorded against the job id, but each of their
+# tasks has its own row (jobid.N), so the search continues from the job id.
+_CHILDREN = '''
+WITH RECURSIVE children (jobid) AS (
+    SELECT jobid FROM job_deps WHERE parentid = :jobid OR parentid = %s
+    UNION
+    SELECT job_deps.jobid FROM job_deps JOIN children ON job_deps.parentid = children.jobid OR job_deps.parentid = %s
+)
+''' % (_base_jobid(':jobid'), _base_jobid('children.jobid'))
+
+# all columns, except for the (possibly large) src, stdout, and stderr
+FIND_COLUMNS = ['jobid', 'project', 'sample', 'run', 'name', 'procs', 'hostname', 'status', 'retcode', 'submit_time', 'start_time', 'stop_time', 'abort_time', 'abort_code', 'aborted_by', 'task_hash'] + qtask.monitor.RUSAGE_COLUMNS
+BLOB_COLUMNS = ['src', 'stdout', 'stderr']
+
 
 class SqliteMonitor(qtask.monitor.Monitor):
     def __init__(self, path):
         self.path = path
         self.lock = qtask.monitor.Lock(self.path)
         self.conn = None
+        self._batch_size = 0
+        self._pending_jobs = []
+        self._pending_deps = []
+
+        # depth of nested transaction() blocks
+        self._txn = 0
 
         if not os.path.exists(self.path):
-            conn = sqlite3.connect(self.path)
-            conn.execute('''
-CREATE TABLE jobs (
+            with self.transaction():
+                self.conn.execute('''
+CREATE TABLE IF NOT EXISTS jobs (
     jobid TEXT,
     project TEXT,
     sample TEXT,
@@ -43,100 +107,314 @@ CREATE TABLE jobs (
     stderr BLOB
 );
 ''')
-            conn.execute('''
-CREATE TABLE job_deps (
+                self.conn.execute('''
+CREATE TABLE IF NOT EXISTS job_deps (
     jobid TEXT,
     parentid TEXT
 );
 ''')
-            conn.commit()
-            conn.close()
+
+        self._migrate()
+
+    def _migrate(self):
+        self.connect()
+        if self.conn.execute('PRAGMA user_version').fetchone()[0] >= len(_MIGRATIONS):
+            return
+
+        with self.transaction() as conn:
+            # check again, now that we have the lock
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            for stmts in _MIGRATIONS[version:]:
+                for sql in stmts:
+                    conn.execute(sql)
+            conn.execute('PRAGMA user_version = %d' % len(_MIGRATIONS))
 
     def connect(self):
         if not self.conn:
-            self.lock.acquire()
-            self.conn = sqlite3.connect(self.path)
+            # the busy timeout covers anyone writing without our lock
+            self.conn = sqlite3.connect(self.path, timeout=60)
+            # (long statements keep the lock from looking stale)
+            self.conn.set_progress_handler(self._progress, 100000)
+
+    def _progress(self):
+        if self._txn:
+            self.lock.refresh()
+        return 0
 
     def close(self):
+        self.flush()
         if self.conn:
             self.conn.close()
+            self.conn = None
+
+    @contextlib.contextmanager
+    def transaction(self):
+        '''
+        Holds the lock (and an open transaction) for the duration of the block.
+        The lock is only held while writing, so that many jobs can update the
+        database at once. Nested blocks are part of the outer transaction.
+        '''
+        if self._txn:
+            self.lock.refresh()
+            self._txn += 1
+            try:
+                yield self.conn
+            finally:
+                self._txn -= 1
+            return
+
+        self.lock.acquire()
+        try:
+            self.connect()
+            self._txn = 1
+            try:
+                yield self.conn
+                self.conn.commit()
+            except:
+                self.conn.rollback()
+                raise
+        finally:
+            self._txn = 0
             self.lock.release()
 
+    def stats(self):
+        return {'lock_acquired': self.lock.acquired, 'lock_wait': self.lock.wait_time, 'lock_max_wait': self.lock.max_wait, 'lock_broken': self.lock.broken}
+
+    def begin_batch(self, size=1000):
+        self._batch_size = size
+
+    def end_batch(self):
+        self.flush()
+        self._batch_size = 0
+
+    def flush(self):
+        'write any buffered submit() rows in a single transaction'
+        if not self._pending_jobs and not self._pending_deps:
+            return
+
+        # (taken first, so that rows that can't be written aren't tried again
+        # with every later write)
+        jobs = self._pending_jobs
+        deps = self._pending_deps
+        self._pending_jobs = []
+        self._pending_deps = []
+
+        with self.transaction() as conn:
+            # a job is only added once for each run (events can be sent again, ex:
+            # spooled by a client that timed out), job ids can be reused by later runs
+            seen = set()
+            jobids = list(set([job[0] for job in jobs]))
+            for i in xrange(0, len(jobids), 500):
+                batch = jobids[i:i + 500]
+                seen.update(conn.execute('SELECT jobid, run FROM jobs WHERE jobid IN (%s)' % ','.join(['?'] * len(batch)), batch).fetchall())
+
+            new_jobs = []
+            for job in jobs:
+                if (job[0], job[3]) not in seen:
+                    seen.add((job[0], job[3]))
+                    new_jobs.append(job)
+
+            if len(new_jobs) < len(jobs):
+                # (and their dependencies, once)
+                added = set([job[0] for job in new_jobs])
+                deps = [dep for dep in collections.OrderedDict.fromkeys(deps) if dep[0] in added]
+
+            conn.executemany("INSERT INTO jobs (jobid, project, sample, run, name, procs, submit_time, src, task_hash, abort_code, status) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 0, 'pending')", new_jobs)
+            conn.executemany('INSERT INTO job_deps (jobid, parentid) VALUES (?,?)', deps)
+
     def execute(self, sql, args=None):
-        self.connect()
-        self.conn.execute(sql, args)
-        self.conn.commit()
+        # keep writes in order
+        self.flush()
+
+        with self.transaction() as conn:
+            conn.execute(sql, args)
 
     def query(self, sql, args=None):
+        '''
+        Reads don't take the lock (sqlite's own locking keeps them consistent),
+        so they aren't held up by running jobs writing to the database.
+        Inside a transaction, they are part of it.
+        '''
         self.connect()
 
         cur = self.conn.cursor()
-        cur.execute(sql, args)
-        for row in cur:
-            yield row
+        cur.execute(sql, args or [])
+        rows = cur.fetchall()
         cur.close()
 
-    def submit(self, jobid, jobname, src, procs=1, deps=[], project=None, sample=None, run=None):
-        self.execute('INSERT INTO jobs (jobid, project, sample, run, name, procs, submit_time, src, abort_code) VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0)', (jobid, project, sample, run, jobname, procs, _now_ts(), src))
+        return rows
+
+    def submit(self, jobid, jobname, src, procs=1, deps=[], project=None, sample=None, run=None, task_hash=None, ts=None):
+        self._pending_jobs.append((jobid, project, sample, run, jobname, procs, ts or _now_ts(), src, task_hash))
         for d in deps:
-            self.execute('INSERT INTO job_deps (jobid, parentid) VALUES (?,?)', (jobid, d))
+            self._pending_deps.append((jobid, d))
 
-    def start(self, jobid, hostname=None):
-        self.execute('UPDATE jobs SET hostname = ?, start_time = ? WHERE jobid = ?', (hostname, _now_ts(), jobid))
+        if len(self._pending_jobs) >= self._batch_size:
+            self.flush()
 
-    def stop(self, jobid, retcode, stdout=None, stderr=None):
-        self.execute('UPDATE jobs SET retcode = ?, stop_time = ? WHERE jobid = ?', (retcode, _now_ts(), jobid))
+    def start(self, jobid, hostname=None, ts=None):
+        self.execute("UPDATE jobs SET hostname = ?, start_time = ?, status = CASE WHEN status = 'pending' THEN 'running' ELSE status END WHERE jobid = ?", (hostname, ts or _now_ts(), jobid))
 
-        if stdout:
-            self.stdout(jobid, stdout)
+    def stop(self, jobid, retcode, stdout=None, stderr=None, rusage=None, ts=None):
+        # read the output files before taking the lock
+        self.record_stop(jobid, retcode, qtask.monitor.read_stdout(stdout) if stdout else None, qtask.monitor.read_stderr(stderr) if stderr else None, ts, qtask.monitor.read_rusage(rusage))
 
-        if stderr:
-            self.stderr(jobid, stderr)
+    def record_stop(self, jobid, retcode, stdout_z=None, stderr_z=None, ts=None, usage=None):
+        '''
+        same as stop(), but the output is given as compressed data (see
+        qtask.monitor.capture_output), and the resource usage as a dict
+        '''
+        with self.transaction():
+            if usage:
+                cols = [k for k in qtask.monitor.RUSAGE_COLUMNS if k in usage]
+                self.execute('UPDATE jobs SET %s WHERE jobid = ?' % ', '.join(['%s = ?' % k for k in cols]), [usage[k] for k in cols] + [jobid])
+            # (a job marked as lost that finishes after all is recorded normally)
+            self.execute("UPDATE jobs SET retcode = ?, stop_time = ?, status = CASE WHEN status = 'aborted' AND COALESCE(abort_code, 0) != 3 THEN status WHEN ? = 0 THEN 'done' ELSE 'failed' END WHERE jobid = ?", (retcode, ts or _now_ts(), retcode, jobid))
+            self.record_output(jobid, stdout_z, stderr_z)
 
-    def stdout(self, jobid, stdout):
-        stdout_s = ''
-        if stdout and os.path.exists(stdout):
-            with open(stdout) as f:
-                stdout_s = f.read()
+    def record_output(self, jobid, stdout_z=None, stderr_z=None):
+        with self.transaction():
+            if stdout_z is not None:
+                self.execute('UPDATE jobs SET stdout = ? WHERE jobid = ?', (sqlite3.Binary(stdout_z), jobid))
 
-        self.execute('UPDATE jobs SET stdout = ? WHERE jobid = ?', (stdout_s, jobid))
+            if stderr_z is not None:
+                self.execute('UPDATE jobs SET stderr = ? WHERE jobid = ?', (sqlite3.Binary(stderr_z), jobid))
+
+    def stdout(self, jobid, stdout):
+        self.record_output(jobid, stdout_z=qtask.monitor.read_stdout(stdout))
 
     def stderr(self, jobid, stderr, conn=None):
-        stderr_s = ''
-        if stderr and os.path.exists(stderr):
-            with open(stderr) as f:
-                # the regex removes any progress bars
-                stderr_s = re.sub('(.*)\r(.*?)\r','\\2',f.read())
+        self.record_output(jobid, stderr_z=qtask.monitor.read_stderr(stderr))
+
+    def output(self, jobid, stream='stdout'):
+        if stream not in ['stdout', 'stderr']:
+            raise ValueError('Unknown output stream: %s' % stream)
 
-        self.execute('UPDATE jobs SET stderr = ? WHERE jobid = ?', (stderr_s, jobid))
+        for row in self.query('SELECT %s FROM jobs WHERE jobid = ?' % stream, (jobid, )):
+            for chunk in qtask.monitor.iter_output(row[0]):
+                yield chunk
 
-    def signal(self, jobid, sig):
-        self.abort(jobid, sig, 2)
-        self.killdeps(jobid)
+    def signal(self, jobid, sig, ts=None):
+        '''
+        For a fused job, the tasks that hadn't finished (jobid.N) are aborted:
+        the running one by the signal, the rest by the job.
+        '''
+        with self.transaction():
+            ts = ts or _now_ts()
+            self.abort(jobid, sig, 2, ts)
+            # (jobid.N sorts between "jobid." and "jobid/", so the index is used)
+            self.execute("""UPDATE jobs SET abort_code = CASE WHEN status = 'running' THEN 2 ELSE 1 END, aborted_by = CASE WHEN status = 'running' THEN :sig ELSE :jobid END, abort_time = :ts, status = 'aborted'
+WHERE jobid > :jobid || '.' AND jobid < :jobid || '/' AND status IN ('pending', 'running')""", {'jobid': jobid, 'sig': sig, 'ts': ts})
+            self.killdeps(jobid, ts)
 
-    def killdeps(self, jobid):
-        children = set()
-        for cid in self._find_children(jobid):
-            children.add(cid)
+    def killdeps(self, jobid, ts=None):
+        '''
+        Aborts all descendants that are still pending or running (finished
+        jobs keep their status) at once, and returns them (so that concurrent
+        calls don't return the same jobs twice).
+        '''
+        with self.transaction():
+            active = [row[0] for row in self.query(_CHILDREN + "SELECT jobid FROM jobs WHERE jobid IN (SELECT jobid FROM children) AND status IN ('pending', 'running')", {'jobid': jobid})]
+            self.execute(_CHILDREN + "UPDATE jobs SET abort_code = 1, aborted_by = :jobid, abort_time = :ts, status = 'aborted' WHERE jobid IN (SELECT jobid FROM children) AND status IN ('pending', 'running')", {'jobid': jobid, 'ts': ts or _now_ts()})
+        return active
 
-        for cid in children:
-            self.abort(cid, jobid, 1)
+    def qdeldeps(self, jobid, ts=None):
+        return self.killdeps(jobid, ts)
 
     def _find_children(self, jobid):
-        for row in self.query('SELECT jobid FROM job_deps WHERE parentid = ?', (jobid, )):
-            childid = row[0]
-            for cid in self._find_children(childid):
-                yield cid
-            yield childid
+        'returns the ids of all jobs that depend on this job (directly or indirectly)'
+        return [row[0] for row in self.query(_CHILDREN + 'SELECT jobid FROM children', {'jobid': jobid})]
 
-    def abort(self, jobid, reason, code):
+    def abort(self, jobid, reason, code, ts=None):
         '''
         codes:
             0 - error during submission
             1 - error with parent
             2 - got killed by SGE/job scheduler
+            3 - lost (the job scheduler dropped it, see reconcile())
         '''
-        self.execute('UPDATE jobs SET abort_code = ?, aborted_by = ?, abort_time = ? WHERE jobid = ?', (code, reason, _now_ts(), jobid))
+        self.execute("UPDATE jobs SET abort_code = ?, aborted_by = ?, abort_time = ?, status = 'aborted' WHERE jobid = ?", (code, reason, ts or _now_ts(), jobid))
+
+    def abort_jobs(self, jobids, reason, code, ts=None):
+        with self.transaction() as conn:
+            # (along with any buffered submit() rows)
+            self.flush()
+            ts = ts or _now_ts()
+            conn.executemany("UPDATE jobs SET abort_code = ?, aborted_by = ?, abort_time = ?, status = 'aborted' WHERE jobid = ?", [(code, reason, ts, jobid) for jobid in jobids])
+
+    def find(self, project=None, sample=None, jobname=None, jobid=None, run=None, status=None, columns=None, limit=None, offset=0):
+        if columns:
+            for col in columns:
+                if col not in FIND_COLUMNS and col not in BLOB_COLUMNS:
+                    raise ValueError('Unknown column: %s' % col)
+        else:
+            columns = FIND_COLUMNS
+
+        where = []
+        args = []
+        for col, val in [('project', project), ('sample', sample), ('name', jobname), ('jobid', jobid), ('run', run), ('status', status)]:
+            if val is not None:
+                where.append('%s = ?' % col)
+                args.append(val)
+
+        sql = 'SELECT %s FROM jobs' % ', '.join(columns)
+        if where:
+            sql += ' WHERE %s' % ' AND '.join(where)
+        sql += ' ORDER BY rowid'
+        if limit:
+            sql += ' LIMIT ? OFFSET ?'
+            args.extend([limit, offset])
+
+        return [dict(zip(columns, row)) for row in self.query(sql, args)]
+
+    def completed(self, task_hashes):
+        done = set()
+        task_hashes = list(task_hashes)
+
+        # (sqlite limits the number of variables in a query)
+        for i in xrange(0, len(task_hashes), 500):
+            chunk = task_hashes[i:i + 500]
+            for row in self.query("SELECT DISTINCT task_hash FROM jobs WHERE status = 'done' AND task_hash IN (%s)" % ','.join(['?'] * len(chunk)), chunk):
+                done.add(row[0])
+
+        return done
+
+    def history(self, jobnames, limit=20):
+        hist = {}
+        jobnames = list(jobnames)
+        cols = ['name', 'stop_time - start_time', 'procs'] + qtask.monitor.RUSAGE_COLUMNS
+        for i in xrange(0, len(jobnames), 500):
+            chunk = jobnames[i:i + 500]
+            # (newest first)
+            for row in self.query("SELECT %s FROM jobs WHERE status = 'done' AND start_time IS NOT NULL AND name IN (%s) ORDER BY rowid DESC" % (', '.join(cols), ','.join(['?'] * len(chunk))), chunk):
+                runs = hist.setdefault(row[0], [])
+                if len(runs) < limit:
+                    runs.append(dict(zip(['secs', 'procs'] + qtask.monitor.RUSAGE_COLUMNS, row[1:])))
+        return hist
+
+    def summary(self, project=None, sample=None, run=None):
+        where = []
+        args = []
+        for col, val in [('project', project), ('sample', sample), ('run', run)]:
+            if val is not None:
+                where.append('%s = ?' % col)
+                args.append(val)
+
+        sql = 'SELECT run, status, COUNT(*), MIN(project), MIN(submit_time) FROM jobs'
+        if where:
+            sql += ' WHERE %s' % ' AND '.join(where)
+        sql += ' GROUP BY run, status'
+
+        runs = {}
+        for run, status, count, project, submit_time in self.query(sql, args):
+            if run not in runs:
+                runs[run] = {'run': run, 'project': project, 'submit_time': submit_time}
+                for st in qtask.monitor.STATUSES:
+                    runs[run][st] = 0
+            runs[run][status] = count
+            if runs[run]['project'] is None:
+                runs[run]['project'] = project
+            if submit_time is not None and (runs[run]['submit_time'] is None or submit_time < runs[run]['submit_time']):
+                runs[run]['submit_time'] = submit_time
 
-    def find(self, project=None, sample=None, jobname=None, jobid=None):
-        raise NotImplementedError
+        return sorted(runs.values(), key=lambda x: x['submit_time'])
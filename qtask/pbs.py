@@ -1,14 +1,249 @@
 import subprocess
+import sys
+import re
+
 import qtask
 
+# qstat job_state -> job_states() state
+STATES = {'Q': 'pending', 'W': 'pending', 'T': 'pending', 'H': 'held', 'R': 'running', 'E': 'running', 'S': 'suspended', 'C': 'done'}
+
+
 class PBS(qtask.JobRunner):
-    def __init__(self, *args, **kwargs):
-        self.dry_run_cur_jobid = 1
+    '''
+    PBS/Torque runner.
+
+    Torque removes jobs whose "afterok" dependencies can't be met, so jobs
+    that depend on a failed job are removed by the server (unlike SGE, where
+    the job script has to qdel its successors).
+    '''
+    supports_array = True
+    jobid_var = '$PBS_JOBID'
+    priority_range = (-1024, 1023)
+    job_prefix = 'pbsjob_'
 
+    def __init__(self, account=None, tmpdir='/tmp', *args, **kwargs):
+        self.dry_run_cur_jobid = 1
+        self.account = account
+        self.tmpdir = tmpdir
         qtask.JobRunner.__init__(self, *args, **kwargs)
 
+    def _mem(self, val, procs=1):
+        # qtask mem values are per processor (SGE h_vmem), PBS mem is for the job
+        mb = (qtask._mem_bytes(val) * procs + (1024 * 1024) - 1) / (1024 * 1024)
+        return '%smb' % mb
+
+    def qsub(self, task, monitor, dryrun=False):
+        if task.array:
+            # each array task is tracked separately by the monitor (as jobid[].N)
+            jobvar = '$QTASK_JOB_ID.$PBS_ARRAYID'
+        else:
+            jobvar = '$PBS_JOBID'
+
+        src = '#!/bin/bash\n'
+        src += '#PBS -S /bin/bash\n'
+        src += '#PBS -N %s\n' % self.job_name(task)
+
+        if 'holding' in task.resources:
+            src += '#PBS -h\n'
+
+        if task.array:
+            if 'tc' in task.resources:
+                src += '#PBS -t 1-%s%%%s\n' % (len(task.array), task.resources['tc'])
+            else:
+                src += '#PBS -t 1-%s\n' % len(task.array)
+
+        if 'env' in task.resources:
+            src += '#PBS -V\n'
+
+        if 'walltime' in task.resources:
+            src += '#PBS -l walltime=%s\n' % self._calc_time(task.resources['walltime'])
+
+        procs = int(task.resources['ppn']) if 'ppn' in task.resources else 1
+        if 'ppn' in task.resources:
+            src += '#PBS -l nodes=1:ppn=%s\n' % procs
+
+        if 'mem' in task.resources:
+            src += '#PBS -l mem=%s\n' % self._mem(task.resources['mem'], procs)
+
+        if task.depends or 'depends' in task.resources:
+            depids = [t.jobid for t in task.depends if t.jobid]
+            if 'depends' in task.resources:
+                depids.extend(task.resources['depends'].split(','))
+
+            if depids:
+                jobs = []
+                arrays = []
+                for depid in depids:
+                    if depid not in jobs and depid not in arrays:
+                        if '[]' in depid:
+                            arrays.append(depid)
+                        else:
+                            jobs.append(depid)
+
+                deps = []
+                if jobs:
+                    deps.append('afterok:%s' % ':'.join(jobs))
+                if arrays:
+                    deps.append('afterokarray:%s' % ':'.join(arrays))
+                src += '#PBS -W depend=%s\n' % ','.join(deps)
+
+        if 'priority' in task.resources:
+            src += '#PBS -p %s\n' % task.resources['priority']
+
+        if 'qos' in task.resources:
+            src += '#PBS -l qos=%s\n' % task.resources['qos']
+
+        if 'queue' in task.resources:
+            src += '#PBS -q %s\n' % task.resources['queue']
+
+        if 'mail' in task.resources:
+            src += '#PBS -m %s\n' % task.resources['mail']
+
+        if 'wd' in task.resources:
+            src += '#PBS -d %s\n' % task.resources['wd']
+
+        if 'account' in task.resources and task.resources['account']:
+            src += '#PBS -A %s\n' % task.resources['account']
+        elif self.account:
+            src += '#PBS -A %s\n' % self.account
+
+        if monitor or task.array:
+            # array task output is redirected by the script (paths may use $QTASK_INPUT)
+            src += '#PBS -o /dev/null\n'
+            src += '#PBS -e /dev/null\n'
+        else:
+            if 'stdout' in task.resources:
+                src += '#PBS -o %s\n' % task.resources['stdout']
+
+            if 'stderr' in task.resources:
+                src += '#PBS -e %s\n' % task.resources['stderr']
+
+        src += 'FAILED=""\n'
+        src += 'TMPDIR="${TMPDIR:-%s}"\n' % self.tmpdir
+
+        if task.array:
+            # $PBS_JOBID is "jobid[N].server", qsub returned "jobid[].server"
+            src += 'QTASK_JOB_ID="${PBS_JOBID/\\[$PBS_ARRAYID\\]/[]}"\n'
+            src += 'QTASK_INPUT="$(sed -n "${PBS_ARRAYID}p" "%s")"\n' % task.array_index
+            src += 'QTASK_INPUT_BASE="${QTASK_INPUT##*/}"\n'
+            src += 'export QTASK_INPUT QTASK_INPUT_BASE\n'
+
+        # qdel and walltime limits send SIGTERM (followed by SIGKILL)
+        src += 'notify_kill() {\n'
+        src += '  FAILED="1"\n'
+        if monitor:
+            src += '  "%s" "%s" signal %s "SIGTERM"\n' % (qtask.QTASK_MON, monitor, jobvar)
+            src += '  "%s" "%s" killdeps %s\n' % (qtask.QTASK_MON, monitor, '$QTASK_JOB_ID' if task.array else '$PBS_JOBID')
+        elif task.fused and task.resources.get('monitor'):
+            # fused tasks report to the monitor themselves (this aborts the
+            # unfinished ones, jobid.N)
+            src += '  "%s" "%s" signal %s "SIGTERM"\n' % (qtask.QTASK_MON, task.resources['monitor'], jobvar)
+        src += '}\n'
+        src += 'trap notify_kill SIGTERM\n'
+
+        src += 'set -o pipefail\nfunc () {\n  %s\n  return $?\n}\n' % task.cmd
+
+        if monitor:
+            src += '"%s" "%s" start %s $HOSTNAME\n' % (qtask.QTASK_MON, monitor, jobvar)
+            src += '%s 2>"$TMPDIR/%s.qtask.stderr" >"$TMPDIR/%s.qtask.stdout"\n' % (qtask._measured(task, 'func', '$TMPDIR/%s.qtask.rusage' % jobvar), jobvar, jobvar)
+            src += 'RETVAL=$?\n'
+            src += 'if [ "$FAILED" == "" ]; then\n'
+            src += '  "%s" "%s" stop %s $RETVAL "$TMPDIR/%s.qtask.stdout" "$TMPDIR/%s.qtask.stderr" "$TMPDIR/%s.qtask.rusage"\n' % (qtask.QTASK_MON, monitor, jobvar, jobvar, jobvar, jobvar)
+            if task.measured:
+                src += '  rm -f "$TMPDIR/%s.qtask.rusage"\n' % jobvar
+            if 'stdout' in task.resources:
+                src += '  mv "$TMPDIR/%s.qtask.stdout" "%s"\n' % (jobvar, task.resources['stdout'])
+            else:
+                src += '  rm "$TMPDIR/%s.qtask.stdout"\n' % jobvar
+
+            if 'stderr' in task.resources:
+                src += '  mv "$TMPDIR/%s.qtask.stderr" "%s"\n' % (jobvar, task.resources['stderr'])
+            else:
+                src += '  rm "$TMPDIR/%s.qtask.stderr"\n' % jobvar
+
+            src += '  if [ $RETVAL -ne 0 ]; then\n'
+            src += '    "%s" "%s" killdeps %s\n' % (qtask.QTASK_MON, monitor, '$QTASK_JOB_ID' if task.array else '$PBS_JOBID')
+            src += '  fi\n'
+            src += 'fi\n'
+        elif task.array:
+            src += 'func'
+            if 'stdout' in task.resources:
+                src += ' >"%s"' % task.resources['stdout']
+            if 'stderr' in task.resources:
+                src += ' 2>"%s"' % task.resources['stderr']
+            src += '\n'
+            src += 'RETVAL=$?\n'
+        else:
+            src += 'func\n'
+            src += 'RETVAL=$?\n'
+
+        src += 'exit $RETVAL\n'
+
+        if not dryrun:
+            proc = subprocess.Popen(["qsub", ], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            output = proc.communicate(src)[0]
+            retval = proc.wait()
+
+            if retval != 0:
+                sys.stderr.write('Error submitting job %s: %s\n' % (task.name, output))
+                sys.stderr.write(src)
+                sys.stderr.write('\n')
+                raise RuntimeError(output)
+
+            # array jobs are returned as "jobid[].server"
+            return output.strip(), src
+
+        jobid = str(self.dry_run_cur_jobid)
+        self.dry_run_cur_jobid += 1
+        if task.array:
+            return 'dryrun.%s[]' % jobid, src
+        return 'dryrun.%s' % jobid, src
+
     def qdel(self, *jobid):
-        subprocess.call(["qdel", ' '.join([str(x) for x in jobid])])
+        for batch in self._batches(jobid):
+            subprocess.call(["qdel"] + batch)
 
     def qrls(self, *jobid):
-        subprocess.call(["qrls", ' '.join([str(x) for x in jobid])])
+        for batch in self._batches(jobid):
+            subprocess.call(["qrls"] + batch)
+
+    def job_states(self):
+        '''
+        Torque lists finished jobs (state C, with their exit status) for
+        "keep_completed" seconds, so this also covers job_accounting().
+        '''
+        import getpass
+        import xml.etree.ElementTree as ET
+
+        # ("qstat -u" doesn't support -x, so the owner is checked here)
+        proc = subprocess.Popen(["qstat", "-x", "-t"], stdout=subprocess.PIPE)
+        output = proc.communicate()[0]
+        if proc.wait() != 0:
+            raise RuntimeError('Error running qstat')
+
+        owner = '%s@' % getpass.getuser()
+        states = {}
+        if not output.strip():
+            return states
+
+        for job in ET.fromstring(output).iter('Job'):
+            if not (job.findtext('Job_Owner') or '').startswith(owner):
+                continue
+
+            jobid = job.findtext('Job_Id')
+            if '[]' in jobid:
+                # the array job (its tasks are listed separately)
+                continue
+
+            m = re.match(r'^(.*)\[(\d+)\](.*)$', jobid)
+            if m:
+                # array tasks are "jobid[N].server", monitor rows are "jobid[].server.N"
+                jobid = '%s[]%s.%s' % (m.group(1), m.group(3), m.group(2))
+
+            code = job.findtext('job_state')
+            info = {'state': STATES.get(code, 'pending'), 'name': job.findtext('Job_Name')}
+            if code == 'C' and job.findtext('exit_status') is not None:
+                info['exit_status'] = int(job.findtext('exit_status'))
+            states[jobid] = info
+
+        return states
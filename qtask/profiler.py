@@ -0,0 +1,183 @@
+'''
+Submission profiler (enabled with QTASK_PROFILE=1 or submit(profile=True)).
+
+Records the wall time of each submission phase, the latency of individual
+calls (qsub, monitor writes, etc), and every subprocess that is started. A
+summary is written to stderr once the pipeline has been submitted and, if
+"profile_json" is set ($QTASK_PROFILE_JSON), to a JSON file.
+'''
+import os
+import sys
+import math
+import time
+import contextlib
+
+_active = None
+
+
+def current():
+    'returns the running profiler (or None)'
+    return _active
+
+
+def start():
+    global _active
+    if not _active:
+        _active = Profiler()
+        _active.install()
+    return _active
+
+
+def stop():
+    'stops (and returns) the running profiler'
+    global _active
+    prof = _active
+    _active = None
+    if prof:
+        prof.uninstall()
+    return prof
+
+
+def _prog_name(args, shell=False):
+    if isinstance(args, basestring):
+        args = args.split() if shell else [args]
+    if not args:
+        return '?'
+    return os.path.basename(str(args[0]))
+
+
+def _stats(vals):
+    vals = sorted(vals)
+    if not vals:
+        return {'count': 0, 'total': 0.0, 'mean': 0.0, 'p50': 0.0, 'p95': 0.0, 'max': 0.0}
+
+    def pct(p):
+        # nearest rank
+        return vals[max(0, int(math.ceil(p / 100.0 * len(vals))) - 1)]
+
+    total = sum(vals)
+    return {'count': len(vals), 'total': total, 'mean': total / len(vals), 'p50': pct(50), 'p95': pct(95), 'max': vals[-1]}
+
+
+class Profiler(object):
+    def __init__(self):
+        # imported here so that "import qtask" stays light
+        import threading
+        self._lock = threading.Lock()
+        self.start_time = time.time()
+        self.phases = []        # [name, secs] (in the order they first ran)
+        self.calls = {}         # name -> [secs, ...]
+        self.subprocesses = {}  # program -> [secs, ...] (until it was waited on)
+        self.forks = 0
+        self.counters = {}
+        self._popen = None
+
+    def install(self):
+        'counts (and times) every subprocess.Popen'
+        import subprocess
+        if self._popen:
+            return
+
+        prof = self
+        orig = subprocess.Popen
+
+        class _Popen(orig):
+            def __init__(self, args, *a, **kwargs):
+                self._qtask_prog = _prog_name(args, kwargs.get('shell'))
+                self._qtask_start = time.time()
+                self._qtask_timed = False
+                orig.__init__(self, args, *a, **kwargs)
+                with prof._lock:
+                    prof.forks += 1
+
+            def wait(self):
+                ret = orig.wait(self)
+                if not self._qtask_timed:
+                    self._qtask_timed = True
+                    with prof._lock:
+                        prof.subprocesses.setdefault(self._qtask_prog, []).append(time.time() - self._qtask_start)
+                return ret
+
+        self._popen = orig
+        subprocess.Popen = _Popen
+
+    def uninstall(self):
+        if self._popen:
+            import subprocess
+            subprocess.Popen = self._popen
+            self._popen = None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.time() - start)
+
+    def add_phase(self, name, secs):
+        with self._lock:
+            for phase in self.phases:
+                if phase[0] == name:
+                    phase[1] += secs
+                    return
+            self.phases.append([name, secs])
+
+    @contextlib.contextmanager
+    def timed(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, time.time() - start)
+
+    def record(self, name, secs):
+        with self._lock:
+            self.calls.setdefault(name, []).append(secs)
+
+    def add_counters(self, prefix, counters):
+        with self._lock:
+            for k in counters:
+                self.counters['%s.%s' % (prefix, k)] = counters[k]
+
+    def summary(self):
+        with self._lock:
+            subprocesses = {}
+            for prog in self.subprocesses:
+                subprocesses[prog] = _stats(self.subprocesses[prog])
+
+            return {
+                'total': time.time() - self.start_time,
+                'phases': [{'name': name, 'secs': secs} for name, secs in self.phases],
+                'calls': dict([(name, _stats(vals)) for name, vals in self.calls.items()]),
+                'subprocesses': subprocesses,
+                'forks': self.forks,
+                'counters': dict(self.counters),
+            }
+
+    def report(self, out=sys.stderr):
+        summary = self.summary()
+        out.write('qtask profile: %.3f sec, %s subprocess(es)\n' % (summary['total'], summary['forks']))
+
+        if summary['phases']:
+            out.write('  %-24s %8s\n' % ('phase', 'sec'))
+            for phase in summary['phases']:
+                out.write('  %-24s %8.3f\n' % (phase['name'], phase['secs']))
+
+        for title, stats in [('call', summary['calls']), ('subprocess', summary['subprocesses'])]:
+            if not stats:
+                continue
+            out.write('  %-24s %8s %8s %8s %8s %8s\n' % (title, 'count', 'total', 'p50', 'p95', 'max'))
+            for name in sorted(stats):
+                s = stats[name]
+                out.write('  %-24s %8s %8.3f %8.4f %8.4f %8.4f\n' % (name, s['count'], s['total'], s['p50'], s['p95'], s['max']))
+
+        for k in sorted(summary['counters']):
+            val = summary['counters'][k]
+            out.write('  %-24s %s\n' % (k, '%.4f' % val if type(val) == float else val))
+
+    def write_json(self, path):
+        import json
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2, sort_keys=True)
+            f.write('\n')
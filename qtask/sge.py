@@ -1,28 +1,63 @@
 import subprocess
 import sys
-import string
 
 import qtask
 
 
 class SGE(qtask.JobRunner):
-    def __init__(self, parallelenv='shm', account=None, tmpdir='/tmp', *args, **kwargs):
+    '''
+    SGE/OGE runner.
+
+    SGE releases the jobs that depend on a job when it finishes, even if it
+    failed, so a failed job has to remove its successors. By default, they
+    are found with "qstat -f -j". With kill_deps=monitor (runner.kill_deps in
+    ~/.qtaskrc), they are looked up in the job monitor instead (qtask-mon
+    qdeldeps), which removes each job once, with one qdel call. An http://
+    monitor sends these to the collector, which batches them.
+    '''
+    supports_array = True
+    jobid_var = '$JOB_ID'
+    priority_range = (-1023, 0)  # (users can only lower their priority)
+    job_prefix = 'sgejob_'
+    virtual_mem = True  # (h_vmem)
+
+    def __init__(self, parallelenv='shm', account=None, tmpdir='/tmp', kill_deps='qstat', *args, **kwargs):
         self.dry_run_cur_jobid = 1
         self.parallelenv = parallelenv
         self.account = account
         self.tmpdir = tmpdir
+        if kill_deps not in ['qstat', 'monitor']:
+            raise ValueError('Unknown kill_deps value: %s (valid: qstat, monitor)' % kill_deps)
+        self.qdel_deps = kill_deps == 'monitor'
         qtask.JobRunner.__init__(self, *args, **kwargs)
 
 
     def qsub(self, task, monitor, dryrun=False):
+        if task.array:
+            # each array task is tracked separately by the monitor
+            jobvar = '$JOB_ID.$SGE_TASK_ID'
+        else:
+            jobvar = '$JOB_ID'
+
+        # fused tasks report to the monitor themselves, but still use it to remove successors
+        fused_monitor = task.resources.get('monitor') if task.fused else None
+        qdel_monitor = None
+        if self.qdel_deps:
+            qdel_monitor = monitor or fused_monitor
+
         src = '#!/bin/bash\n'
         src += '#$ -w e\n'
         src += '#$ -terse\n'
-        src += '#$ -N %s\n' % (task.fullname if task.fullname[0] in string.ascii_letters else 'sgejob_%s' % task.fullname)
+        src += '#$ -N %s\n' % self.job_name(task)
 
         if 'holding' in task.resources:
             src += '#$ -h\n'
 
+        if task.array:
+            src += '#$ -t 1-%s\n' % len(task.array)
+            if 'tc' in task.resources:
+                src += '#$ -tc %s\n' % task.resources['tc']
+
         if 'env' in task.resources:
             src += '#$ -V\n'
 
@@ -46,6 +81,9 @@ class SGE(qtask.JobRunner):
             if depids:
                 src += '#$ -hold_jid %s\n' % ','.join(depids)
 
+        if 'priority' in task.resources:
+            src += '#$ -p %s\n' % task.resources['priority']
+
         if 'qos' in task.resources:
             src += '#$ -P %s\n' % task.resources['qos']
 
@@ -63,7 +101,8 @@ class SGE(qtask.JobRunner):
         elif self.account:
             src += '#$ -A %s\n' % self.account
 
-        if monitor:
+        if monitor or task.array:
+            # array task output is redirected by the script (paths may use $QTASK_INPUT)
             src += '#$ -o /dev/null\n'
             src += '#$ -e /dev/null\n'
         else:
@@ -82,34 +121,80 @@ class SGE(qtask.JobRunner):
         src += '  kill_deps\n'
 
         if monitor:
-            src += '  "%s" "%s" signal $JOB_ID "$1"\n' % (qtask.QTASK_MON, monitor)
+            src += '  "%s" "%s" signal %s "$1"\n' % (qtask.QTASK_MON, monitor, jobvar)
+            if task.array:
+                src += '  "%s" "%s" killdeps $JOB_ID\n' % (qtask.QTASK_MON, monitor)
+        elif fused_monitor:
+            # (aborts the job's unfinished tasks, jobid.N)
+            src += '  "%s" "%s" signal %s "$1"\n' % (qtask.QTASK_MON, fused_monitor, jobvar)
 
         src += '}\n'
 
-        src += 'kill_deps() {\n'
-        src += '  qdel $(qstat -f -j $JOB_ID | grep jid_successor_list | awk \'{print $2}\' | sed -e \'s/,/ /g\')\n'
-        src += '}\n'
+        if qdel_monitor:
+            # (all descendants, each removed once)
+            src += 'kill_deps() {\n'
+            src += '  "%s" "%s" qdeldeps $JOB_ID\n' % (qtask.QTASK_MON, qdel_monitor)
+            src += '}\n'
+        elif not [c for c in task.children if c.barrier]:
+            src += 'kill_deps() {\n'
+            src += '  qdel $(qstat -f -j $JOB_ID | grep jid_successor_list | awk \'{print $2}\' | sed -e \'s/,/ /g\')\n'
+            src += '}\n'
+        else:
+            # deleting a barrier job releases the jobs that wait on it, so
+            # everything after it is removed (one qstat for each job)
+            src += 'find_successors() {\n'
+            src += '  local j\n'
+            src += '  for j in $(qstat -f -j $1 2>/dev/null | grep jid_successor_list | awk \'{print $2}\' | sed -e \'s/,/ /g\'); do\n'
+            src += '    case " $SUCCESSORS " in\n'
+            src += '      *" $j "*) ;;\n'
+            src += '      *) SUCCESSORS="$SUCCESSORS $j"; find_successors $j ;;\n'
+            src += '    esac\n'
+            src += '  done\n'
+            src += '}\n'
+            src += 'kill_deps() {\n'
+            src += '  SUCCESSORS=""\n'
+            src += '  find_successors $JOB_ID\n'
+            src += '  if [ "$SUCCESSORS" != "" ]; then\n'
+            src += '    qdel $SUCCESSORS\n'
+            src += '  fi\n'
+            src += '}\n'
 
         src += 'trap notify_stop SIGUSR1\n'
         src += 'trap notify_kill SIGUSR2\n'
     
+        if task.array:
+            src += 'QTASK_INPUT="$(sed -n "${SGE_TASK_ID}p" "%s")"\n' % task.array_index
+            src += 'QTASK_INPUT_BASE="${QTASK_INPUT##*/}"\n'
+            src += 'export QTASK_INPUT QTASK_INPUT_BASE\n'
+
         src += 'set -o pipefail\nfunc () {\n  %s\n  return $?\n}\n' % task.cmd
 
         if monitor:
-            src += '"%s" "%s" start $JOB_ID $HOSTNAME\n' % (qtask.QTASK_MON, monitor)
-            src += 'func 2>"$TMPDIR/$JOB_ID.qtask.stderr" >"$TMPDIR/$JOB_ID.qtask.stdout"\n'
+            src += '"%s" "%s" start %s $HOSTNAME\n' % (qtask.QTASK_MON, monitor, jobvar)
+            src += '%s 2>"$TMPDIR/%s.qtask.stderr" >"$TMPDIR/%s.qtask.stdout"\n' % (qtask._measured(task, 'func', '$TMPDIR/%s.qtask.rusage' % jobvar), jobvar, jobvar)
             src += 'RETVAL=$?\n'
             src += 'if [ "$FAILED" == "" ]; then\n'
-            src += '  "%s" "%s" stop $JOB_ID $RETVAL "$TMPDIR/$JOB_ID.qtask.stdout" "$TMPDIR/$JOB_ID.qtask.stderr"\n' % (qtask.QTASK_MON, monitor)
+            src += '  "%s" "%s" stop %s $RETVAL "$TMPDIR/%s.qtask.stdout" "$TMPDIR/%s.qtask.stderr" "$TMPDIR/%s.qtask.rusage"\n' % (qtask.QTASK_MON, monitor, jobvar, jobvar, jobvar, jobvar)
+            if task.measured:
+                src += '  rm -f "$TMPDIR/%s.qtask.rusage"\n' % jobvar
             if 'stdout' in task.resources:
-                src += '  mv "$TMPDIR/$JOB_ID.qtask.stdout" "%s"\n' % task.resources['stdout']
+                src += '  mv "$TMPDIR/%s.qtask.stdout" "%s"\n' % (jobvar, task.resources['stdout'])
             else:
-                src += '  rm "$TMPDIR/$JOB_ID.qtask.stdout"\n'
+                src += '  rm "$TMPDIR/%s.qtask.stdout"\n' % jobvar
 
             if 'stderr' in task.resources:
-                src += '  mv "$TMPDIR/$JOB_ID.qtask.stderr" "%s"\n' % task.resources['stderr']
+                src += '  mv "$TMPDIR/%s.qtask.stderr" "%s"\n' % (jobvar, task.resources['stderr'])
             else:
-                src += '  rm "$TMPDIR/$JOB_ID.qtask.stderr"\n'
+                src += '  rm "$TMPDIR/%s.qtask.stderr"\n' % jobvar
+        elif task.array:
+            src += 'func'
+            if 'stdout' in task.resources:
+                src += ' >"%s"' % task.resources['stdout']
+            if 'stderr' in task.resources:
+                src += ' 2>"%s"' % task.resources['stderr']
+            src += '\n'
+            src += 'RETVAL=$?\n'
+            src += 'if [ "$FAILED" == "" ]; then\n'
         else:
             src += 'func\n'
             src += 'RETVAL=$?\n'
@@ -117,7 +202,7 @@ class SGE(qtask.JobRunner):
 
         src += '  if [ $RETVAL -ne 0 ]; then\n'
         src += '    kill_deps\n'
-        if monitor:
+        if monitor and not qdel_monitor:
             src += '    "%s" "%s" killdeps $JOB_ID\n' % (qtask.QTASK_MON, monitor)
         src += '  fi\n'
 
@@ -143,6 +228,10 @@ class SGE(qtask.JobRunner):
                 sys.stderr.write('\n')
                 raise RuntimeError(output)
             
+            if task.array:
+                # -terse returns "jobid.1-N:1" for array jobs
+                return output.strip().split('.')[0], src
+
             return output.strip(), src
 
         jobid = str(self.dry_run_cur_jobid)
@@ -150,7 +239,99 @@ class SGE(qtask.JobRunner):
         return 'dryrun.%s' % jobid, src
 
     def qdel(self, *jobid):
-        subprocess.call(["qdel", ','.join([str(x) for x in jobid])])
+        for batch in self._batches(jobid):
+            subprocess.call(["qdel", ','.join(batch)])
 
     def qrls(self, *jobid):
-        subprocess.call(["qrls", ','.join([str(x) for x in jobid])])
+        for batch in self._batches(jobid):
+            subprocess.call(["qrls", ','.join(batch)])
+
+    def job_states(self):
+        import getpass
+        import xml.etree.ElementTree as ET
+
+        proc = subprocess.Popen(["qstat", "-xml", "-u", getpass.getuser()], stdout=subprocess.PIPE)
+        output = proc.communicate()[0]
+        if proc.wait() != 0:
+            raise RuntimeError('Error running qstat')
+
+        states = {}
+        for job in ET.fromstring(output).iter('job_list'):
+            jobid = job.findtext('JB_job_number')
+            state = _state(job.findtext('state') or '')
+            name = job.findtext('JB_name')
+            tasks = job.findtext('tasks')
+            if tasks:
+                for taskid in _task_ids(tasks):
+                    states['%s.%s' % (jobid, taskid)] = {'state': state, 'name': name}
+            else:
+                states[jobid] = {'state': state, 'name': name}
+        return states
+
+    def job_accounting(self, jobids, since=None):
+        import getpass
+        import time
+
+        args = ["qacct", "-o", getpass.getuser()]
+        if since:
+            args.extend(["-b", time.strftime('%Y%m%d%H%M', time.localtime(since))])
+        args.append("-j")
+
+        proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output = proc.communicate()[0]
+        if proc.wait() != 0:
+            # (nothing has finished yet)
+            return {}
+
+        jobids = set(jobids)
+        found = {}
+        for record in _qacct_records(output):
+            jobid = record.get('jobnumber')
+            if record.get('taskid', 'undefined') != 'undefined':
+                jobid = '%s.%s' % (jobid, record['taskid'])
+            if jobid in jobids:
+                info = {'state': 'done', 'exit_status': int(record.get('exit_status', '0').split()[0])}
+                if record.get('failed', '0') != '0':
+                    info['failed'] = record['failed']
+                found[jobid] = info
+        return found
+
+
+def _state(code):
+    'maps a qstat state code (qw, hqw, r, Eqw, ...) to a job_states() state'
+    if 'E' in code:
+        return 'error'
+    if 'h' in code:
+        return 'held'
+    if 's' in code or 'S' in code or 'T' in code:
+        return 'suspended'
+    if 'r' in code or 't' in code or 'd' in code:
+        return 'running'
+    return 'pending'
+
+
+def _task_ids(tasks):
+    'expands an array task list ("4", "5-10:1", "1,3,7-9:2")'
+    for part in tasks.split(','):
+        if '-' in part:
+            rng, sep, step = part.partition(':')
+            start, end = [int(x) for x in rng.split('-')]
+            for i in xrange(start, end + 1, int(step) if step else 1):
+                yield i
+        else:
+            yield int(part)
+
+
+def _qacct_records(output):
+    'splits "qacct -j" output into dicts (one per job or array task)'
+    record = {}
+    for line in output.split('\n'):
+        if line[:5] == '=====':
+            if record:
+                yield record
+            record = {}
+        elif line.strip():
+            cols = line.split(None, 1)
+            record[cols[0]] = cols[1].strip() if len(cols) > 1 else ''
+    if record:
+        yield record
@@ -0,0 +1,247 @@
+import subprocess
+import sys
+
+import qtask
+
+MAIL_TYPES = {'b': 'BEGIN', 'e': 'END', 'a': 'FAIL', 'n': 'NONE'}
+
+# squeue state -> job_states() state (other states are finished jobs)
+STATES = {'PD': 'pending', 'CF': 'pending', 'RQ': 'pending', 'RF': 'pending', 'R': 'running', 'CG': 'running', 'RS': 'running', 'SI': 'running', 'SO': 'running', 'S': 'suspended', 'ST': 'suspended', 'RH': 'held', 'RD': 'held', 'SE': 'error'}
+
+
+class Slurm(qtask.JobRunner):
+    '''
+    Slurm runner.
+
+    Jobs are submitted with --kill-on-invalid-dep, so jobs that depend on a
+    failed job are cancelled by Slurm.
+    '''
+    supports_array = True
+    jobid_var = '$SLURM_JOB_ID'
+    priority_range = (1000, 0)  # --nice (users can only lower their priority)
+    job_prefix = 'slurmjob_'
+
+    def __init__(self, account=None, tmpdir='/tmp', *args, **kwargs):
+        self.dry_run_cur_jobid = 1
+        self.account = account
+        self.tmpdir = tmpdir
+        qtask.JobRunner.__init__(self, *args, **kwargs)
+
+    def qsub(self, task, monitor, dryrun=False):
+        if task.array:
+            # each array task is tracked separately by the monitor
+            jobid = '$SLURM_ARRAY_JOB_ID'
+            jobvar = '$SLURM_ARRAY_JOB_ID.$SLURM_ARRAY_TASK_ID'
+        else:
+            jobid = '$SLURM_JOB_ID'
+            jobvar = '$SLURM_JOB_ID'
+
+        src = '#!/bin/bash\n'
+        src += '#SBATCH --job-name=%s\n' % self.job_name(task)
+
+        if 'holding' in task.resources:
+            src += '#SBATCH --hold\n'
+
+        if task.array:
+            if 'tc' in task.resources:
+                src += '#SBATCH --array=1-%s%%%s\n' % (len(task.array), task.resources['tc'])
+            else:
+                src += '#SBATCH --array=1-%s\n' % len(task.array)
+
+        if 'env' in task.resources:
+            src += '#SBATCH --export=ALL\n'
+
+        if 'walltime' in task.resources:
+            src += '#SBATCH --time=%s\n' % self._calc_time(task.resources['walltime'])
+
+        if 'ppn' in task.resources:
+            src += '#SBATCH --nodes=1\n'
+            src += '#SBATCH --cpus-per-task=%s\n' % task.resources['ppn']
+
+        if 'mem' in task.resources:
+            # (per processor, like SGE's h_vmem)
+            src += '#SBATCH --mem-per-cpu=%s\n' % task.resources['mem']
+
+        if task.depends or 'depends' in task.resources:
+            depids = [t.jobid for t in task.depends if t.jobid]
+            if 'depends' in task.resources:
+                depids.extend(task.resources['depends'].split(','))
+
+            if depids:
+                # one afterok for all of them (an array job id covers all of its tasks)
+                uniq = []
+                for depid in depids:
+                    if depid not in uniq:
+                        uniq.append(depid)
+                src += '#SBATCH --dependency=afterok:%s\n' % ':'.join(uniq)
+                src += '#SBATCH --kill-on-invalid-dep=yes\n'
+
+        if 'priority' in task.resources:
+            src += '#SBATCH --nice=%s\n' % task.resources['priority']
+
+        if 'qos' in task.resources:
+            src += '#SBATCH --qos=%s\n' % task.resources['qos']
+
+        if 'queue' in task.resources:
+            src += '#SBATCH --partition=%s\n' % task.resources['queue']
+
+        if 'mail' in task.resources:
+            types = [MAIL_TYPES[x] for x in task.resources['mail'] if x in MAIL_TYPES]
+            if types:
+                src += '#SBATCH --mail-type=%s\n' % ','.join(types)
+
+        if 'wd' in task.resources:
+            src += '#SBATCH --chdir=%s\n' % task.resources['wd']
+
+        if 'account' in task.resources and task.resources['account']:
+            src += '#SBATCH --account=%s\n' % task.resources['account']
+        elif self.account:
+            src += '#SBATCH --account=%s\n' % self.account
+
+        if monitor or task.array:
+            # array task output is redirected by the script (paths may use $QTASK_INPUT)
+            src += '#SBATCH --output=/dev/null\n'
+            src += '#SBATCH --error=/dev/null\n'
+        else:
+            if 'stdout' in task.resources:
+                src += '#SBATCH --output=%s\n' % task.resources['stdout']
+
+            if 'stderr' in task.resources:
+                src += '#SBATCH --error=%s\n' % task.resources['stderr']
+
+        src += 'FAILED=""\n'
+        src += 'TMPDIR="${TMPDIR:-%s}"\n' % self.tmpdir
+
+        if task.array:
+            src += 'QTASK_INPUT="$(sed -n "${SLURM_ARRAY_TASK_ID}p" "%s")"\n' % task.array_index
+            src += 'QTASK_INPUT_BASE="${QTASK_INPUT##*/}"\n'
+            src += 'export QTASK_INPUT QTASK_INPUT_BASE\n'
+
+        # scancel and time limits send SIGTERM (followed by SIGKILL)
+        src += 'notify_kill() {\n'
+        src += '  FAILED="1"\n'
+        if monitor:
+            src += '  "%s" "%s" signal %s "SIGTERM"\n' % (qtask.QTASK_MON, monitor, jobvar)
+            src += '  "%s" "%s" killdeps %s\n' % (qtask.QTASK_MON, monitor, jobid)
+        elif task.fused and task.resources.get('monitor'):
+            # fused tasks report to the monitor themselves (this aborts the
+            # unfinished ones, jobid.N)
+            src += '  "%s" "%s" signal %s "SIGTERM"\n' % (qtask.QTASK_MON, task.resources['monitor'], jobvar)
+        src += '}\n'
+        src += 'trap notify_kill SIGTERM\n'
+
+        src += 'set -o pipefail\nfunc () {\n  %s\n  return $?\n}\n' % task.cmd
+
+        if monitor:
+            src += '"%s" "%s" start %s $HOSTNAME\n' % (qtask.QTASK_MON, monitor, jobvar)
+            src += '%s 2>"$TMPDIR/%s.qtask.stderr" >"$TMPDIR/%s.qtask.stdout"\n' % (qtask._measured(task, 'func', '$TMPDIR/%s.qtask.rusage' % jobvar), jobvar, jobvar)
+            src += 'RETVAL=$?\n'
+            src += 'if [ "$FAILED" == "" ]; then\n'
+            src += '  "%s" "%s" stop %s $RETVAL "$TMPDIR/%s.qtask.stdout" "$TMPDIR/%s.qtask.stderr" "$TMPDIR/%s.qtask.rusage"\n' % (qtask.QTASK_MON, monitor, jobvar, jobvar, jobvar, jobvar)
+            if task.measured:
+                src += '  rm -f "$TMPDIR/%s.qtask.rusage"\n' % jobvar
+            if 'stdout' in task.resources:
+                src += '  mv "$TMPDIR/%s.qtask.stdout" "%s"\n' % (jobvar, task.resources['stdout'])
+            else:
+                src += '  rm "$TMPDIR/%s.qtask.stdout"\n' % jobvar
+
+            if 'stderr' in task.resources:
+                src += '  mv "$TMPDIR/%s.qtask.stderr" "%s"\n' % (jobvar, task.resources['stderr'])
+            else:
+                src += '  rm "$TMPDIR/%s.qtask.stderr"\n' % jobvar
+
+            src += '  if [ $RETVAL -ne 0 ]; then\n'
+            src += '    "%s" "%s" killdeps %s\n' % (qtask.QTASK_MON, monitor, jobid)
+            src += '  fi\n'
+            src += 'fi\n'
+        elif task.array:
+            src += 'func'
+            if 'stdout' in task.resources:
+                src += ' >"%s"' % task.resources['stdout']
+            if 'stderr' in task.resources:
+                src += ' 2>"%s"' % task.resources['stderr']
+            src += '\n'
+            src += 'RETVAL=$?\n'
+        else:
+            src += 'func\n'
+            src += 'RETVAL=$?\n'
+
+        src += 'exit $RETVAL\n'
+
+        if not dryrun:
+            proc = subprocess.Popen(["sbatch", "--parsable"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            output = proc.communicate(src)[0]
+            retval = proc.wait()
+
+            if retval != 0:
+                sys.stderr.write('Error submitting job %s: %s\n' % (task.name, output))
+                sys.stderr.write(src)
+                sys.stderr.write('\n')
+                raise RuntimeError(output)
+
+            # --parsable returns "jobid" or "jobid;cluster"
+            return output.strip().split(';')[0], src
+
+        jobid = str(self.dry_run_cur_jobid)
+        self.dry_run_cur_jobid += 1
+        return 'dryrun.%s' % jobid, src
+
+    def qdel(self, *jobid):
+        for batch in self._batches(jobid):
+            subprocess.call(["scancel"] + batch)
+
+    def qrls(self, *jobid):
+        for batch in self._batches(jobid):
+            subprocess.call(["scontrol", "release", ','.join(batch)])
+
+    def job_states(self):
+        import getpass
+
+        # -r lists each array task as jobid_N (monitor rows are jobid.N)
+        # (the job name is last, it may have spaces)
+        proc = subprocess.Popen(["squeue", "-h", "-r", "-u", getpass.getuser(), "-o", "%i %t %r %j"], stdout=subprocess.PIPE)
+        output = proc.communicate()[0]
+        if proc.wait() != 0:
+            raise RuntimeError('Error running squeue')
+
+        states = {}
+        for line in output.split('\n'):
+            cols = line.split(None, 3)
+            if len(cols) < 2:
+                continue
+            jobid, code = cols[0].replace('_', '.'), cols[1]
+            name = cols[3] if len(cols) > 3 else None
+            if code == 'PD' and len(cols) > 2 and cols[2].startswith('JobHeld'):
+                states[jobid] = {'state': 'held', 'name': name}
+            else:
+                states[jobid] = {'state': STATES.get(code, 'done'), 'name': name}
+        return states
+
+    def job_accounting(self, jobids, since=None):
+        import getpass
+        import time
+
+        args = ["sacct", "-n", "-P", "-X", "-u", getpass.getuser(), "-o", "JobID,State,ExitCode"]
+        if since:
+            args.extend(["-S", time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(since))])
+
+        proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output = proc.communicate()[0]
+        if proc.wait() != 0:
+            return {}
+
+        jobids = set(jobids)
+        found = {}
+        for line in output.split('\n'):
+            cols = line.split('|')
+            if len(cols) < 3:
+                continue
+            jobid = cols[0].replace('_', '.')
+            # (ExitCode is "exit_status:signal", State is ex: "OUT_OF_MEMORY" or "CANCELLED by 123")
+            state = cols[1].split()[0] if cols[1] else ''
+            if jobid in jobids and state not in ['PENDING', 'RUNNING', 'SUSPENDED', 'REQUEUED', 'RESIZING']:
+                info = {'state': 'done', 'exit_status': int(cols[2].split(':')[0] or 0)}
+                if state != 'COMPLETED':
+                    info['failed'] = state
+                found[jobid] = info
+        return found
@@ -0,0 +1,511 @@
+'''
+Throttled (sliding window) submission.
+
+If "max_queued" is set ($QTASK_MAX_QUEUED), submit() stops after that many
+jobs (array tasks count separately) and hands the rest of the pipeline to a
+background qtask-throttle process. It checks the scheduler every
+"throttle_interval" seconds (runner.cached_job_states(), so any number of them
+only cost one qstat per interval), and submits more tasks as the pipeline's
+jobs finish.
+
+The state for each run is kept in "throttle_dir" (default: ~/.qtask-throttle):
+
+  run.state     the tasks that haven't been submitted yet (pickled, written
+                once), as plain values: each task's dependencies are saved by
+                their position (or job id, if they were already submitted), so
+                the size of the graph doesn't matter
+  run.journal   one line for each change: "submit N token" before task N is
+                submitted, "jobid N jobid" after, "reported" once their
+                monitor rows are written, "release jobid..." once they are
+                released, and "skip N" for tasks that won't run
+  run.log       output from qtask-throttle
+
+Deferred jobs are submitted on hold and only released once their job ids
+are in the journal. If qtask-throttle dies between qsub and the journal
+write, the job it submitted can't run. Each job's name ends with a token that
+is journaled before qsub, so when it is restarted (qtask-throttle run.state),
+it looks for a job with that name in the scheduler, and uses it instead of
+submitting the task again.
+
+Tasks whose dependencies failed (according to the monitor, or the scheduler's
+accounting records) are skipped, along with everything that depends on them.
+Dependencies that already finished successfully are left out of the job
+(PBS and Slurm reject dependencies on jobs they no longer know about).
+'''
+import itertools
+import os
+import sys
+import time
+
+import qtask
+import qtask.monitor
+
+
+def queued_size(t):
+    'the number of scheduler entries for a task'
+    return len(t.array) if t.array else 1
+
+
+def state_dir(config):
+    return os.path.expanduser(config.get('throttle_dir') or '~/.qtask-throttle')
+
+
+def _dep_refs(depends, index):
+    'dependencies by their position in the deferred tasks, or job id'
+    refs = []
+    for d in depends:
+        if d in index:
+            refs.append(index[d])
+        elif d.jobid:
+            refs.append(d.jobid)
+    return refs
+
+
+def _save_task(t, index, chain=()):
+    'the state of a deferred task (see _load_tasks)'
+    saved = {
+        'name': t.name,
+        'basename': t.basename,
+        'cmd': t.cmd,
+        'resources': t.resources,
+        'array': t.array,
+        'measured': t.measured,
+        'task_hash': t.task_hash,
+        'barrier': t.barrier,
+        # (a fused task's dependencies on the tasks before it in its chain are implied)
+        'depends': _dep_refs([d for d in t.depends if d not in chain], index),
+    }
+    if t.fused:
+        saved['fused'] = [_save_task(sub, index, t.fused) for sub in t.fused]
+    return saved
+
+
+def _load_task(saved):
+    t = qtask.QTask(saved['cmd'], saved['name'], array=saved['array'])
+    t.resources = saved['resources']
+    t.basename = saved['basename']
+    t.measured = saved['measured']
+    t.task_hash = saved['task_hash']
+    t.barrier = saved['barrier']
+    if 'fused' in saved:
+        t.fused = [_load_task(x) for x in saved['fused']]
+    return t
+
+
+def _load_tasks(saved):
+    'rebuilds the deferred tasks (and the links between them)'
+    tasks = [_load_task(x) for x in saved]
+
+    def deps(refs):
+        return [tasks[x] if type(x) == int else qtask._QTaskDirectWrapper(x) for x in refs]
+
+    for t, x in zip(tasks, saved):
+        t.depends = deps(x['depends'])
+        for d in t.depends:
+            if isinstance(d, qtask.QTask):
+                d.children.append(t)
+        if t.fused:
+            for sub, sub_saved in zip(t.fused, x['fused']):
+                sub.depends = deps(sub_saved['depends'])
+    return tasks
+
+
+def start(pipeline, deferred, max_queued):
+    '''
+    Saves the deferred tasks (in submission order) and starts qtask-throttle
+    in the background (in its own session, so it survives logging out).
+    Returns the path to the state file.
+    '''
+    import cPickle
+
+    path = state_dir(pipeline.config)
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    # (fused tasks are referred to by the job that runs them)
+    index = {}
+    for i, t in enumerate(deferred):
+        index[t] = i
+        for sub in t.fused or []:
+            index[sub] = i
+
+    base = os.path.join(path, pipeline.run_code)
+    state = {
+        'config': pipeline.config,
+        'runner': pipeline.runner,
+        'project': pipeline.project,
+        'sample': pipeline.sample,
+        'run_code': pipeline.run_code,
+        'max_queued': max_queued,
+        'submitted': [(t.jobid, queued_size(t)) for t in pipeline._submit_order],
+        'arrays': len([t for t in pipeline._submit_order if t.array]),
+        'saved': time.time(),
+        'tasks': [_save_task(t, index) for t in deferred],
+    }
+
+    tmp = '%s.state.%s' % (base, os.getpid())
+    with open(tmp, 'wb') as f:
+        cPickle.dump(state, f, cPickle.HIGHEST_PROTOCOL)
+    os.rename(tmp, '%s.state' % base)
+
+    qtask.check_path(qtask.QTASK_THROTTLE)
+
+    import subprocess
+    with open('/dev/null') as devnull:
+        with open('%s.log' % base, 'a') as log:
+            subprocess.Popen([qtask.QTASK_THROTTLE, '%s.state' % base], stdin=devnull, stdout=log, stderr=subprocess.STDOUT, close_fds=True, preexec_fn=os.setsid)
+
+    return '%s.state' % base
+
+
+class Throttle(object):
+    def __init__(self, state_file):
+        import cPickle
+
+        if state_file[-6:] != '.state':
+            raise ValueError('Not a qtask-throttle state file: %s' % state_file)
+
+        self.base = state_file[:-6]
+        with open(state_file, 'rb') as f:
+            state = cPickle.load(f)
+
+        self.config = state['config']
+        self.runner = state['runner']
+        self.project = state['project']
+        self.sample = state['sample']
+        self.run_code = state['run_code']
+        self.max_queued = state['max_queued']
+        self.submitted = dict(state['submitted'])  # jobid -> scheduler entries
+        self.tasks = _load_tasks(state['tasks'])
+        self.arrays = state['arrays']
+
+        self.skipped = set()
+        self.held = []          # submitted on hold, not released yet
+        self.unreported = []    # indexes of submitted tasks without monitor rows (after a restart)
+        self.in_doubt = None    # index of a task that may have been submitted
+        self.in_doubt_token = None  # its token (see runner.job_name)
+        self.in_doubt_jobid = None  # its job, if it was
+        self.recent = {}        # jobid -> submit time (newer than the scheduler's states)
+        self.pos = 0
+        self._journal = None
+
+        for jobid in self.submitted:
+            self.recent[jobid] = state['saved']
+        self._lock = None
+
+    def lock(self):
+        'returns False if another qtask-throttle is already working on this run'
+        import fcntl
+        self._lock = open('%s.lock' % self.base, 'a')
+        try:
+            fcntl.flock(self._lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            return False
+        return True
+
+    def replay(self):
+        'applies the journal (after a restart)'
+        path = '%s.journal' % self.base
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    cols = line.split()
+                    if not cols or (cols[0] not in ['release', 'reported'] and len(cols) < 2) or (cols[0] == 'submit' and len(cols) < 3):
+                        # (a partial line from a crash)
+                        continue
+
+                    if cols[0] == 'submit':
+                        self.in_doubt = int(cols[1])
+                        self.in_doubt_token = cols[2]
+                    elif cols[0] == 'jobid' and len(cols) == 3:
+                        t = self.tasks[int(cols[1])]
+                        t.jobid = cols[2]
+                        t.token = self.in_doubt_token
+                        self.submitted[t.jobid] = queued_size(t)
+                        # (until the scheduler has been asked again)
+                        self.recent[t.jobid] = time.time()
+                        self.held.append(t)
+                        self.unreported.append(int(cols[1]))
+                        self.in_doubt = None
+                        self.in_doubt_token = None
+                        self.pos = int(cols[1]) + 1
+                    elif cols[0] == 'reported':
+                        self.unreported = []
+                    elif cols[0] == 'release':
+                        released = set(cols[1:])
+                        self.held = [t for t in self.held if t.jobid not in released]
+                    elif cols[0] == 'skip':
+                        self.skipped.add(self.tasks[int(cols[1])])
+                        self.pos = int(cols[1]) + 1
+
+        if self.in_doubt is not None:
+            # (looked up, see find_in_doubt())
+            self.pos = self.in_doubt
+
+        self._journal = open(path, 'a')
+
+    def find_in_doubt(self):
+        '''
+        Looks for the job of a task that may have been submitted before a
+        restart: a job with the task's name and the token that was journaled
+        for it. Returns its job id, or None if it wasn't submitted.
+        '''
+        t = self.tasks[self.in_doubt]
+        t.token = self.in_doubt_token
+        name = self.runner.job_name(t)
+        found = [x for x in self.runner.find_jobs(name) if x not in self.submitted]
+
+        if len(found) > 1:
+            raise RuntimeError('More than one job is named %s (%s). Remove the ones that aren\'t part of run %s with qdel, then restart qtask-throttle.' % (name, ', '.join(found), self.run_code))
+        return found[0] if found else None
+
+    def journal(self, line):
+        self._journal.write('%s\n' % line)
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+
+    def outstanding(self, ts, states):
+        'the number of the pipeline\'s jobs that are still queued or running'
+        count = 0
+        for key in states:
+            if states[key]['state'] != 'done' and (key in self.submitted or self.runner.monitor_jobid(key) in self.submitted):
+                count += 1
+
+        # (submitted after the states were read)
+        for jobid in self.submitted:
+            if self.recent.get(jobid, 0) >= ts:
+                count += self.submitted[jobid]
+        return count
+
+    def _dep_states(self, jobids, ts, states):
+        '''
+        returns a dict: jobid -> active, done, or failed. Jobs the scheduler
+        doesn't list are looked up in the monitor (or its accounting records).
+        '''
+        active = set()
+        for key in states:
+            if states[key]['state'] != 'done':
+                active.add(key)
+                active.add(self.runner.monitor_jobid(key))
+
+        result = {}
+        finished = []
+        for jobid in jobids:
+            if jobid in active or self.recent.get(jobid, 0) >= ts:
+                result[jobid] = 'active'
+            elif jobid in states and 'exit_status' in states[jobid]:
+                result[jobid] = 'done' if states[jobid]['exit_status'] == 0 else 'failed'
+            else:
+                finished.append(jobid)
+
+        if not finished:
+            return result
+
+        uri = self.config.get('monitor')
+        if uri and uri[:9] == 'sqlite://':
+            mon = qtask.monitor.load_monitor(uri)
+            try:
+                rows = {}
+                for row in mon.find(run=self.run_code, columns=['jobid', 'status']):
+                    rows.setdefault(self.runner.monitor_jobid(row['jobid']), []).append(row['status'])
+                    rows.setdefault(row['jobid'], []).append(row['status'])
+            finally:
+                mon.close()
+
+            for jobid in finished:
+                statuses = rows.get(jobid, ['done'])
+                # (still pending/running in the monitor, but gone from the scheduler: lost)
+                result[jobid] = 'done' if set(statuses) == set(['done']) else 'failed'
+        else:
+            found = self.runner.job_accounting(finished)
+            for jobid in finished:
+                info = found.get(jobid)
+                result[jobid] = 'failed' if info and (info.get('exit_status') or info.get('failed')) else 'done'
+
+        return result
+
+    def submit_more(self, ts, states, free):
+        '''
+        Submits (on hold) up to "free" entries worth of tasks, returns the
+        number of tasks that were submitted.
+        '''
+        pipeline = qtask.pipeline
+        mon = None
+        if self.config.get('monitor'):
+            mon = qtask.monitor.load_monitor(self.config['monitor'])
+            mon.begin_batch()
+
+        count = 0
+        dep_states = None
+        try:
+            while self.pos < len(self.tasks) and free > 0:
+                t = self.tasks[self.pos]
+
+                if [d for d in t.depends if d in self.skipped]:
+                    self._skip(t, 'a dependency was skipped')
+                    continue
+
+                if dep_states is None:
+                    jobids = set()
+                    for x in self.tasks[self.pos:self.pos + max(free, 1)]:
+                        jobids.update([d.jobid for d in x.depends if d.jobid])
+                    dep_states = self._dep_states(jobids, ts, states)
+
+                deps = [d for d in t.depends if d.jobid]
+                missing = [d.jobid for d in deps if d.jobid not in dep_states]
+                if missing:
+                    dep_states.update(self._dep_states(missing, ts, states))
+
+                failed = [d.jobid for d in deps if dep_states[d.jobid] == 'failed']
+                if failed:
+                    self._skip(t, 'dependency failed: %s' % ','.join(failed))
+                    continue
+
+                # (array index files are numbered after the ones the pipeline wrote, the
+                # same for each attempt)
+                pipeline._array_seq = itertools.count(self.arrays + self.pos + 1)
+                if not pipeline._prepare_task(t):
+                    self._remove_in_doubt()
+                    self.journal('skip %s' % self.pos)
+                    self.pos += 1
+                    continue
+
+                if not t.token:
+                    t.token = qtask._submit_token()
+                self.journal('submit %s %s' % (self.pos, t.token))
+
+                # finished dependencies are left out, the job itself is held
+                depends = t.depends
+                held = 'holding' in t.resources
+                t.depends = [d for d in depends if not d.jobid or dep_states[d.jobid] == 'active']
+                if not held:
+                    t.resources['holding'] = True
+                try:
+                    if self.pos == self.in_doubt and self.in_doubt_jobid:
+                        # it was submitted before the restart (the script is only
+                        # needed for the monitor)
+                        jobid = self.in_doubt_jobid
+                        src = pipeline._qsub(t, dryrun=True)[1]
+                        sys.stdout.write('%s was already submitted (%s)\n' % (t.fullname, jobid))
+                    else:
+                        jobid, src = pipeline._qsub(t)
+                finally:
+                    t.depends = depends
+                    if not held:
+                        del t.resources['holding']
+
+                self.journal('jobid %s %s' % (self.pos, jobid))
+                self.in_doubt = None
+                self.in_doubt_token = None
+                self.in_doubt_jobid = None
+                pipeline._task_submitted(t, jobid)
+                pipeline._report_task(t, src, mon)
+                self.submitted[jobid] = queued_size(t)
+                self.recent[jobid] = time.time()
+                if not held:
+                    self.held.append(t)
+
+                self.pos += 1
+                free -= queued_size(t)
+                count += 1
+        finally:
+            if mon:
+                # all rows need to be written before any jobs are released
+                mon.end_batch()
+                mon.close()
+                if count:
+                    self.journal('reported')
+            self.release()
+
+        return count
+
+    def _remove_in_doubt(self):
+        'removes the job of the in doubt task (when it is skipped)'
+        if self.pos == self.in_doubt:
+            if self.in_doubt_jobid:
+                self.runner.qdel(self.in_doubt_jobid)
+            self.in_doubt = None
+            self.in_doubt_token = None
+            self.in_doubt_jobid = None
+
+    def _skip(self, t, reason):
+        sys.stdout.write('skipped %s (%s)\n' % (t.fullname, reason))
+        self._remove_in_doubt()
+        self.skipped.add(t)
+        self.journal('skip %s' % self.pos)
+        self.pos += 1
+
+    def report(self):
+        '''
+        Writes the monitor rows for jobs that were submitted just before a
+        restart (their rows are written after each round of submissions).
+        '''
+        if self.unreported and self.config.get('monitor'):
+            pipeline = qtask.pipeline
+            mon = qtask.monitor.load_monitor(self.config['monitor'])
+            mon.begin_batch()
+            try:
+                for pos in self.unreported:
+                    t = self.tasks[pos]
+                    pipeline._array_seq = itertools.count(self.arrays + pos + 1)
+                    pipeline._prepare_task(t)
+                    src = pipeline._qsub(t, dryrun=True)[1]
+                    pipeline._report_task(t, src, mon)
+            finally:
+                mon.end_batch()
+                mon.close()
+            self.journal('reported')
+        self.unreported = []
+
+    def release(self):
+        if self.held:
+            jobids = [t.jobid for t in self.held]
+            self.runner.qrls(*jobids)
+            self.journal('release %s' % ' '.join(jobids))
+            self.held = []
+
+    def setup(self):
+        'points qtask.pipeline at this run (for its submission helpers)'
+        pipeline = qtask.pipeline
+        pipeline.config = self.config
+        pipeline.runner = self.runner
+        pipeline.project = self.project
+        pipeline.sample = self.sample
+        pipeline.run_code = self.run_code
+        pipeline._submitted_tasks = set()
+        pipeline._submit_order = []
+
+    def run(self, interval=None):
+        if interval is None:
+            interval = float(self.config.get('throttle_interval', 30))
+
+        self.setup()
+        self.report()
+        self.release()
+
+        if self.in_doubt is not None:
+            self.in_doubt_jobid = self.find_in_doubt()
+
+        while self.pos < len(self.tasks):
+            ts, states = self.runner.cached_job_states(interval)
+            free = self.max_queued - self.outstanding(ts, states)
+            if free > 0:
+                count = self.submit_more(ts, states, free)
+                if count:
+                    sys.stdout.write('%s: submitted %s, %s left\n' % (time.strftime('%Y-%m-%d %H:%M:%S'), count, len(self.tasks) - self.pos))
+                    sys.stdout.flush()
+
+            if self.pos < len(self.tasks):
+                time.sleep(interval)
+
+        self.journal('finished')
+        self._journal.close()
+
+    def status(self):
+        return {'run': self.run_code, 'tasks': len(self.tasks), 'submitted': len([t for t in self.tasks if t.jobid]), 'skipped': len(self.skipped), 'left': len(self.tasks) - self.pos}
+
+    def cleanup(self):
+        'removes the state (once everything has been submitted)'
+        for ext in ['state', 'journal', 'lock']:
+            if os.path.exists('%s.%s' % (self.base, ext)):
+                os.unlink('%s.%s' % (self.base, ext))
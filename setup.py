@@ -9,5 +9,5 @@ setup(name='qtask',
       author_email='mbreese@stanford.edu',
       url='http://github.com/mbreese/qtask/',
       packages=['qtask', 'qtask.monitor'],
-      scripts=['bin/mqsub', 'bin/mqdel', 'bin/qtask-mon']
+      scripts=['bin/mqsub', 'bin/mqdel', 'bin/qtask-mon', 'bin/qtask-collector', 'bin/qtask-stat', 'bin/qtask-watch', 'bin/qtask-rusage', 'bin/qtask-throttle']
      )